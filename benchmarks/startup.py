@@ -0,0 +1,106 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+Measure smwflow start-up cost.
+
+For each mode, a fresh interpreter imports smwflow.config and
+smwflow.process, parses the arguments (loading the vault and global
+variables where the mode needs them) and reports the elapsed time and which
+heavyweight modules ended up loaded.  Modes are only timed up to the point
+smwflow.process.process() would be called, against a scratch smwflow.conf and
+empty repos, so no SMW or git state is needed.
+
+usage: python benchmarks/startup.py [repetitions]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+HEAVY_MODULES = ['rsm', 'jinja2', 'yaml', 'ansible', 'multiprocessing']
+
+MODES = [
+    ['status'],
+    ['checkout', 'master'],
+    ['verify', 'hss'],
+    ['update', '--dry-run', 'imps'],
+]
+
+PROBE = r'''
+import sys, time, json
+start = time.time()
+import smwflow.config
+import smwflow.process
+imported = time.time()
+try:
+    smwflow.config.ArgConfig(smwflow.config.BaseConfig(), %(argv)r)
+    error = None
+except BaseException as err:
+    error = repr(err)
+done = time.time()
+heavy = sorted(x for x in %(heavy)r if x in sys.modules)
+sys.stderr.write(json.dumps({'import': imported - start, 'config': done - imported,
+                             'heavy': heavy, 'error': error}) + '\n')
+'''
+
+def make_workdir():
+    """Create a scratch directory holding etc/smwflow.conf and empty repos."""
+    workdir = tempfile.mkdtemp(prefix='smwflow-bench-')
+    os.mkdir(os.path.join(workdir, 'etc'))
+    for repo in ['smwconf', 'secured', 'zypper']:
+        os.mkdir(os.path.join(workdir, repo))
+    with open(os.path.join(workdir, 'etc', 'smwflow.conf'), 'w') as wfp:
+        wfp.write('[smwflow]\n')
+        for repo in ['smwconf', 'secured', 'zypper']:
+            wfp.write('%s=%s\n' % (repo, os.path.join(workdir, repo)))
+        wfp.write('system=bench\n')
+    return workdir
+
+def probe(workdir, argv):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = PROBE % {'argv': argv, 'heavy': HEAVY_MODULES}
+    env = dict(os.environ, PYTHONPATH=root)
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env,
+                                stdout=devnull, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+    return json.loads(stderr.strip().splitlines()[-1])
+
+def main(argv):
+    reps = int(argv[0]) if argv else 5
+    workdir = make_workdir()
+    try:
+        run(workdir, reps)
+    finally:
+        shutil.rmtree(workdir)
+
+def run(workdir, reps):
+    print "%-26s %10s %10s  %s" % ('mode', 'import ms', 'config ms', 'heavy modules loaded')
+    for mode in MODES:
+        results = [probe(workdir, mode) for _ in xrange(reps)]
+        import_ms = min(x['import'] for x in results) * 1000
+        config_ms = min(x['config'] for x in results) * 1000
+        heavy = ','.join(results[-1]['heavy']) or '-'
+        print "%-26s %10.1f %10.1f  %s" % (' '.join(mode), import_ms, config_ms, heavy)
+        if results[-1]['error']:
+            print "    (argument processing failed: %s)" % results[-1]['error']
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
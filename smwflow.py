@@ -22,8 +22,13 @@ import smwflow.process
 
 def main(argv):
     base_config = smwflow.config.BaseConfig()
-    config = smwflow.config.ArgConfig(base_config, argv).values
-    rc = smwflow.process.process(config)
+    arg_config = smwflow.config.ArgConfig(base_config, argv)
+    config = arg_config.values
+    if arg_config.forwarded:
+        import smwflow.server as server
+        rc = server.forward(config.server, argv)
+    else:
+        rc = smwflow.process.process(config)
     sys.exit(rc)
 
 if __name__ == "__main__":
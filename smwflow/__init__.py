@@ -29,81 +29,124 @@ CONFIG_PATH = './etc'
 __all__ = ["config", "process"]
 
 class SmwflowObject(object):
-    def __init__(self, name=None, smw_rel_path=None, parent=None, **kwargs):
-        self.__data__ = dict()
-        self.__set_callback__ = dict()
-        self.__get_callback__ = dict()
+    """A managed file: a git object and its counterpart on the SMW.
+
+    Objects behave like dictionaries, but the common fields are stored in
+    __slots__ (and may also be read as attributes once set); any other key,
+    e.g. a manifest extra, goes to an overflow dictionary created on first
+    use.  Unset fields are simply absent, as with a dictionary.
+    """
+    FIELDS = ('name', 'fullpath', 'smwpath', 'repo', 'fstype', 'mode', 'owner', 'group',
+              'formattype', 'git_data', 'smw_data', 'git_digest', 'smw_digest')
+    __slots__ = FIELDS + ('extras',)
+
+    def __init__(self, name=None, parent=None, **kwargs):
+        self.extras = None
+        if parent is not None:
+            self._copyconstructor(parent)
         if name:
-            self['name'] = name
-        if smw_rel_path:
-            self['smw_rel_path'] = smw_rel_path
+            self.name = name
         for key in kwargs:
             self[key] = kwargs[key]
-        if parent_obj:
-            self._copyconstructor(parent)
         self._basic_verify()
 
-    def name(self):
-        return self['name']
-
-    def get_smw_path(self):
-        return self['smw_path']
-
-    def get_git_path(self):
-        return self['git_path']
-
-    def get_git_data(self):
-        return self['git_data']
-
-    def get_swm_data(self):
-        return self['smw_data']
-
     def _copyconstructor(self, parent_obj):
         if not isinstance(parent_obj, SmwflowObject):
             raise ValueError("Invalid parent smwflow object")
 
         for key in parent_obj.keys():
-            self[key] = parent_obj[key]
+            self[key] = copy.copy(parent_obj[key])
 
     def _basic_verify(self):
-        if 'name' not in self:
+        if not hasattr(self, 'name'):
             raise ValueError('Invalid name for SmwflowObject')
-        if 'smw_rel_path' not in self:
-            raise ValueError('Invalid smw_rel_path for SmwflowObject')
 
     def __getitem__(self, key):
-        if key in self.__get_callback__:
-            return self.__get_callback__[key](key)
-        return self.__data__[key]
-
-    def keys(self):
-        keys = set(self.__get_callback__.keys())
-        keys |= set(self.__set_callback__.keys())
-        keys |= set(self.__data__.keys())
-        return list(keys)
+        if key in _SMWFLOW_OBJECT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extras is not None and key in self.extras:
+            return self.extras[key]
+        raise KeyError(key)
 
     def __setitem__(self, key, value):
-        if key in self.__set_callback__:
-            self.__set_callback__[key](key, value)
+        if key in _SMWFLOW_OBJECT_FIELDS:
+            setattr(self, key, value)
         else:
-            self.__data__[key] = value
+            if self.extras is None:
+                self.extras = {}
+            self.extras[key] = value
 
     def __delitem__(self, key):
-        if key in self.__data__:
-            del self.__data__[key]
-        if key in self.__set_callback__:
-            del self.__set_callback__[key]
-        if key in self.__get_callback__:
-            del self.__get_callback__[key]
+        if key in _SMWFLOW_OBJECT_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extras is not None and key in self.extras:
+            del self.extras[key]
+        else:
+            raise KeyError(key)
 
     def __contains__(self, key):
-        if key in self.__data__:
-            return True
-        if key in self.__set_callback__:
-            return True
-        if key in self.__get_callback__:
-            return True
-        return False
+        if key in _SMWFLOW_OBJECT_FIELDS:
+            return hasattr(self, key)
+        return self.extras is not None and key in self.extras
+
+    def keys(self):
+        keys = [x for x in self.FIELDS if hasattr(self, x)]
+        if self.extras:
+            keys.extend(self.extras.keys())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
 
     def __len__(self):
-        return len(self.keys())
+        count = sum(1 for x in self.FIELDS if hasattr(self, x))
+        return count + (len(self.extras) if self.extras else 0)
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other):
+        for key in other.keys():
+            self[key] = other[key]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.extras = None
+        self.update(state)
+
+    def __repr__(self):
+        return 'SmwflowObject(%r)' % self.to_dict()
+
+_SMWFLOW_OBJECT_FIELDS = frozenset(SmwflowObject.FIELDS)
@@ -0,0 +1,339 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.basesmw
+
+Management of base SMW operating system files (sshd, ntp, syslog, ...).
+
+The managed files are described by a registry: the defaults in
+MANAGED_BASESMW, extended or overridden by the list of entries in
+basesmw/registry.yaml of each repo.  The registry is indexed by name, by
+smwpath and by directory, so the SMW side is examined one directory at a
+time -- a single listing per directory for all the files managed in it --
+rather than file by file.  Git objects live in the basesmw/basesmw and
+basesmw/<system>_basesmw layers, like hss and imps objects.
+"""
+
+import os
+import stat
+import errno
+import shutil
+import yaml
+import smwflow.digests
+import smwflow.manifest
+import smwflow.render
+import smwflow.search
+import smwflow.smwfile
+import smwflow.variables
+
+MANAGED_BASESMW = [
+    {
+        'repo': 'smwconf',
+        'name': 'sshd_config',
+        'smwpath': '/etc/ssh/sshd_config',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0640,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'ssh_config',
+        'smwpath': '/etc/ssh/ssh_config',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0644,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'ntp.conf',
+        'smwpath': '/etc/ntp.conf',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0644,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'syslog-ng.conf',
+        'smwpath': '/etc/syslog-ng/syslog-ng.conf',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0644,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'resolv.conf',
+        'smwpath': '/etc/resolv.conf',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0644,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'hosts',
+        'smwpath': '/etc/hosts',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0644,
+        'owner': 'root',
+        'group': 'root'
+    },
+    {
+        'repo': 'smwconf',
+        'name': 'sudoers',
+        'smwpath': '/etc/sudoers',
+        'fstype': 'file',
+        'formattype': 'raw',
+        'mode': 0440,
+        'owner': 'root',
+        'group': 'root'
+    },
+]
+
+REGISTRY_FILENAME = 'registry.yaml'
+
+class Registry(object):
+    """Managed base SMW files indexed by name, smwpath and directory."""
+    def __init__(self, entries=None):
+        self.by_name = {}
+        self.by_smwpath = {}
+        self.by_dir = {}
+        self.symlinks = set()
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry):
+        """Add an entry, replacing any earlier entry of the same name."""
+        if entry['name'] in self.by_name:
+            self.remove(entry['name'])
+        self.by_name[entry['name']] = entry
+        self.by_smwpath[entry['smwpath']] = entry
+        dirname, basename = os.path.split(entry['smwpath'])
+        self.by_dir.setdefault(dirname, {})[basename] = entry
+
+    def remove(self, name):
+        entry = self.by_name.pop(name)
+        del self.by_smwpath[entry['smwpath']]
+        dirname, basename = os.path.split(entry['smwpath'])
+        del self.by_dir[dirname][basename]
+        if not self.by_dir[dirname]:
+            del self.by_dir[dirname]
+
+    def __iter__(self):
+        return iter(self.by_name[x] for x in sorted(self.by_name))
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def scan(self):
+        """Stat the managed files, listing each directory only once.
+
+        Symlinks are followed, and recorded in self.symlinks.
+
+        Returns: dict
+            smwpath -> stat result, or None if the file does not exist
+        """
+        ret = {}
+        self.symlinks = set()
+        for dirname in sorted(self.by_dir):
+            managed = self.by_dir[dirname]
+            try:
+                present = set(os.listdir(dirname)) & set(managed)
+            except OSError:
+                present = set()
+            for basename in managed:
+                smwpath = os.path.join(dirname, basename)
+                ret[smwpath] = None
+                if basename in present:
+                    try:
+                        ret[smwpath] = os.lstat(smwpath)
+                        if stat.S_ISLNK(ret[smwpath].st_mode):
+                            self.symlinks.add(smwpath)
+                            ret[smwpath] = os.stat(smwpath)
+                    except OSError:
+                        ret[smwpath] = None
+                smwflow.smwfile.STAT_CACHE.prime(smwpath, ret[smwpath])
+        return ret
+
+def load_registry(config):
+    """Build the registry from MANAGED_BASESMW and the repos' registry files."""
+    registry = Registry(MANAGED_BASESMW)
+    for repo in ['smwconf', 'secured']:
+        repo_path = getattr(config, repo, None)
+        if not repo_path:
+            continue
+        path = os.path.join(repo_path, 'basesmw', REGISTRY_FILENAME)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as rfp:
+            entries = yaml.safe_load(rfp.read()) or []
+        for entry in entries:
+            if 'name' not in entry or 'smwpath' not in entry:
+                print "WARNING: skipping invalid basesmw registry entry in %s: %s" % (path, entry)
+                continue
+            entry.setdefault('repo', repo)
+            entry.setdefault('fstype', 'file')
+            registry.add(entry)
+    return registry
+
+def import_data(config):
+    deferred_actions = []
+    registry = load_registry(config)
+    present = registry.scan()
+    for repo in ['smwconf', 'secured']:
+        repo_path = getattr(config, repo, None)
+        if not repo_path:
+            continue
+        if not os.access(repo_path, os.W_OK):
+            print "WARNING: cannot write to %s, skipping %s repo basesmw item import" % \
+                  (repo_path, repo)
+            continue
+        repo_basesmw = os.path.join(repo_path, 'basesmw')
+        for path in [repo_basesmw, os.path.join(repo_basesmw, '%s_basesmw' % config.system)]:
+            try:
+                os.mkdir(path, 0755)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise err
+        repo_basesmw = os.path.join(repo_basesmw, '%s_basesmw' % config.system)
+
+        manifest = smwflow.manifest.Manifest(repo_basesmw)
+
+        for item in registry:
+            if item['repo'] != repo or present[item['smwpath']] is None:
+                continue
+            shutil.copyfile(item['smwpath'], os.path.join(repo_basesmw, item['name']))
+            manifest[item['name']] = item
+
+        deferred_actions.extend(manifest.save())
+        deferred_actions.append("Add/Commit basesmw items in %s" % repo_path)
+    return deferred_actions
+
+def get_verify_objects(config, names=None):
+    """Discover the basesmw objects and render their git side.
+
+    Registry entries supply the smwpath, ownership, mode and format of
+    objects whose manifest does not.  If names is given, only those objects
+    are rendered and returned.
+    """
+    ret = {}
+    registry = load_registry(config)
+    objs = smwflow.search.get_objects(config, 'basesmw', 'basesmw')
+    basesmw_vars = smwflow.variables.read_vars(config, 'basesmw', 'vars', None,
+                                               config.global_vars)
+    for key in objs:
+        obj = objs[key]
+        if names is not None and key not in names:
+            continue
+        entry = registry.by_name.get(key, {})
+        for attr in ['smwpath', 'mode', 'owner', 'group', 'formattype']:
+            if attr not in obj and attr in entry:
+                obj[attr] = entry[attr]
+        if 'smwpath' not in obj:
+            print 'Skipping git basesmw file %s since it has no smwpath in the manifest ' \
+                  'or registry' % key
+            continue
+        obj['smwpath'] = smwflow.smwfile.smw_root_path(config, obj['smwpath'])
+        ret[key] = obj
+
+    keys = sorted(ret.keys())
+    rendered = smwflow.render.render_files([ret[x]['fullpath'] for x in keys], basesmw_vars,
+                                           smwflow.render.get_render_processes(config))
+    for key, git_data in zip(keys, rendered):
+        ret[key]['git_data'] = git_data
+    return ret
+
+def verify_object(config, obj, statobj, report=True):
+    """Compare a rendered basesmw object with its current state on the SMW.
+
+    statobj is the stat() result for obj['smwpath'] from Registry.scan(),
+    None if the file does not exist.  Without report, the comparison stops
+    at the first difference, as hss.verify_object().
+
+    Returns: tuple (issues, attributes_ok)
+        as hss.verify_object()
+    """
+    if statobj is None or not stat.S_ISREG(statobj.st_mode):
+        print 'git basesmw file %s does not exist as %s on SMW' % (obj['name'], obj['smwpath'])
+        return None, False
+    smw_data = smwflow.smwfile.read_smw_file(obj['smwpath'])
+    if not obj['git_data'] or not smw_data:
+        print 'Failed to read git or smw data for basesmw file %s (smw: %s)' % \
+              (obj['name'], obj['smwpath'])
+        return None, smwflow.smwfile.attributes_match(config, obj, statobj)
+    if not report:
+        issues = []
+        if not smwflow.digests.equal(config, obj, obj['git_data'], smw_data):
+            issues = ['%s differs' % obj['name']]
+    else:
+        issues = smwflow.digests.differences(config, obj, obj['git_data'], smw_data)
+    return issues, smwflow.smwfile.attributes_match(config, obj, statobj)
+
+def _verify_objects(config, names=None, report=True):
+    """Verify the basesmw objects, yielding (obj, issues, attributes_ok, is_symlink)."""
+    objs = get_verify_objects(config, names)
+    registry = Registry(objs.values())
+    stats = registry.scan()
+    for key in sorted(objs):
+        obj = objs[key]
+        issues, attributes_ok = verify_object(config, obj, stats[obj['smwpath']], report)
+        yield obj, issues, attributes_ok, obj['smwpath'] in registry.symlinks
+
+def verify_data(config, names=None):
+    deferred_actions = []
+    for obj, issues, attributes_ok, _ in _verify_objects(config, names):
+        if issues:
+            print "DIFFERENCES FOUND IN %s" % obj['name']
+            for item in issues:
+                print item
+            print ""
+        if issues is not None and not attributes_ok:
+            print 'WARNING: file on smw %s has incorrect ownership or mode' % obj['smwpath']
+        if issues is None or issues or not attributes_ok:
+            deferred_actions.append("Resolve differences in basesmw file %s" % obj['smwpath'])
+    return deferred_actions
+
+def update_data(config, plan):
+    """Add the writes and attribute changes needed by the basesmw files to plan."""
+    deferred_actions = []
+    for obj, issues, attributes_ok, is_symlink in _verify_objects(config, report=False):
+        if obj['git_data'] is None:
+            print "Skipping basesmw file %s, failed to render %s" % (obj['name'], obj['fullpath'])
+            deferred_actions.append("Resolve rendering of basesmw file %s" % obj['fullpath'])
+            continue
+        if is_symlink and (issues is None or issues or not attributes_ok):
+            # writing would go through the link to a file smwflow does not manage
+            print "Skipping basesmw file %s, %s is a symlink on SMW" % \
+                  (obj['name'], obj['smwpath'])
+            deferred_actions.append("Resolve differences in basesmw file %s (a symlink)" %
+                                    obj['smwpath'])
+            continue
+        if issues is None or issues:
+            print "Planning update of basesmw file %s in %s" % (obj['name'], obj['smwpath'])
+            plan.write(obj['smwpath'], obj['git_data'])
+        if issues is None or issues or not attributes_ok:
+            plan.attributes(obj['smwpath'], obj)
+    return deferred_actions
@@ -18,22 +18,27 @@ import os
 import sys
 import stat
 import subprocess
-import tempfile
 import codecs
 import datetime
+import multiprocessing
 import socket
-from jinja2 import Template
 import yaml
 import rsm.hss
 import smwflow
-import smwflow.compare
+import smwflow.digests
+import smwflow.gitrev
 import smwflow.manifest
 import smwflow.search
 import smwflow.smwfile
 import smwflow.variables
+import smwflow.plan
 import smwflow.plugin
+import smwflow.render
 
 
+CFGSET_OBJTYPES = ['worksheets', 'config', 'dist', 'ansible', 'files']
+CFGSET_FILETREE_OBJTYPES = ['ansible', 'files']
+
 MANAGED_CFGSET_WORKSHEET = {
 }
 
@@ -42,36 +47,156 @@ MANAGED_CFGSET_CONFIG = {
     'cray_local_users_config.yaml': {'mode': 0600},
 }
 
-def _render_obj(obj, objtype_vars):
-    git_data = None
-    if 'git_data' in obj:
-        return obj['git_data']
+# templated object types and their managed extras
+CFGSET_TEMPLATE_EXTRAS = {
+    'worksheets': MANAGED_CFGSET_WORKSHEET,
+    'config': MANAGED_CFGSET_CONFIG,
+    'dist': None,
+}
+
+def _plugin_git_data(obj, objtype_vars):
+    """Get the git content of a plugin-provided object, rendered if templated.
 
-    with codecs.open(obj['fullpath'], mode='r', encoding='utf-8') as rfp:
-        data = rfp.read()
-        template = Template(data)
-        git_data = template.render(objtype_vars)
+    The content is fetched from the plugin on demand and only its digest is
+    kept, in 'git_digest'.
+    """
+    plugin = obj['plugin']
+    git_data = plugin.get_git_object(obj['plugin_obj'])
+    if git_data and plugin.is_templated():
+        git_data = smwflow.render.render(git_data, objtype_vars)
+    if git_data:
+        obj['git_digest'] = smwflow.plan.content_digest(git_data)
     return git_data
 
+def _read_git_obj(obj):
+    """Read an untemplated git object (ansible and files trees) verbatim.
+
+    Returns None, and marks the object as binary, if the file cannot be
+    decoded as utf-8.  Only the digest of the content is kept, in
+    'git_digest'.
+    """
+    git_data = None
+    try:
+        with codecs.open(obj['fullpath'], mode='r', encoding='utf-8') as rfp:
+            git_data = rfp.read()
+    except UnicodeDecodeError:
+        # compared and copied by file digest instead (see _binary_differences())
+        obj['binary'] = True
+        return None
+    obj['git_digest'] = smwflow.plan.content_digest(git_data)
+    return git_data
+
+def _binary_differences(obj):
+    """Compare a binary git object with its SMW counterpart by file digest."""
+    try:
+        if smwflow.plan.file_digest(obj['fullpath']) == \
+                smwflow.plan.file_digest(obj['smwpath']):
+            return []
+    except (IOError, OSError):
+        pass
+    return ['binary content of %s differs' % obj['name']]
+
 def _read_smw_obj(obj):
+    """Read the SMW counterpart of obj, keeping only its digest in 'smw_digest'."""
     smw_data = None
-    if 'smw_data' in obj:
-        return obj['smw_data']
+    if 'smw_plugin' in obj:
+        smw_data = obj['smw_plugin'].get_smw_object(obj['smw_plugin_obj'])
+        if smw_data:
+            obj['smw_digest'] = smwflow.plan.content_digest(smw_data)
+            return smw_data
 
     if 'smwpath' not in obj or not obj['smwpath']:
         print 'unknown smw path for %s' % obj['name']
         return None
-    if not os.path.exists(obj['smwpath']):
+    if not smwflow.smwfile.STAT_CACHE.exists(obj['smwpath']):
         print 'file does not exist for %s at %s' % (obj['name'], obj['smwpath'])
         return None
 
     try:
-        with codecs.open(obj['smwpath'], mode='r', encoding='utf-8') as rfp:
-            smw_data = rfp.read()
-    except IOError:
-        pass
+        smw_data = smwflow.smwfile.read_smw_file(obj['smwpath'])
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    obj['smw_digest'] = smwflow.plan.content_digest(smw_data)
     return smw_data
 
+def _link_smw_obj(obj, smw_obj):
+    """Attach the SMW location (and any plugin providing SMW data) to a git object."""
+    if 'smwpath' in smw_obj:
+        obj['smwpath'] = smw_obj['smwpath']
+    if 'smw_plugin' in smw_obj:
+        obj['smw_plugin'] = smw_obj['smw_plugin']
+        obj['smw_plugin_obj'] = smw_obj['smw_plugin_obj']
+
+def _compare_objs(config, obj, git_data, smw_data):
+    """Compare git and SMW content, skipping the parse if the digests match."""
+    if obj.get('git_digest') is not None and obj.get('git_digest') == obj.get('smw_digest'):
+        return []
+    return smwflow.digests.differences(config, obj, git_data, smw_data)
+
+def _equal_objs(config, obj, git_data, smw_data):
+    """As _compare_objs(), but only decide equality, stopping at the first difference."""
+    if obj.get('git_digest') is not None and obj.get('git_digest') == obj.get('smw_digest'):
+        return True
+    return smwflow.digests.equal(config, obj, git_data, smw_data)
+
+def _digests_match(obj):
+    """True if the SMW file of obj holds the git content digested earlier this run.
+
+    Lets later phases (e.g., verification after an update) confirm unchanged
+    objects without rendering or reading them again.
+    """
+    if 'git_digest' not in obj or 'smw_plugin' in obj or not obj.get('smwpath'):
+        return False
+    try:
+        obj['smw_digest'] = smwflow.plan.file_digest(obj['smwpath'])
+    except (IOError, OSError):
+        return False
+    return obj['smw_digest'] == obj['git_digest']
+
+def _attributes_ok(config, obj):
+    """True if obj['smwpath'] exists with the ownership and mode of obj."""
+    return smwflow.smwfile.STAT_CACHE.exists(obj['smwpath']) and \
+        smwflow.smwfile.verifyattributes(config, obj)
+
+def _same_text(obj, git_data, statobj):
+    """Compare text git_data with the SMW file of obj, checking the size first.
+
+    The SMW file is compared by digest, without decoding it.
+    """
+    if len(git_data.encode('utf-8')) != statobj.st_size:
+        return False
+    return _digests_match(obj)
+
+def _snapshot_tree(root):
+    """Snapshot a directory tree with a single lstat() per entry.
+
+    Returns: tuple (files, dirs)
+        dictionaries mapping paths relative to root to their lstat results;
+        symlinks, including those to directories, are listed as files.
+    """
+    files = {}
+    dirs = {}
+    start_idx = len(root) + 1
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in dirnames + filenames:
+            fullpath = os.path.join(dirpath, name)
+            try:
+                statobj = os.lstat(fullpath)
+            except OSError:
+                continue
+            smwflow.smwfile.STAT_CACHE.prime(fullpath, statobj)
+            if stat.S_ISDIR(statobj.st_mode):
+                dirs[fullpath[start_idx:]] = statobj
+            else:
+                files[fullpath[start_idx:]] = statobj
+    return files, dirs
+
+def _select_objs(objs, keys):
+    """Restrict an object dictionary to keys, or return it whole if keys is None."""
+    if keys is None:
+        return objs
+    return {x: objs[x] for x in keys if x in objs}
+
 def _basic_verify(git_objs, smw_objs):
     ret = {'differences': 0}
     smw_keys = set(smw_objs.keys())
@@ -103,8 +228,8 @@ def _filter_smw_worksheet(path):
         True if the path should be considered a worksheet
         False if not.
     """
-    stdata = os.stat(path)
-    if stat.S_ISREG(stdata.st_mode) and path.endswith('_worksheet.yaml'):
+    stdata = smwflow.smwfile.STAT_CACHE.stat(path)
+    if stdata and stat.S_ISREG(stdata.st_mode) and path.endswith('_worksheet.yaml'):
         return True
     return False
 
@@ -123,8 +248,8 @@ def _filter_smw_config(path):
         True if path should be considered a managed config object
         False if not.
     """
-    stdata = os.stat(path)
-    if not stat.S_ISREG(stdata.st_mode):
+    stdata = smwflow.smwfile.STAT_CACHE.stat(path)
+    if not stdata or not stat.S_ISREG(stdata.st_mode):
         return False
     _, fname = os.path.split(path)
     if fname == 'cray_image_groups.yaml':
@@ -136,8 +261,8 @@ def _filter_smw_config(path):
     return True
 
 def _filter_smw_dist_preload(path):
-    stdata = os.stat(path)
-    if not stat.S_ISREG(stdata.st_mode):
+    stdata = smwflow.smwfile.STAT_CACHE.stat(path)
+    if not stdata or not stat.S_ISREG(stdata.st_mode):
         return False
     _, fname = os.path.split(path)
     if fname.find('preload') >= 0 and fname.find('cray') < 0:
@@ -172,14 +297,156 @@ def __simple_worksheet_config(data):
         parentobj[subkeys[-1]] = data[key]
     return ret
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _parse_worksheet(fullpath, worksheet_vars):
+    """Render a worksheet template and unflatten it with __simple_worksheet_config."""
+    worksheet = smwflow.render.render_file(fullpath, worksheet_vars)
+    data = yaml.load(worksheet)
+    if not data:
+        return None
+    return __simple_worksheet_config(data)
+
+class WorksheetCache(object):
+    """Cache of rendered and unflattened worksheets, per system and cfgset type.
+
+    Each worksheet is rendered and parsed once and then served to every
+    consumer (ConfigSet.parse_network, Nodegroups, plugins).  An entry is
+    reused only while the mtimes of its template and of every vars file
+    layered into it are unchanged.  The returned dictionaries are shared and
+    must not be modified by callers.
+    """
+    def __init__(self):
+        self.vars = {}
+        self.worksheets = {}
+
+    def clear(self):
+        self.vars.clear()
+        self.worksheets.clear()
+
+    def _vars_signature(self, config, cfgset_type, system):
+        signature = []
+        for maintype, objtype, subtype in [('vars', 'vars', None),
+                                           ('imps', 'vars', None),
+                                           ('imps', 'worksheet_vars', cfgset_type)]:
+            paths = smwflow.search.gen_paths(config, maintype, objtype, subtype, system=system)
+            for path in paths:
+                for fname in ['%s.yaml' % system, '%s_secrets.yaml' % system]:
+                    fpath = os.path.join(path, fname)
+                    signature.append((fpath, _mtime(fpath)))
+        return tuple(signature)
+
+    def _get_vars(self, config, cfgset_type, system):
+        key = (system, cfgset_type)
+        signature = self._vars_signature(config, cfgset_type, system)
+        if key in self.vars and self.vars[key][0] == signature:
+            return signature, self.vars[key][1]
+
+        global_vars = smwflow.variables.read_vars(config, 'vars', 'vars', system=system)
+        imps_vars = smwflow.variables.read_vars(config, 'imps', 'vars', None,
+                                                global_vars, system=system)
+        worksheet_vars = smwflow.variables.read_vars(config, 'imps', 'worksheet_vars',
+                                                     cfgset_type, imps_vars, system=system)
+        self.vars[key] = (signature, worksheet_vars)
+        return signature, worksheet_vars
+
+    def get(self, config, cfgset_type, name, system=None):
+        """Get the parsed worksheet name for the system.
+
+        Args:
+          config (ArgConfig): smwflow configuration
+          cfgset_type (string): config set type, 'cle' or 'global'
+          name (string): worksheet filename, e.g., 'cray_net_worksheet.yaml'
+          system (string): target system, defaults to config.system
+
+        Returns:
+          the unflattened worksheet dictionary, or None if the worksheet does
+          not exist or is empty
+        """
+        if not system:
+            system = config.system
+
+        # later paths take precedence, as in smwflow.search.get_objects
+        fullpath = None
+        for path in smwflow.search.gen_paths(config, 'imps', 'worksheets', cfgset_type,
+                                             system=system):
+            candidate = os.path.join(os.path.realpath(path), name)
+            if os.path.exists(candidate):
+                fullpath = candidate
+        if not fullpath:
+            return None
+
+        vars_signature, worksheet_vars = self._get_vars(config, cfgset_type, system)
+        signature = (vars_signature, fullpath, _mtime(fullpath))
+        key = (system, cfgset_type, name)
+        if key not in self.worksheets or self.worksheets[key][0] != signature:
+            self.worksheets[key] = (signature, _parse_worksheet(fullpath, worksheet_vars))
+        return self.worksheets[key][1]
+
+WORKSHEET_CACHE = WorksheetCache()
+
+class ObjectGraph(object):
+    """Per-run store of the objects making up a config set.
+
+    Each object type (worksheets, config, dist, ansible, files) is discovered,
+    has its variables resolved and its SMW counterparts identified exactly once
+    per run.  Content is never kept: it is streamed through each phase and
+    only its digests are recorded in the objects ('git_digest' and
+    'smw_digest'), so memory stays bounded by the objects in flight, and
+    later phases (e.g., post-update validation) can confirm unchanged objects
+    by digest instead of rendering them again.
+    """
+    def __init__(self):
+        self.git_objs = {}
+        self.local_vars = {}
+        self.smw_objs = {}
+        self.managed_smw_objs = {}
+        self.plugin_smw_objs = {}
+        self.touched = {}
+
+    def touch(self, obj_type, key=None):
+        """Record that an object was written or re-attributed during this run.
+
+        A key of None marks the whole object type as touched, e.g., because
+        cfgset regenerated it.
+        """
+        if key is None:
+            self.touched[obj_type] = None
+        elif obj_type not in self.touched:
+            self.touched[obj_type] = set([key])
+        elif self.touched[obj_type] is not None:
+            self.touched[obj_type].add(key)
+
+    def invalidate_smw(self, obj_type, keys=None):
+        """Forget the SMW side of obj_type, e.g., after cfgset regenerated it.
+
+        The SMW objects of obj_type are always rediscovered; only the digests
+        read for keys (or for every object if keys is None) are dropped.
+        """
+        if obj_type in self.smw_objs:
+            del self.smw_objs[obj_type]
+        if obj_type in self.managed_smw_objs:
+            del self.managed_smw_objs[obj_type]
+        git_objs = self.git_objs.get(obj_type, {})
+        if keys is None:
+            keys = git_objs.keys()
+        for key in keys:
+            if key in git_objs and 'smw_digest' in git_objs[key]:
+                del git_objs[key]['smw_digest']
+
 class ConfigSet(object):
-    def __init__(self, config, ctype, cname, parent_vars):
+    def __init__(self, config, ctype, cname, parent_vars, plan=None):
         self.config = config
         self.cfgset_type = ctype
         self.cfgset_name = cname
         self.parent_vars = parent_vars
         self.routermap = {}
-        self.todo = []
+        self.plan = plan if plan is not None else smwflow.plan.Plan()
+        self.graph = ObjectGraph()
         routermap = rsm.hss.RouterMap(self.config.partition)
         for node in routermap:
             self.routermap[node.cname] = node
@@ -203,24 +470,49 @@ class ConfigSet(object):
     def smwimport(self):
         pass
 
-    def verify(self):
-        diff = {}
-        diff['worksheets'] = self._verify_template_objs('worksheets',
-                                                        _filter_smw_worksheet,
-                                                        MANAGED_CFGSET_WORKSHEET)
-        diff['config'] = self._verify_template_objs('config', _filter_smw_config,
-                                                    MANAGED_CFGSET_CONFIG)
-        diff['dist'] = self._verify_template_objs('dist', _filter_smw_dist_preload, None)
-        diff['ansible'] = self._verify_filetree('ansible', None)
-        diff['files'] = self._verify_filetree('files', None)
+    def verify(self, touched=None):
+        """Verify the config set against the git repos.
+
+        Args:
+          self (ConfigSet): reference to current class instance
+          touched (dict)  : optional mapping of object type to the set of object
+                            names to verify (None verifies the whole type);
+                            object types not present are skipped.  Used to
+                            limit post-update verification to what the update
+                            actually changed.
+
+        Returns:
+          dict of per-object-type differences, with the total count of
+          differences in 'differences'
+        """
+        checks = [
+            ('worksheets', self._verify_template_objs,
+             (_filter_smw_worksheet, MANAGED_CFGSET_WORKSHEET)),
+            ('config', self._verify_template_objs, (_filter_smw_config, MANAGED_CFGSET_CONFIG)),
+            ('dist', self._verify_template_objs, (_filter_smw_dist_preload, None)),
+            ('ansible', self._verify_filetree, (None,)),
+            ('files', self._verify_filetree, (None,)),
+        ]
+
+        diff = {'differences': 0}
+        for obj_type, verify_fxn, args in checks:
+            keys = None
+            if touched is not None:
+                if obj_type not in touched:
+                    continue
+                keys = touched[obj_type]
+            diff[obj_type] = verify_fxn(obj_type, *args, keys=keys)
+            diff['differences'] += diff[obj_type]['differences']
 
         return diff
 
     def update(self):
+        """Plan the update of the config set; see smwflow.plan.apply()."""
         self._modify_cfgset(True)
         self._validate_cfgset()
 
     def create(self):
+        """Create the config set and plan its setup; see smwflow.plan.apply()."""
         self._init_smw_cfgset()
         self._modify_cfgset(False)
         self._validate_cfgset()
@@ -242,20 +534,8 @@ class ConfigSet(object):
           with all multipart (this.that.the.other: True) broken up into a multi
           level dictionary (ret['this']['that']['the']['other'] = True)
         """
-        if not system:
-            system = self.config.system
-
-        objs = smwflow.search.get_objects(self.config, 'imps', 'worksheets',
-                                          self.cfgset_type, system=system)
-        global_vars = smwflow.variables.read_vars(self.config, 'vars', 'vars', system=system)
-        imps_vars = smwflow.variables.read_vars(self.config, 'imps', 'vars', None,
-                                                global_vars, system=system)
-        worksheet_vars = smwflow.variables.read_vars(self.config, 'imps', 'worksheet_vars',
-                                                     self.cfgset_type, imps_vars, system=system)
-
-        net_worksheet = _render_obj(objs['cray_net_worksheet.yaml'], worksheet_vars)
-        data = yaml.load(net_worksheet)
-        return __simple_worksheet_config(data)
+        return WORKSHEET_CACHE.get(self.config, self.cfgset_type, 'cray_net_worksheet.yaml',
+                                   system)
 
     def _get_smw_objects(self, obj_type, filter_fxn, extra):
         smw_files = {}
@@ -329,83 +609,170 @@ class ConfigSet(object):
                 }
         return cfgset_objs
 
-    def _get_plugin_objs(self, obj_type, git_objs, smw_objs, local_vars):
+    def _get_plugin_objs(self, obj_type, git_objs, smw_objs):
+        """Discover plugin-provided objects.
+
+        Only a reference to the plugin and its object is kept; the content
+        is fetched again when it is streamed (see _plugin_git_data() and
+        _read_smw_obj()).
+        """
         count = 0
         if obj_type not in self.plugins:
             return 0
 
         for plugin in self.plugins[obj_type]:
             pobjs = plugin.get_objects()
+            if not pobjs:
+                continue
             for objname in pobjs:
                 obj = pobjs[objname]
 
-                git_data = plugin.get_git_object(obj)
-                if git_data:
-                    if plugin.is_templated():
-                        template = Template(git_data)
-                        git_data = template.render(local_vars)
+                if plugin.get_git_object(obj):
                     if objname not in git_objs:
                         git_objs[objname] = {"name": objname}
-                    git_objs[objname]['git_data'] = git_data
+                    git_objs[objname]['plugin'] = plugin
+                    git_objs[objname]['plugin_obj'] = obj
 
-                smw_data = plugin.get_smw_object(obj)
+                has_smw_data = bool(plugin.get_smw_object(obj))
                 smw_path = plugin.get_smw_path(obj)
 
-                if smw_data or smw_path:
+                if has_smw_data or smw_path:
                     smw_objs[objname] = {"name": objname}
-                if smw_data:
-                    smw_objs[objname]['smw_data'] = smw_data
+                if has_smw_data:
+                    smw_objs[objname]['smw_plugin'] = plugin
+                    smw_objs[objname]['smw_plugin_obj'] = obj
                 if smw_path:
-                    smw_objs[objname]['smw_path'] = smw_path
+                    smw_objs[objname]['smwpath'] = smw_path
                 count += 1
         return count
 
-    def _get_template_objs(self, obj_type, extra):
-        git_objs = smwflow.search.get_objects(self.config, 'imps', obj_type, self.cfgset_type)
-        local_vars = smwflow.variables.read_vars(self.config, 'imps',
-                                                 '%s_vars' % obj_type, self.cfgset_type,
-                                                 self.parent_vars)
+    def _get_vars(self, obj_type):
+        """Resolve the variables for obj_type once per run."""
+        if obj_type not in self.graph.local_vars:
+            self.graph.local_vars[obj_type] = \
+                smwflow.variables.read_vars(self.config, 'imps', '%s_vars' % obj_type,
+                                            self.cfgset_type, self.parent_vars)
+        return self.graph.local_vars[obj_type]
+
+    def _get_git_objs(self, obj_type, extra):
+        """Discover the git objects (including plugin objects) for obj_type.
 
-        self._get_plugin_objs(obj_type, git_objs, None, local_vars)
+        Discovery happens once per run; subsequent calls return the same
+        object dictionaries, along with the digests recorded in them.
+        """
+        if obj_type in self.graph.git_objs:
+            return self.graph.git_objs[obj_type]
+
+        git_objs = smwflow.search.get_objects(self.config, 'imps', obj_type, self.cfgset_type)
+        plugin_smw_objs = {}
+        self._get_plugin_objs(obj_type, git_objs, plugin_smw_objs)
         for filename in git_objs:
             obj = git_objs[filename]
             obj['name'] = filename
-            if 'git_data' not in obj:
-                obj['git_data'] = _render_obj(obj, local_vars)
             if extra and filename in extra:
                 for key in extra[filename]:
                     if key not in obj:
                         obj[key] = extra[filename][key]
 
+        self.graph.git_objs[obj_type] = git_objs
+        self.graph.plugin_smw_objs[obj_type] = plugin_smw_objs
         return git_objs
 
-    def _verify_template_objs(self, obj_type, filter_fxn, extra):
+    def _get_smw_objs(self, obj_type, filter_fxn, extra, filetree=False):
+        """Identify the SMW objects for obj_type once per run.
 
-        smw_objs, managed_smw_objs = self._get_smw_objects(obj_type, filter_fxn, extra)
-        git_objs = smwflow.search.get_objects(self.config, 'imps', obj_type, self.cfgset_type)
-        local_vars = smwflow.variables.read_vars(self.config, 'imps',
-                                                 '%s_vars' % obj_type, self.cfgset_type,
-                                                 self.parent_vars)
+        Must be called after _get_git_objs() so that plugin-provided SMW
+        objects are merged in.
+        """
+        if obj_type not in self.graph.smw_objs:
+            if filetree:
+                smw_objs = self._get_smw_obj_filetree(obj_type, filter_fxn)
+                managed_smw_objs = {}
+            else:
+                smw_objs, managed_smw_objs = self._get_smw_objects(obj_type, filter_fxn, extra)
+            for key, value in self.graph.plugin_smw_objs.get(obj_type, {}).items():
+                smw_objs[key] = value
+            self.graph.smw_objs[obj_type] = smw_objs
+            self.graph.managed_smw_objs[obj_type] = managed_smw_objs
+        return self.graph.smw_objs[obj_type], self.graph.managed_smw_objs[obj_type]
+
+    def _get_git_data(self, obj_type, obj):
+        """Produce the content of an untemplated git object, or None if binary."""
+        if 'plugin' in obj:
+            return _plugin_git_data(obj, self._get_vars(obj_type))
+        return _read_git_obj(obj)
+
+    def _stream_template_objs(self, obj_type, extra, keys=None):
+        """Render the git objects of a templated object type as a stream.
+
+        Args:
+          self (ConfigSet): reference to current class instance
+          obj_type (string): templated object type
+          extra (dict): managed extras of obj_type
+          keys (iterable): object names to render, None for all of them
+
+        Yields: tuple
+          (key, obj, rendered content), plugin-provided objects first, then
+          the template files in name order.  Templates are rendered in
+          parallel by smwflow.render.render_stream(), which only reads a
+          bounded window of them ahead of the consumer; each object keeps
+          just the digest of its rendered content.
+        """
+        git_objs = _select_objs(self._get_git_objs(obj_type, extra), keys)
+        local_vars = self._get_vars(obj_type)
+        files = []
+        for key in sorted(git_objs.keys()):
+            obj = git_objs[key]
+            if 'plugin' in obj:
+                yield key, obj, _plugin_git_data(obj, local_vars)
+            elif 'fullpath' in obj:
+                files.append(key)
+        if not files:
+            return
+
+        def _jobs():
+            for key in files:
+                with codecs.open(git_objs[key]['fullpath'], mode='r', encoding='utf-8') as rfp:
+                    source = rfp.read()
+                yield key, source, obj_type
+
+        processes = smwflow.render.get_render_processes(self.config) or \
+            multiprocessing.cpu_count()
+        rendered = smwflow.render.render_stream(_jobs(), {obj_type: local_vars},
+                                                min(processes, len(files)))
+        for key, git_data in rendered:
+            obj = git_objs[key]
+            obj['git_digest'] = smwflow.plan.content_digest(git_data)
+            yield key, obj, git_data
+
+    def _verify_template_objs(self, obj_type, filter_fxn, extra, keys=None):
+        git_objs = _select_objs(self._get_git_objs(obj_type, extra), keys)
+        smw_objs, managed_smw_objs = self._get_smw_objs(obj_type, filter_fxn, extra)
+        smw_objs = _select_objs(smw_objs, keys)
+        managed_smw_objs = _select_objs(managed_smw_objs, keys)
 
-        self._get_plugin_objs(obj_type, git_objs, local_vars)
         ret, common_keys = _basic_verify(git_objs, smw_objs)
 
+        render_keys = []
         for key in common_keys:
             obj = git_objs[key]
-            obj['name'] = key
-            obj['smwpath'] = smw_objs[key]['smwpath']
+            _link_smw_obj(obj, smw_objs[key])
+            if not _digests_match(obj):
+                render_keys.append(key)
 
-            git_data = _render_obj(obj, local_vars)
+        for key, obj, git_data in self._stream_template_objs(obj_type, extra, render_keys):
             smw_data = _read_smw_obj(obj)
 
             if git_data and smw_data:
-                tmp = smwflow.compare.basic_compare(self.config, obj, git_data, smw_data)
+                tmp = _compare_objs(self.config, obj, git_data, smw_data)
                 if tmp:
                     ret['value_diff'][key] = tmp
                     ret['differences'] += len(tmp)
             else:
                 print "WARNING skipping verification of %s" % key
 
+        for key in sorted(common_keys):
+            obj = git_objs[key]
             if not smwflow.smwfile.verifyattributes(self.config, obj):
                 ret['permissions'].append(obj['smwpath'])
                 ret['differences'] += 1
@@ -420,35 +787,32 @@ class ConfigSet(object):
 
         return ret
 
-    def _verify_filetree(self, obj_type, filter_fxn):
-        smw_objs = self._get_smw_obj_filetree(obj_type, filter_fxn)
-        git_objs = smwflow.search.get_objects(self.config, 'imps', obj_type, self.cfgset_type)
+    def _verify_filetree(self, obj_type, filter_fxn, keys=None):
+        git_objs = _select_objs(self._get_git_objs(obj_type, None), keys)
+        smw_objs, _ = self._get_smw_objs(obj_type, filter_fxn, None, filetree=True)
+        smw_objs = _select_objs(smw_objs, keys)
 
-        self._get_plugin_objs(obj_type, git_objs, None)
         ret, common_keys = _basic_verify(git_objs, smw_objs)
 
-        for key in common_keys:
+        for key in sorted(common_keys):
             obj = git_objs[key]
-            obj['smwpath'] = smw_objs[key]['smwpath']
-            obj['name'] = key
-            smw_value = None
-            git_value = None
-
-            try:
-                with codecs.open(git_objs[key]['fullpath'], mode='r', encoding='utf-8') as rfp:
-                    git_value = rfp.read()
-            except UnicodeDecodeError:
-                ## TODO, handle this error properly (i.e., switch md5sum or whatever)
-                continue
-
-            try:
-                with codecs.open(git_objs[key]['smwpath'], mode='r', encoding='utf-8') as rfp:
-                    smw_value = rfp.read()
-            except IOError:
-                print "WARNING: skipping %s" % key
-                continue
-            print git_objs[key]['fullpath'], git_objs[key]['smwpath']
-            tmp = smwflow.compare.basic_compare(self.config, obj, git_value, smw_value)
+            _link_smw_obj(obj, smw_objs[key])
+
+            tmp = None
+            if obj.get('binary'):
+                tmp = _binary_differences(obj)
+            elif not _digests_match(obj):
+                git_value = self._get_git_data(obj_type, obj)
+                if git_value is None and obj.get('binary'):
+                    tmp = _binary_differences(obj)
+                elif git_value is None:
+                    continue
+                else:
+                    smw_value = _read_smw_obj(obj)
+                    if smw_value is None:
+                        print "WARNING: skipping %s" % key
+                        continue
+                    tmp = _compare_objs(self.config, obj, git_value, smw_value)
             if tmp:
                 ret['value_diff'][key] = tmp
                 ret['differences'] += len(tmp)
@@ -459,16 +823,12 @@ class ConfigSet(object):
         return ret
 
     def _modify_cfgset(self, do_verify):
-        self.todo = []
         self._setup_worksheets(do_verify=do_verify)
         self._setup_config(do_verify=do_verify)
         self._setup_dist(do_verify=do_verify)
         self._setup_files(do_verify=do_verify)
         self._setup_ansible(do_verify=do_verify)
         self._setup_metadata()
-        while self.todo:
-            fxn = self.todo.pop()
-            fxn()
 
     def _init_smw_cfgset(self):
         cfgset_path = os.path.join(self.config.configset_path, self.cfgset_name)
@@ -491,85 +851,105 @@ class ConfigSet(object):
             sys.exit(1)
 
     def _setup_worksheets(self, do_verify=False):
-        if do_verify:
-            diffs = self._verify_template_objs('worksheets', _filter_smw_worksheet,
-                                               MANAGED_CFGSET_WORKSHEET)
-            if diffs['differences'] == 0:
-                return 0
-
-        worksheets = self._get_template_objs('worksheets', MANAGED_CFGSET_WORKSHEET)
-        worksheets_tmp = tempfile.mkdtemp()
-        for key in worksheets:
-            wpath = os.path.join(worksheets_tmp, key)
-            with open(wpath, 'w') as wfp:
-                wfp.write(worksheets[key]['git_data'])
-
-        print "Updating cfgset with worksheets"
-        command = [
-            "cfgset",
-            "update",
-            "--mode=prepare",
-            "--no-scripts",
-            "-w",
-            '%s/*yaml' % worksheets_tmp,
-            self.cfgset_name
-        ]
-        retc = subprocess.call(command)
-        self.todo.append(self._update_cfgset)
+        """Plan the submission of worksheets to the config set via 'cfgset update'.
 
+        With do_verify, only the worksheets whose rendered content is missing
+        from or differs with the config set are submitted, and no cfgset call
+        is planned if there are none; attributes are corrected either way.
+        """
+        smw_objs, _ = self._get_smw_objs('worksheets', _filter_smw_worksheet,
+                                         MANAGED_CFGSET_WORKSHEET)
         cfgset_wks_root = os.path.join(self.config.configset_path, self.cfgset_name, 'worksheets')
+        worksheets = self._get_git_objs('worksheets', MANAGED_CFGSET_WORKSHEET)
+        submit = set()
+        for key, obj, git_data in self._stream_template_objs('worksheets',
+                                                             MANAGED_CFGSET_WORKSHEET):
+            if not git_data:
+                continue
+            if do_verify and key in smw_objs:
+                _link_smw_obj(obj, smw_objs[key])
+                smw_data = _read_smw_obj(obj)
+                # an empty or unreadable worksheet is submitted to repair it
+                if smw_data and _equal_objs(self.config, obj, git_data, smw_data):
+                    continue
+            self.plan.cfgset_worksheet(self.cfgset_name, key, git_data)
+            submit.add(key)
+
+        if submit:
+            self._update_cfgset()
+        else:
+            print "No worksheet content changes, skipping cfgset update"
+
         for key in worksheets:
             obj = worksheets[key]
             obj['smwpath'] = os.path.join(cfgset_wks_root, key)
-            smwflow.smwfile.setattributes(self.config, obj)
+            if key in submit or not _attributes_ok(self.config, obj):
+                self.plan.cfgset_attributes(self.cfgset_name, obj['smwpath'], obj)
         for key in MANAGED_CFGSET_WORKSHEET:
-            obj = {'smwpath': os.path.join(cfgset_wks_root, key)}
-            smwflow.smwfile.setattributes(self.config, obj)
+            obj = dict(MANAGED_CFGSET_WORKSHEET[key], name=key,
+                       smwpath=os.path.join(cfgset_wks_root, key))
+            if not _attributes_ok(self.config, obj):
+                self.plan.cfgset_attributes(self.cfgset_name, obj['smwpath'], obj)
+        return 0
 
-        return retc
+    def _plan_write(self, obj_type, key, obj, data, semantic=False):
+        """Plan writing data and attributes to obj['smwpath'] where they differ.
 
-    def _setup_simple_obj(self, obj_type, do_verify=False, filter_fxn=None, extra=None):
-        if do_verify:
-            diffs = self._verify_template_objs(obj_type, filter_fxn, extra)
-            if diffs['differences'] == 0:
-                return 0
+        Content is compared by digest; with semantic, content that differs
+        only in ways smwflow.compare ignores (e.g., key order) is left alone.
+        """
+        exists = smwflow.smwfile.STAT_CACHE.exists(obj['smwpath'])
+        write = not exists or \
+            smwflow.plan.file_digest(obj['smwpath']) != smwflow.plan.content_digest(data)
+        if write and exists and semantic:
+            smw_data = _read_smw_obj(obj)
+            write = not smw_data or not _equal_objs(self.config, obj, data, smw_data)
+        if write:
+            self.plan.write(obj['smwpath'], data)
+        if write or not _attributes_ok(self.config, obj):
+            self.plan.attributes(obj['smwpath'], obj)
+            self.graph.touch(obj_type, key)
+
+    def _setup_simple_obj(self, obj_type, do_verify=False, extra=None):
+        """Plan the config set files of a templated object type in one streaming pass."""
         cfgset_obj_root = os.path.join(self.config.configset_path, self.cfgset_name, obj_type)
-        objs = self._get_template_objs(obj_type, extra)
-        for key in objs:
-            wpath = os.path.join(cfgset_obj_root, key)
-            objs[key]['smwpath'] = wpath
-            with open(wpath, 'w') as wfp:
-                wfp.write(objs[key]['git_data'])
-            smwflow.smwfile.setattributes(self.config, objs[key])
+        for key, obj, git_data in self._stream_template_objs(obj_type, extra):
+            if not git_data:
+                continue
+            obj['smwpath'] = os.path.join(cfgset_obj_root, key)
+            self._plan_write(obj_type, key, obj, git_data, semantic=do_verify)
         return 0
 
     def _setup_config(self, do_verify=False):
-        return self._setup_simple_obj('config', do_verify, _filter_smw_config,
-                                      MANAGED_CFGSET_CONFIG)
+        return self._setup_simple_obj('config', do_verify, MANAGED_CFGSET_CONFIG)
 
     def _setup_dist(self, do_verify=False):
-        return self._setup_simple_obj('dist', do_verify, _filter_smw_dist_preload, None)
+        return self._setup_simple_obj('dist', do_verify, None)
 
     def _setup_filetree_obj(self, obj_type, do_verify=False, filter_fxn=None, extra=None):
-        git_objs = smwflow.search.get_objects(self.config, 'imps', obj_type, self.cfgset_type)
-        local_vars = smwflow.variables.read_vars(self.config, 'imps',
-                                                 '%s_vars' % obj_type, self.cfgset_type,
-                                                 self.parent_vars)
-
-        self._get_plugin_objs(obj_type, git_objs, local_vars)
+        """Plan a delta sync of an ansible or files tree into the config set.
 
+        The git objects are compared with a snapshot of the config set tree:
+        only missing or differing files are written, ownership and modes are
+        corrected in bulk where the snapshot shows them wrong, and files and
+        directories absent from git (and not provided by a plugin) are removed.
+        """
+        git_objs = self._get_git_objs(obj_type, extra)
         ftree_root = os.path.join(self.config.configset_path, self.cfgset_name, obj_type)
+        smw_files, smw_dirs = _snapshot_tree(ftree_root)
+        keep = set(self.graph.plugin_smw_objs.get(obj_type, {}).keys())
+        counts = dict.fromkeys(['created', 'updated', 'deleted', 'attributes', 'unchanged'], 0)
+        bulk = {}
+
+        def _fix_attributes(path, obj):
+            attrs = tuple(sorted(smwflow.plan.get_attributes(obj).items()))
+            bulk.setdefault(attrs, []).append(path)
 
         dirs = set()
         # pass 1, setup obj and build directory map
         for filename in git_objs:
             obj = git_objs[filename]
-            obj['name'] = filename
             obj['smwpath'] = os.path.join(ftree_root, filename)
-            if extra and filename in extra:
-                for key in extra[filename]:
-                    if key not in obj:
-                        obj[key] = extra[filename][key]
             if 'isdirectory' not in obj:
                 obj['isdirectory'] = False
 
@@ -581,32 +961,75 @@ class ConfigSet(object):
                 currpath = '/'.join(components[:idx])
                 dirs.add(currpath)
 
-        # generate sorted list of directories so we can create them in sequence
-        # set umask so os.mkdir() sets the modes correctly
-        sv_umask = os.umask(0)
-        dirs = sorted(list(dirs))
-        for dirname in dirs:
+        # directories are created in sorted order so parents come first
+        for dirname in sorted(list(dirs)):
             smwpath = os.path.join(ftree_root, dirname)
-            mode = 0755
-            if dirname in git_objs and 'mode' in git_objs[dirname]:
-                mode = git_objs[dirname]['mode']
-            try:
-                os.mkdir(smwpath, mode)
-            except OSError:
-                pass
-        os.umask(sv_umask)
-
-        for filename in git_objs:
+            obj = git_objs.get(dirname, {})
+            if dirname not in smw_dirs:
+                self.plan.mkdir(smwpath, obj.get('mode', 0755))
+                counts['created'] += 1
+                if 'owner' in obj or 'group' in obj:
+                    _fix_attributes(smwpath, obj)
+            elif not smwflow.smwfile.attributes_match(self.config, obj, smw_dirs[dirname]):
+                _fix_attributes(smwpath, obj)
+                counts['attributes'] += 1
+
+        for filename in sorted(git_objs.keys()):
+            obj = git_objs[filename]
             if obj['isdirectory']:
                 continue
-            if 'data' not in obj:
-                obj['data'] = _render_obj(obj, local_vars)
-            wpath = obj['smwpath']
-            with open(wpath, 'w') as wfp:
-                wfp.write(obj['data'])
-            mode = obj['mode'] if 'mode' in obj else 0644
-            os.chmod(wpath, mode)
-            smwflow.smwfile.setattributes(self.config, obj)
+            if 'mode' not in obj:
+                obj['mode'] = 0644
+            statobj = smw_files.get(filename)
+            git_data = None
+            if not obj.get('binary'):
+                git_data = self._get_git_data(obj_type, obj)
+            if git_data is not None:
+                changed = statobj is None or not _same_text(obj, git_data, statobj)
+                if changed:
+                    self.plan.write(obj['smwpath'], git_data)
+            elif 'fullpath' in obj:
+                changed = statobj is None or \
+                    statobj.st_size != os.path.getsize(obj['fullpath']) or \
+                    smwflow.plan.file_digest(obj['smwpath']) != \
+                    smwflow.plan.file_digest(obj['fullpath'])
+                if changed:
+                    self.plan.copy(obj['smwpath'], obj['fullpath'])
+            else:
+                continue
+
+            if changed:
+                counts['updated' if statobj else 'created'] += 1
+                _fix_attributes(obj['smwpath'], obj)
+            elif not smwflow.smwfile.attributes_match(self.config, obj, statobj):
+                counts['attributes'] += 1
+                _fix_attributes(obj['smwpath'], obj)
+            else:
+                counts['unchanged'] += 1
+                continue
+            self.graph.touch(obj_type, filename)
+
+        for relpath in sorted(smw_files.keys()):
+            if relpath in git_objs or relpath in keep:
+                continue
+            self.plan.delete(os.path.join(ftree_root, relpath))
+            counts['deleted'] += 1
+            self.graph.touch(obj_type, relpath)
+        # deepest directories first so they are empty when removed
+        for relpath in sorted(smw_dirs.keys(), reverse=True):
+            if relpath in dirs or relpath in git_objs or relpath in keep or \
+                    any(x.startswith(relpath + '/') for x in keep):
+                continue
+            self.plan.rmdir(os.path.join(ftree_root, relpath))
+            counts['deleted'] += 1
+
+        for attrs, paths in sorted(bulk.items()):
+            self.plan.attributes_bulk(paths, dict(attrs))
+
+        print "cfgset %s %s: %d created, %d updated, %d deleted, %d attributes, " \
+              "%d unchanged" % (self.cfgset_name, obj_type, counts['created'],
+                                counts['updated'], counts['deleted'], counts['attributes'],
+                                counts['unchanged'])
 
     def _setup_files(self, do_verify=False):
         return self._setup_filetree_obj('files', do_verify, None, None)
@@ -618,48 +1041,45 @@ class ConfigSet(object):
         metadata = {
             "timestamp": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
         }
-        metadata["smwconf"] = {
-            "HEAD": smwflow.process.get_git_head_rev(self.config.smwconf),
-            "branch": smwflow.process.get_git_branch(self.config.smwconf),
-            "path": self.config.smwconf
-        }
-        metadata["secured"] = {
-            "HEAD": smwflow.process.get_git_head_rev(self.config.secured),
-            "branch": smwflow.process.get_git_branch(self.config.secured),
-            "path": self.config.secured
-        }
+        for repo in ['smwconf', 'secured']:
+            repo_path = smwflow.gitrev.get_origin(self.config, repo)
+            commit = smwflow.gitrev.get_commit(self.config, repo)
+            metadata[repo] = {
+                "HEAD": commit or smwflow.process.get_git_head_rev(repo_path),
+                "branch": self.config.git_rev if commit else \
+                          smwflow.process.get_git_branch(repo_path),
+                "path": repo_path
+            }
         metadata['construct_cfgset_config'] = self.config
         metadata['build_host'] = socket.gethostname()
 
-        config_path = os.path.join(self.config.configset_root, self.cfgset_name, 'config')
+        config_path = os.path.join(self.config.configset_path, self.cfgset_name, 'config')
         metadata_path = os.path.join(config_path, 'smwflow_metadata.yaml')
-        with open(metadata_path, 'w') as wfp:
-            wfp.write(yaml.dump(metadata))
-            wfp.close()
+        self.plan.write(metadata_path, yaml.dump(metadata))
 
     def _update_cfgset(self):
-        print "Update config set %s" % self.cfgset_name
-        command = [
-            "cfgset",
-            "update",
-            "--mode=prepare",
-        ]
-        if self.config.noscripts:
-            command.append("--no-scripts")
-        command.append(self.cfgset_name)
-        retc = subprocess.call(command)
-        return retc
+        """Plan a 'cfgset update' of the config set."""
+        self.plan.cfgset_update(self.cfgset_name)
+        # cfgset update regenerates the config set from its worksheets
+        self.graph.touch('worksheets')
+        self.graph.touch('config')
 
     def _validate_cfgset(self):
-        print "Validate config set %s" % self.cfgset_name
-        command = [
-            "cfgset",
-            "validate",
-            self.cfgset_name
-        ]
-        retc = subprocess.call(command)
-        diffs = self.verify()
-        return retc + diffs['differences']
+        """Plan a 'cfgset validate' of the config set and a verify once applied."""
+        self.plan.cfgset_validate(self.cfgset_name)
+        self.plan.after_apply(self._verify_modified)
+
+    def _verify_modified(self):
+        for obj_type in self.graph.touched:
+            self.graph.invalidate_smw(obj_type)
+        if getattr(self.config, 'full_verify', False):
+            diffs = self.verify()
+        else:
+            diffs = self.verify(self.graph.touched)
+        if diffs['differences'] > 0:
+            self.display_diffs(diffs)
+            return ["Resolve differences in cfgset %s" % self.cfgset_name]
+        return []
 
     def display_diffs(self, diffs):
         print diffs
@@ -682,6 +1102,10 @@ class Plugin(object):
     def get_smw_path(self, obj):
         return None
 
+    def read_smw_file(self, path):
+        """Read an SMW file through the read cache shared with smwflow (for get_smw_object)."""
+        return smwflow.smwfile.read_smw_file(path)
+
     def get_git_object(self, obj):
         return None
 
@@ -696,35 +1120,81 @@ class Nodegroups(object):
         self.config = config
         self.nodegroups = None
         self.network = None
+        self.hosts_by_key = {}
+        self.hostkeys_by_id = {}
+        self.members = {}
+        self.unresolved = {}
+        self.groups_by_host = {}
         self.data = self._parse_nodegroups(system)
-
+        self._index_hosts()
+        self._index_nodegroups()
 
     def _parse_nodegroups(self, system=None):
-        if not system:
-            system = self.config.system
-
-        objs = smwflow.search.get_objects(self.config, 'imps', 'worksheets', 'cle', system=system)
-        global_vars = smwflow.variables.read_vars(self.config, 'vars', 'vars', system=system)
-        imps_vars = smwflow.variables.read_vars(self.config, 'imps', 'vars',
-                                                None, global_vars, system=system)
-        worksheet_vars = smwflow.variables.read_vars(self.config, 'imps',
-                                                     'worksheet_vars', 'cle',
-                                                     imps_vars, system=system)
-
-        worksheet = _render_obj(objs['cray_node_groups_worksheet.yaml'], worksheet_vars)
-        data = yaml.load(worksheet)
-        data = __simple_worksheet_config(data)
+        data = WORKSHEET_CACHE.get(self.config, 'cle', 'cray_node_groups_worksheet.yaml', system)
         if not data:
             raise ValueError('Failed to find or parse cray_node_groups_worksheet')
         self.nodegroups = data
 
-        worksheet = _render_obj(objs['cray_net_worksheet.yaml'], worksheet_vars)
-        data = yaml.load(worksheet)
-        data = __simple_worksheet_config(data)
+        data = WORKSHEET_CACHE.get(self.config, 'cle', 'cray_net_worksheet.yaml', system)
         if not data:
             raise ValueError('Failed to find or parse cray_net_worksheet')
         self.network = data
 
+    def _index_hosts(self):
+        """Build the hostkey->host and hostid->hostkey indexes from cray_net.
+
+        Only hosts with a hostname are indexed, as only those can be resolved
+        to a logical node name.
+        """
+        try:
+            hosts = self.network['cray_net']['settings']['hosts']['data']
+        except (KeyError, TypeError):
+            hosts = {}
+
+        for hostkey in hosts:
+            host = hosts[hostkey]
+            if 'hostname' not in host:
+                continue
+            self.hosts_by_key[hostkey] = host
+            if 'hostid' in host:
+                self.hostkeys_by_id[host['hostid']] = hostkey
+
+    def _resolve_hostkey(self, member):
+        """Resolve a raw nodegroup member to a cray_net hostkey, or None."""
+        if member in self.hostkeys_by_id:
+            return self.hostkeys_by_id[member]
+        if member in self.hosts_by_key:
+            return member
+        return None
+
+    def _index_nodegroups(self):
+        """Resolve the membership of every nodegroup once.
+
+        Membership is stored as a frozenset of cray_net hostkeys per nodegroup,
+        with the reverse mapping of hostkey to the set of nodegroups containing
+        it.
+        """
+        try:
+            groups = self.nodegroups['cray_node_groups']['settings']['groups']['data']
+        except (KeyError, TypeError):
+            groups = {}
+
+        for nodegroup in groups:
+            members = set()
+            unresolved = set()
+            for member in self.get_rawnames_in_nodegroup(nodegroup):
+                hostkey = self._resolve_hostkey(member)
+                if hostkey is None:
+                    unresolved.add(member)
+                    continue
+                members.add(hostkey)
+                if hostkey not in self.groups_by_host:
+                    self.groups_by_host[hostkey] = set()
+                self.groups_by_host[hostkey].add(nodegroup)
+            self.members[nodegroup] = frozenset(members)
+            if unresolved:
+                self.unresolved[nodegroup] = frozenset(unresolved)
+
     def get_rawnames_in_nodegroup(self, nodegroup):
         members = []
         try:
@@ -752,57 +1222,92 @@ class Nodegroups(object):
             Raises:
                 ValueError when any members of a nodegroup could not be resolved.
         """
-        hostmap = {}
-        members = self.get_rawnames_in_nodegroup(nodegroup)
-        if not members:
-            return []
+        if nodegroup in self.unresolved:
+            raise ValueError('Following %s members could not be identified in cray_net: %s'
+                             % (nodegroup, ', '.join(sorted(self.unresolved[nodegroup]))))
 
-        for hostkey in self.network['cray_net']['settings']['hosts']['data']:
-            host = self.network['cray_net']['settings']['hosts']['data'][hostkey]
-            if 'hostname' not in host:
-                continue
+        return [self.hosts_by_key[x] for x in self.get_hostkeys_in_nodegroup(nodegroup)]
 
-            for member in members:
-                if 'hostid' in host and host['hostid'] == member:
-                    hostmap[member] = host
-                if hostkey == member:
-                    hostmap[member] = host
-        memset = set(members)
-        hostset = set(hostmap.keys())
-        missing = memset - hostset
-        if missing:
-            raise ValueError('Following %s members could not be identified in cray_net: %s'
-                             % (nodegroup, ', '.join(missing)))
+    def get_hostkeys_in_nodegroup(self, nodegroup):
+        """Get the resolved cray_net hostkeys of the members of a nodegroup.
 
-        return hostmap.values()
+            Unresolvable members are silently omitted.  The returned frozenset
+            may be combined directly with the results for other nodegroups
+            (union, intersection, difference).
 
-def verify_data(config):
-    imps_vars = smwflow.variables.read_vars(config, 'imps', 'vars', None, config.global_vars)
+            Args:
+                self (Nodegroup): reference to current Nodegroups instance
+                nodegroup (string): name of nodegroup of interest
+
+            Returns:
+                frozenset of cray_net hostkeys, empty if the nodegroup is unknown
+        """
+        return self.members.get(nodegroup, frozenset())
 
-    if config.verify_both_cfgset:
-        global_cfgset = ConfigSet(config, 'global', 'global', imps_vars)
-        cle_cfgset = ConfigSet(config, 'cle', config.cle_configset, imps_vars)
-        global_diffs = global_cfgset.verify()
-        cle_diffs = cle_cfgset.verify()
+    def get_host(self, hostkey):
+        """Get the cray_net host entry for a hostkey or hostid, or None."""
+        hostkey = self._resolve_hostkey(hostkey)
+        if hostkey is None:
+            return None
+        return self.hosts_by_key[hostkey]
 
-        if global_diffs['differences'] > 0:
-            global_cfgset.display_diffs(global_diffs)
-        if cle_diffs['differences'] > 0:
-            cle_cfgset.display_diffs(cle_diffs)
-        return []
-    configset = ConfigSet(config, config.cfgset_type, config.cfgset_name, imps_vars)
-    diffs = configset.verify()
-    configset.display_diffs(diffs)
-    return []
+    def get_nodegroups_for_host(self, host):
+        """Identify every nodegroup containing a host.
+
+            Args:
+                self (Nodegroup): reference to current Nodegroups instance
+                host (string): cray_net hostkey or hostid of the host
+
+            Returns:
+                set of nodegroup names, empty if the host is in no nodegroup
+        """
+        hostkey = self._resolve_hostkey(host)
+        if hostkey is None:
+            return set()
+        return set(self.groups_by_host.get(hostkey, ()))
+
+def verify_data(config, selection=None):
+    """Verify the config sets selected by config.
+
+    Args:
+      config (ArgConfig): smwflow configuration
+      selection (dict)  : optional mapping of config set type ('cle' or
+                          'global') to the touched dictionary passed to
+                          ConfigSet.verify() (None verifies the whole config
+                          set); config set types not present are skipped.
+    """
+    deferred_actions = []
+    imps_vars = smwflow.variables.read_vars(config, 'imps', 'vars', None, config.global_vars)
+
+    for ctype, cname in _get_cfgsets(config, config.verify_both_cfgset):
+        touched = None
+        if selection is not None:
+            if ctype not in selection:
+                continue
+            touched = selection[ctype]
+        configset = ConfigSet(config, ctype, cname, imps_vars)
+        diffs = configset.verify(touched)
+        if diffs['differences'] > 0:
+            configset.display_diffs(diffs)
+            deferred_actions.append("Resolve differences in cfgset %s" % cname)
+    return deferred_actions
+
+def _get_cfgsets(config, both):
+    if both:
+        return [('global', 'global'), ('cle', config.cle_configset)]
+    return [(config.cfgset_type, config.cfgset_name)]
 
 def create(config):
     imps_vars = smwflow.variables.read_vars(config, 'imps', 'vars', None, config.global_vars)
-    configset = ConfigSet(config, config.cfgset_type, config.cfgset_name, imps_vars)
+    plan = smwflow.plan.Plan()
+    configset = ConfigSet(config, config.cfgset_type, config.cfgset_name, imps_vars, plan)
     configset.create()
-    return []
+    return smwflow.plan.apply(config, plan)
 
-def update_data(config):
+def update_data(config, plan):
+    """Add the updates of the selected config sets to plan."""
     imps_vars = smwflow.variables.read_vars(config, 'imps', 'vars', None, config.global_vars)
-    configset = ConfigSet(config, config.cfgset_type, config.cfgset_name, imps_vars)
-    configset.update()
+    for ctype, cname in _get_cfgsets(config, getattr(config, 'update_both_cfgset', False)):
+        configset = ConfigSet(config, ctype, cname, imps_vars, plan)
+        configset.update()
     return []
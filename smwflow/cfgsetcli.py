@@ -0,0 +1,149 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.cfgsetcli
+
+Run-level queue of Cray 'cfgset' CLI operations.  Operations requested while
+modifying a config set are coalesced per config set: any number of update
+requests and worksheet submissions become one 'cfgset update', followed by
+at most one 'cfgset validate'.  Independent config sets are then processed
+concurrently, and each CLI call is timed.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import codecs
+import subprocess
+from multiprocessing.pool import ThreadPool
+import smwflow.smwfile
+
+class CfgsetQueue(object):
+    """Pending cfgset operations, keyed by config set name."""
+    def __init__(self, config):
+        self.config = config
+        self.pending = {}
+        self.order = []
+        self.timings = []
+
+    def _get(self, cname):
+        if cname not in self.pending:
+            self.pending[cname] = {
+                'update': False,
+                'worksheets': None,
+                'validate': False,
+                'callbacks': [],
+            }
+            self.order.append(cname)
+        return self.pending[cname]
+
+    def call(self, command):
+        """Run a cfgset command now, recording its duration."""
+        start = time.time()
+        retc = subprocess.call(command)
+        self.timings.append((' '.join(command), time.time() - start, retc))
+        return retc
+
+    def add_worksheet(self, cname, key, data):
+        """Stage a worksheet for submission by the next update of cname."""
+        pending = self._get(cname)
+        if pending['worksheets'] is None:
+            pending['worksheets'] = tempfile.mkdtemp()
+        with codecs.open(os.path.join(pending['worksheets'], key), mode='w',
+                         encoding='utf-8') as wfp:
+            wfp.write(data)
+        pending['update'] = True
+
+    def update(self, cname):
+        self._get(cname)['update'] = True
+
+    def validate(self, cname):
+        self._get(cname)['validate'] = True
+
+    def after(self, cname, fxn):
+        """Call fxn once the pending operations on cname have been run."""
+        callbacks = self._get(cname)['callbacks']
+        if fxn not in callbacks:
+            callbacks.append(fxn)
+
+    def _commands(self, cname, pending):
+        commands = []
+        if pending['update']:
+            command = ['cfgset', 'update', '--mode=prepare']
+            if self.config.noscripts:
+                command.append('--no-scripts')
+            if pending['worksheets'] is not None:
+                command.extend(['-w', '%s/*yaml' % pending['worksheets']])
+            command.append(cname)
+            commands.append(command)
+        if pending['validate']:
+            commands.append(['cfgset', 'validate', cname])
+        return commands
+
+    def _run(self, item):
+        cname, pending = item
+        retc = 0
+        try:
+            for command in self._commands(cname, pending):
+                print "Running %s" % ' '.join(command)
+                retc += self.call(command)
+        finally:
+            if pending['worksheets'] is not None:
+                shutil.rmtree(pending['worksheets'], ignore_errors=True)
+            # cfgset may rewrite anything in the config set
+            smwflow.smwfile.STAT_CACHE.invalidate_tree(
+                os.path.join(self.config.configset_path, cname))
+        return retc
+
+    def flush(self):
+        """Run all pending operations, then their callbacks.
+
+        Config sets are processed concurrently; callbacks run afterwards in
+        the order they were queued.
+
+        Returns: int
+            sum of the cfgset exit codes
+        """
+        items = [(cname, self.pending[cname]) for cname in self.order]
+        self.pending = {}
+        self.order = []
+        if not items:
+            return 0
+
+        if len(items) > 1:
+            pool = ThreadPool(len(items))
+            try:
+                results = pool.map(self._run, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._run(items[0])]
+
+        for _, pending in items:
+            for fxn in pending['callbacks']:
+                fxn()
+        return sum(results)
+
+    def report(self):
+        for command, duration, retc in self.timings:
+            print "%6.1fs  %s%s" % (duration, command,
+                                    '' if retc == 0 else ' (exit %d)' % retc)
+        total = sum(x[1] for x in self.timings)
+        if self.timings:
+            print "%6.1fs  total in %d cfgset calls" % (total, len(self.timings))
@@ -15,10 +15,12 @@
 # See the LICENSE file in the top-level of the smwflow source distribution.
 
 import difflib
+import hashlib
 import json
 import ConfigParser
 import io
 import yaml
+import smwflow.smwfile
 
 def guess_type(config, obj):
     if 'formattype' in obj:
@@ -35,8 +37,96 @@ def guess_type(config, obj):
         return 'ini'
     return 'raw'
 
+# prefix of the ignore_keys entries that are paths rather than key names
+IGNORE_PATH_PREFIX = 'path:'
 
-def __diff_basic_tree(git_data, smw_data, typestr, keyskiplist):
+class IgnoreSpec(object):
+    """Compiled form of the 'ignore_keys' of an object.
+
+    An entry ignores the value of the key of that name at any depth; names
+    may contain dots, as the keys of worksheets do.  An entry prefixed with
+    'path:' ignores one value by its dotted keys from the top of the tree,
+    with '*' matching any key (or any member of a list) at its level, e.g.
+    'path:cray_net.settings.hosts.data.*.ip'.  Paths are compiled into a
+    trie that is walked alongside the trees being compared; the comparison
+    carries the trie nodes matching the current position.  Ignored keys
+    still have to be present on both sides.
+    """
+    def __init__(self, ignore_keys):
+        self.anywhere = set()
+        self.root = {}
+        for entry in ignore_keys:
+            if not isinstance(entry, basestring) or not entry.startswith(IGNORE_PATH_PREFIX):
+                self.anywhere.add(entry)
+                continue
+            node = self.root
+            for part in entry[len(IGNORE_PATH_PREFIX):].split('.'):
+                node = node.setdefault(part, {})
+            node[None] = True
+
+    def roots(self):
+        return [self.root] if self.root else []
+
+    def active(self, nodes):
+        """True if anything below the position of nodes may be ignored."""
+        return bool(self.anywhere) or bool(nodes)
+
+    def descend(self, nodes, key):
+        """Follow key from nodes.
+
+        Returns: tuple (ignored, nodes)
+            ignored is True if the value of key is ignored, otherwise nodes
+            are the trie nodes matching its position
+        """
+        if key in self.anywhere:
+            return True, []
+        name = key if isinstance(key, basestring) else str(key)
+        children = []
+        for node in nodes:
+            for part in (name, '*'):
+                if part in node:
+                    if None in node[part]:
+                        return True, []
+                    children.append(node[part])
+        return False, children
+
+    def members(self, nodes):
+        """As descend(), for the members of a list, which only '*' matches."""
+        children = []
+        for node in nodes:
+            if '*' in node:
+                if None in node['*']:
+                    return True, []
+                children.append(node['*'])
+        return False, children
+
+__IGNORE_SPECS = {}
+
+def get_ignore_spec(obj_data):
+    """Get the compiled IgnoreSpec of obj_data, compiling each distinct spec once."""
+    ignore_keys = tuple(obj_data['ignore_keys'] if 'ignore_keys' in obj_data else [])
+    if ignore_keys not in __IGNORE_SPECS:
+        __IGNORE_SPECS[ignore_keys] = IgnoreSpec(ignore_keys)
+    return __IGNORE_SPECS[ignore_keys]
+
+def __prune_tree(data, spec, nodes):
+    """Copy of data with the ignored values blanked, for whole-value comparisons."""
+    if not spec.active(nodes):
+        return data
+    if isinstance(data, dict):
+        ret = {}
+        for key, value in data.items():
+            ignored, children = spec.descend(nodes, key)
+            ret[key] = None if ignored else __prune_tree(value, spec, children)
+        return ret
+    elif isinstance(data, list):
+        ignored, children = spec.members(nodes)
+        if ignored:
+            return None
+        return [__prune_tree(x, spec, children) for x in data]
+    return data
+
+def __diff_basic_tree(git_data, smw_data, typestr, spec, nodes):
     ret = []
     if type(git_data) is not type(smw_data):
         return ['git type (%s) != smw type (%s) for %s' % \
@@ -56,11 +146,19 @@ def __diff_basic_tree(git_data, smw_data, typestr, keyskiplist):
             ret.append("git %s:%s" % (typestr, item))
 
         for item in common:
-            if item in keyskiplist:
+            ignored, children = spec.descend(nodes, item)
+            if ignored:
                 continue
             ret.extend(__diff_basic_tree(git_data[item], smw_data[item],
-                                         "%s:%s" % (typestr, item), keyskiplist))
+                                         "%s:%s" % (typestr, item), spec, children))
     elif isinstance(git_data, list):
+        ignored, children = spec.members(nodes)
+        if ignored:
+            return ret
+        if spec.active(children):
+            # list members are matched whole, so drop their ignored values first
+            git_data = [__prune_tree(x, spec, children) for x in git_data]
+            smw_data = [__prune_tree(x, spec, children) for x in smw_data]
         missing_in_git = [x for x in git_data if x not in smw_data]
         missing_in_smw = [x for x in smw_data if x not in git_data]
         common = [x for x in smw_data if x in git_data]
@@ -74,7 +172,7 @@ def __diff_basic_tree(git_data, smw_data, typestr, keyskiplist):
             git_idx = git_data.index(item)
             smw_idx = smw_data.index(item)
             ret.extend(__diff_basic_tree(git_data[git_idx], smw_data[smw_idx],
-                                         "%s:%s" % (typestr, item), keyskiplist))
+                                         "%s:%s" % (typestr, item), spec, children))
     elif git_data != smw_data:
         ret.append("smw %s:%s" % (typestr, smw_data))
         ret.append("git %s:%s" % (typestr, git_data))
@@ -82,25 +180,25 @@ def __diff_basic_tree(git_data, smw_data, typestr, keyskiplist):
 
 def __diff_ansiblevault(config, obj_data, git_data, smw_data):
     try:
-        ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
+        spec = get_ignore_spec(obj_data)
         git_yaml = yaml.load(config.vaultobj.decrypt(git_data))
         smw_yaml = yaml.load(config.vaultobj.decrypt(smw_data))
-        return __diff_basic_tree(git_yaml, smw_yaml, obj_data['name'], ignore_keys)
+        return __diff_basic_tree(git_yaml, smw_yaml, obj_data['name'], spec, spec.roots())
     except:
         pass
     return []
 
 def __diff_yaml(_, obj_data, git_data, smw_data):
-    ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
-    git_yaml = yaml.load(git_data)
-    smw_yaml = yaml.load(smw_data)
-    return __diff_basic_tree(git_yaml, smw_yaml, obj_data['name'], ignore_keys)
+    spec = get_ignore_spec(obj_data)
+    git_yaml = __parse_tree('yaml', git_data)
+    smw_yaml = __parse_tree('yaml', smw_data)
+    return __diff_basic_tree(git_yaml, smw_yaml, obj_data['name'], spec, spec.roots())
 
 def __diff_json(_, obj_data, git_data, smw_data):
-    ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
-    git_json = json.loads(git_data)
-    smw_json = json.loads(smw_data)
-    return __diff_basic_tree(git_json, smw_json, obj_data['name'], ignore_keys)
+    spec = get_ignore_spec(obj_data)
+    git_json = __parse_tree('json', git_data)
+    smw_json = __parse_tree('json', smw_data)
+    return __diff_basic_tree(git_json, smw_json, obj_data['name'], spec, spec.roots())
 
 def __parse_ini(input_str):
     ret = {}
@@ -116,10 +214,10 @@ def __parse_ini(input_str):
     return ret
 
 def __diff_ini(_, obj_data, git_data, smw_data):
-    ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
-    git_ini = __parse_ini(git_data)
-    smw_ini = __parse_ini(smw_data)
-    return __diff_basic_tree(git_ini, smw_ini, obj_data['name'], ignore_keys)
+    spec = get_ignore_spec(obj_data)
+    git_ini = __parse_tree('ini', git_data)
+    smw_ini = __parse_tree('ini', smw_data)
+    return __diff_basic_tree(git_ini, smw_ini, obj_data['name'], spec, spec.roots())
 
 def __parse_keyvalue(input_str):
     ret = {}
@@ -158,16 +256,136 @@ def __parse_keyspacevalue(input_str):
     return ret
 
 def __diff_keyvalue(_, obj_data, git_data, smw_data):
-    ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
-    git_kv = __parse_keyvalue(git_data)
-    smw_kv = __parse_keyvalue(smw_data)
-    return __diff_basic_tree(git_kv, smw_kv, obj_data['name'], ignore_keys)
+    spec = get_ignore_spec(obj_data)
+    git_kv = __parse_tree('keyvalue', git_data)
+    smw_kv = __parse_tree('keyvalue', smw_data)
+    return __diff_basic_tree(git_kv, smw_kv, obj_data['name'], spec, spec.roots())
 
 def __diff_keyspacevalue(_, obj_data, git_data, smw_data):
-    ignore_keys = obj_data['ignore_keys'] if 'ignore_keys' in obj_data else []
-    git_kv = __parse_keyspacevalue(git_data)
-    smw_kv = __parse_keyspacevalue(smw_data)
-    return __diff_basic_tree(git_kv, smw_kv, obj_data['name'], ignore_keys)
+    spec = get_ignore_spec(obj_data)
+    git_kv = __parse_tree('keyspacevalue', git_data)
+    smw_kv = __parse_tree('keyspacevalue', smw_data)
+    return __diff_basic_tree(git_kv, smw_kv, obj_data['name'], spec, spec.roots())
+
+def __equal_basic_tree(git_data, smw_data, spec, nodes):
+    """Early-exit counterpart of __diff_basic_tree: True if it finds no differences."""
+    if type(git_data) is not type(smw_data):
+        return False
+
+    if isinstance(git_data, dict):
+        if len(git_data) != len(smw_data):
+            return False
+        for item in git_data:
+            if item not in smw_data:
+                return False
+            ignored, children = spec.descend(nodes, item)
+            if ignored:
+                continue
+            if not __equal_basic_tree(git_data[item], smw_data[item], spec, children):
+                return False
+        return True
+    elif isinstance(git_data, list):
+        ignored, children = spec.members(nodes)
+        if ignored:
+            return True
+        if spec.active(children):
+            git_data = [__prune_tree(x, spec, children) for x in git_data]
+            smw_data = [__prune_tree(x, spec, children) for x in smw_data]
+        for item in git_data:
+            if item not in smw_data:
+                return False
+        for item in smw_data:
+            if item not in git_data:
+                return False
+        return True
+    return git_data == smw_data
+
+__TREE_PARSERS = {
+    'yaml': yaml.load,
+    'json': json.loads,
+    'ini': __parse_ini,
+    'keyvalue': __parse_keyvalue,
+    'keyspacevalue': __parse_keyspacevalue,
+}
+
+def __parse_tree(filetype, data):
+    """Parse data, reusing the parse of SMW files read through smwflow.smwfile."""
+    return smwflow.smwfile.parse_smw_data(data, filetype, __TREE_PARSERS[filetype])
+
+def equal(config, obj_data, git_data, smw_data):
+    """True if basic_compare() would find no differences, stopping at the first.
+
+    For update decisions, which only need to know whether anything differs;
+    use basic_compare() when the differences are to be reported.
+    """
+    if git_data == smw_data:
+        return True
+    filetype = guess_type(config, obj_data)
+    if filetype == 'raw':
+        return git_data.split() == smw_data.split()
+
+    spec = get_ignore_spec(obj_data)
+    if filetype == 'ansiblevault':
+        try:
+            git_tree = yaml.load(config.vaultobj.decrypt(git_data))
+            smw_tree = yaml.load(config.vaultobj.decrypt(smw_data))
+        except:
+            # as __diff_ansiblevault, undecryptable content is not a difference
+            return True
+    elif filetype in __TREE_PARSERS:
+        git_tree = __parse_tree(filetype, git_data)
+        smw_tree = __parse_tree(filetype, smw_data)
+    else:
+        raise ValueError('Unknown filetype in smwflow.compare.equal: %s' % filetype)
+    return __equal_basic_tree(git_tree, smw_tree, spec, spec.roots())
+
+def __canonical_tree(data, spec, nodes):
+    """Reduce a parsed tree to the form __equal_basic_tree compares.
+
+    Ignored values are blanked (their keys still count), and lists become
+    sorted sets of their serialized members, which __equal_basic_tree
+    compares whole.
+    """
+    if isinstance(data, dict):
+        ret = {}
+        for key, value in data.items():
+            ignored, children = spec.descend(nodes, key)
+            ret[key] = None if ignored else __canonical_tree(value, spec, children)
+        return ret
+    elif isinstance(data, list):
+        ignored, children = spec.members(nodes)
+        if ignored:
+            return None
+        return sorted(set(json.dumps(__prune_tree(x, spec, children), sort_keys=True,
+                                     default=repr) for x in data))
+    return data
+
+def canonical_digest(config, obj_data, data):
+    """Digest of data that is equal for semantically equal content.
+
+    Whitespace, key order, quoting and the values of 'ignore_keys' do not
+    change the digest; two contents with equal canonical digests are
+    equal() to each other.
+
+    Returns: string
+        hex sha256 digest, or None if the format has no canonical form
+        (ansible vault) or data cannot be parsed
+    """
+    filetype = guess_type(config, obj_data)
+    if filetype == 'raw':
+        canonical = u' '.join(data.split())
+    elif filetype in __TREE_PARSERS:
+        spec = get_ignore_spec(obj_data)
+        try:
+            tree = __canonical_tree(__parse_tree(filetype, data), spec, spec.roots())
+            canonical = json.dumps(tree, sort_keys=True, default=repr)
+        except Exception:
+            return None
+    else:
+        return None
+    if isinstance(canonical, unicode):
+        canonical = canonical.encode('utf-8')
+    return hashlib.sha256('%s\n%s' % (filetype, canonical)).hexdigest()
 
 def basic_compare(config, obj_data, git_data, smw_data):
     filetype = guess_type(config, obj_data)
@@ -26,10 +26,30 @@ import argparse
 import ConfigParser
 import codecs
 import json
-import ansible.utils.vault as vault
 import smwflow
-import smwflow.search
-import smwflow.variables
+
+# modes a client may forward to a running 'smwflow serve' process
+FORWARDED_MODES = ['status', 'verify', 'update']
+
+# modes that render templates, and so need the vault and global variables;
+# the others start without importing ansible or reading any variables
+VARS_MODES = ['verify', 'update', 'create', 'watch', 'serve']
+
+# VaultLib objects keyed by password file, validated against the file's stats
+_VAULT_CACHE = {}
+
+def _get_vaultobj(password_file):
+    """Get a VaultLib for password_file, reusing it while the file is unchanged."""
+    import ansible.utils.vault as vault
+    stdata = os.stat(password_file)
+    signature = (stdata.st_ino, stdata.st_mtime, stdata.st_size)
+    if password_file in _VAULT_CACHE and _VAULT_CACHE[password_file][0] == signature:
+        return _VAULT_CACHE[password_file][1]
+    with open(password_file, 'r') as rfp:
+        password = rfp.read().strip()
+    vaultobj = vault.VaultLib(password)
+    _VAULT_CACHE[password_file] = (signature, vaultobj)
+    return vaultobj
 
 class BaseConfig(dict):
     """Class representing the smwflow configuration fileself.
@@ -54,8 +74,10 @@ class BaseConfig(dict):
             'system': system,
             'password_file': "",
             'configset_path': '/var/opt/cray/imps/config/sets',
+            'zypper_path': '/var/opt/cray/repos',
             'partition': 'p0',
             'platform_json': None,
+            'server_socket': '',
         }
 
         config_fname = '%s/smwflow.conf' % smwflow.CONFIG_PATH
@@ -67,8 +89,10 @@ class BaseConfig(dict):
         self['system'] = parser.get('smwflow', 'system')
         self['password_file'] = parser.get('smwflow', 'password_file')
         self['configset_path'] = parser.get('smwflow', 'configset_path')
+        self['zypper_path'] = parser.get('smwflow', 'zypper_path')
         self['partition'] = parser.get('smwflow', 'partition')
         self['platform_json'] = parser.get('smwflow', 'platform_json')
+        self['server_socket'] = parser.get('smwflow', 'server_socket')
 
 class ArgCheckoutBranchAction(argparse.Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
@@ -89,20 +113,29 @@ class ArgConfig(object):
     The resulting configuration is used by smwflow.process and all other smwflow
     modules to carry out any and all actions smwflow is capable of taking.
     """
-    def __init__(self, config, argv):
+    def __init__(self, config, argv, forward=True):
         super(ArgConfig, self).__init__()
         self.parser = self.__get_parser(config)
         self.values = self.parser.parse_args(argv)
+        self.forwarded = forward and bool(self.values.server) and \
+                         self.values.mode in FORWARDED_MODES
+        if self.forwarded or self.values.mode not in VARS_MODES:
+            # the server loads the vault and variables itself, and the other
+            # modes render nothing
+            return
+        import smwflow.variables as variables
+        if getattr(self.values, 'git_rev', None):
+            import smwflow.gitrev as gitrev
+            try:
+                gitrev.apply_rev(self.values, self.values.git_rev)
+            except ValueError as err:
+                self.parser.error(str(err))
         if not config['password_file']:
             config['password_file'] = os.path.join(config['secured'], 'ansible_vault/ansible.hash')
         if os.path.exists(config['password_file']):
-            with open(config['password_file'], 'r') as rfp:
-                password = rfp.read().strip()
-                vaultobj = vault.VaultLib(password)
-                setattr(self.values, 'vaultobj', vaultobj)
+            setattr(self.values, 'vaultobj', _get_vaultobj(config['password_file']))
         print self.values
-        variables = smwflow.variables.read_vars(self.values, 'vars', 'vars')
-        setattr(self.values, "global_vars", variables)
+        setattr(self.values, "global_vars", variables.read_vars(self.values, 'vars', 'vars'))
 
     def parse_platform(self):
         """Reads p0.platform.json and generates a dictionary mapping the platform
@@ -143,10 +176,18 @@ class ArgConfig(object):
                             help='system name')
         parser.add_argument('--configset_path', default=config['configset_path'],
                             help='root path to config sets')
+        parser.add_argument('--zypper_path', default=config['zypper_path'],
+                            help='root path to the zypper repos on the smw')
         parser.add_argument('--password_file', default=config['password_file'],
                             help='Ansible vault password file')
         parser.add_argument('--partition', default=config['partition'],
                             help='XC partition for configuration')
+        parser.add_argument('--render-jobs', default=None, type=int, dest='render_jobs',
+                            help='number of processes rendering templates (default: '
+                            'all cores)')
+        parser.add_argument('--server', default=config['server_socket'],
+                            help='forward status, verify and update to the smwflow '
+                            'server listening on this unix socket')
         self.subparsers = parser.add_subparsers(help='smwflow command')
 
         self._setup_status_parser()
@@ -155,6 +196,10 @@ class ArgConfig(object):
         self._setup_verify_parser()
         self._setup_create_parser()
         self._setup_import_parser()
+        self._setup_watch_parser()
+        self._setup_serve_parser()
+        self._setup_deps_parser()
+        self._setup_apply_parser()
         return parser
 
     def _setup_status_parser(self):
@@ -183,8 +228,19 @@ class ArgConfig(object):
         p_update.set_defaults(mode='update', update_hss=False, update_basesmw=False,
                               update_cfgset=False, update_both_cfgset=False,
                               update_imps=False, update_zypper=False)
-        p_update.add_argument('--dry-run', help='do not actually modify anything, just pretend',
-                              default=False, action='store_true')
+        p_update.add_argument('--dry-run', help='do not actually modify anything, just show '
+                              'the planned changes', default=False, action='store_true')
+        p_update.add_argument('--save-plan', help='save the planned changes to this file for '
+                              'a later "smwflow apply" instead of applying them', default=None,
+                              dest='save_plan')
+        p_update.add_argument('--jobs', help='number of file operations to apply concurrently',
+                              default=None, type=int, dest='apply_jobs')
+        p_update.add_argument('--full-verify', help='re-verify everything after the update, '
+                              'not just the objects it changed', default=False,
+                              action='store_true', dest='full_verify')
+        p_update.add_argument('--rev', help='update from this git revision of the smwconf and '
+                              'secured repos instead of their working trees', default=None,
+                              dest='git_rev')
         p_update_sp = p_update.add_subparsers(help='update smw configurations from smw')
 
         p_update_all = p_update_sp.add_parser('all', help='update all smw possible '
@@ -223,6 +279,24 @@ class ArgConfig(object):
                               verify_basesmw=False, verify_cfgset=False,
                               verify_both_cfgset=False, verify_zypper=False,
                               verify_all_zypper=False)
+        p_verify.add_argument('--systems', help='comma-separated list of systems to verify',
+                              default=None, dest='verify_systems',
+                              type=lambda x: [y for y in x.split(',') if y])
+        p_verify.add_argument('--all-systems', help='verify every system defined in the '
+                              'vars layers', default=False, action='store_true',
+                              dest='verify_all_systems')
+        p_verify.add_argument('--smw-root', help='verify against an SMW filesystem snapshot '
+                              'or mount at this path; %%(system)s is replaced by the system '
+                              'name', default=None, dest='smw_root')
+        p_verify.add_argument('--jobs', help='number of systems to verify concurrently',
+                              default=None, type=int, dest='jobs')
+        p_verify.add_argument('--since', help='only verify objects affected by changes since '
+                              'this git revision (default: the HEADs recorded at the last '
+                              'successful verify all)', nargs='?', const='', default=None,
+                              dest='verify_since')
+        p_verify.add_argument('--rev', help='verify from this git revision of the smwconf and '
+                              'secured repos instead of their working trees', default=None,
+                              dest='git_rev')
         p_verify_sp = p_verify.add_subparsers(help='verify smw configurations')
         p_verify_all = p_verify_sp.add_parser('all', help='verify all smw configurations')
         p_verify_all.set_defaults(verify_imps=True, verify_hss=True, verify_basesmw=True,
@@ -292,3 +366,47 @@ class ArgConfig(object):
                                      default='cle', dest='cfgset_type')
         p_import_cfgset.add_argument('cfgset_name', help='configset name')
         return p_import
+
+    def _setup_watch_parser(self):
+        p_watch = self.subparsers.add_parser('watch', help='watch smw configurations for '
+                                             'drift, reporting changes as json lines')
+        p_watch.set_defaults(mode='watch')
+        p_watch.add_argument('--cle_configset', default='p0', help='name of cle configset')
+        p_watch.add_argument('--no-hss', help='do not watch hss configurations',
+                             default=True, action='store_false', dest='watch_hss')
+        p_watch.add_argument('--no-imps', help='do not watch imps configurations',
+                             default=True, action='store_false', dest='watch_imps')
+        p_watch.add_argument('--no-cfgset', help='do not watch configsets',
+                             default=True, action='store_false', dest='watch_cfgset')
+        p_watch.add_argument('--settle', help='seconds to wait for changes to settle '
+                             'before re-verifying', default=1.0, type=float)
+        return p_watch
+
+    def _setup_serve_parser(self):
+        p_serve = self.subparsers.add_parser('serve', help='run a warm-cache smwflow server '
+                                             'on a unix socket')
+        p_serve.set_defaults(mode='serve')
+        p_serve.add_argument('--socket', help='path of the unix socket to listen on',
+                             default=None, dest='serve_socket')
+        return p_serve
+
+    def _setup_deps_parser(self):
+        p_deps = self.subparsers.add_parser('deps', help='list templates depending on '
+                                            'variables')
+        p_deps.set_defaults(mode='deps')
+        p_deps.add_argument('--rebuild', help='discard and rebuild the dependency index',
+                            default=False, action='store_true', dest='deps_rebuild')
+        p_deps.add_argument('deps_variables', nargs='+', metavar='variable',
+                            help='top-level variable name')
+        return p_deps
+
+    def _setup_apply_parser(self):
+        p_apply = self.subparsers.add_parser('apply', help='apply an update plan saved by '
+                                             '"smwflow update --save-plan"')
+        p_apply.set_defaults(mode='apply')
+        p_apply.add_argument('--dry-run', help='only show the planned changes',
+                             default=False, action='store_true')
+        p_apply.add_argument('--jobs', help='number of file operations to apply concurrently',
+                             default=None, type=int, dest='apply_jobs')
+        p_apply.add_argument('plan_file', help='path of the saved plan')
+        return p_apply
@@ -0,0 +1,323 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.delta
+
+Maps the paths changed in the smwconf and secured repos since a given
+revision to the smwflow objects they affect, following the same layering as
+smwflow.search.gen_paths.  A changed template selects just its object; a
+changed vars file selects the templates referencing the variables that
+changed in it (see smwflow.deps), and a changed plugin or manifest selects
+every object that may depend on it.  Changes are not narrowed for config
+sets with plugins, whose objects may depend on any vars or worksheet.  Also
+records the repo HEADs at the last successful verify, which is the default
+starting point for 'verify --since'.
+"""
+
+import os
+import subprocess
+import yaml
+import smwflow.cfgset
+import smwflow.deps
+import smwflow.gitrev
+import smwflow.search
+import smwflow.state
+
+STATE_FILENAME = 'smwflow_last_verify.yaml'
+CFGSET_TYPES = ['cle', 'global']
+
+# plugin directories loaded by smwflow.cfgset.ConfigSet
+PLUGIN_BASETYPES = ['ansible', 'files']
+
+def _git(path, args):
+    command = ['git', '-C', path] + args
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return stdout
+
+def get_last_verified(config, repo):
+    """Get the HEAD of repo recorded at the last successful verify of config.system."""
+    repo_path = smwflow.gitrev.get_origin(config, repo)
+    return smwflow.state.load_state(repo_path, STATE_FILENAME).get(config.system)
+
+def record_verified(config):
+    """Record the current smwconf and secured HEADs as verified for config.system.
+
+    With --rev the verified commits are recorded instead.
+    """
+    for repo in ['smwconf', 'secured']:
+        repo_path = smwflow.gitrev.get_origin(config, repo)
+        if not repo_path or not os.access(repo_path, os.W_OK):
+            continue
+        head = smwflow.gitrev.get_commit(config, repo) or _git(repo_path, ['rev-parse', 'HEAD'])
+        if not head:
+            continue
+        entry = {config.system: head.strip()}
+        smwflow.state.update_state(repo_path, STATE_FILENAME,
+                                   lambda state, entry=entry: state.update(entry))
+
+def get_changed_paths(repo_path, rev, commit=None):
+    """List the repo-relative paths changed between rev and the working tree,
+    or commit if given.
+
+    Untracked (but not ignored) files of the working tree are changes too,
+    and a renamed file is listed under both its old and new names.
+    Returns None if rev cannot be resolved in the repo.
+    """
+    stdout = _git(repo_path, ['diff', '--name-only', '--no-renames', '-z', rev] +
+                  ([commit] if commit else []) + ['--'])
+    if stdout is None:
+        return None
+    paths = [x for x in stdout.split('\0') if x]
+    if not commit:
+        untracked = _git(repo_path, ['ls-files', '--others', '--exclude-standard', '-z'])
+        paths.extend(x for x in (untracked or '').split('\0') if x)
+    return paths
+
+def _strip_layer(config, dirname):
+    """Strip the system prefix from a layer directory name.
+
+    Layers of other systems keep their prefix and so match no known layer.
+    """
+    prefix = '%s_' % config.system
+    if dirname.startswith(prefix):
+        return dirname[len(prefix):]
+    return dirname
+
+class Selection(object):
+    """The set of objects affected by a change.
+
+    hss and imps are sets of object names, or None for every object.
+    cfgset maps config set type to a ConfigSet.verify() touched dictionary
+    (object type to a set of object names, or None for the whole type), and
+    is itself None when every config set object is affected.
+    """
+    def __init__(self):
+        self.hss = set()
+        self.imps = set()
+        self.cfgset = {}
+        self.deps = None
+        self.plugins = {}
+
+    def select_all(self):
+        self.hss = None
+        self.imps = None
+        self.cfgset = None
+
+    def _add_cfgset(self, ctype, obj_type, name=None):
+        if self.cfgset is None:
+            return
+        touched = self.cfgset.setdefault(ctype, {})
+        if name is None:
+            touched[obj_type] = None
+        elif obj_type not in touched:
+            touched[obj_type] = set([name])
+        elif touched[obj_type] is not None:
+            touched[obj_type].add(name)
+
+    def _add_all_cfgset(self, ctypes=None):
+        for ctype in ctypes or CFGSET_TYPES:
+            for obj_type in smwflow.cfgset.CFGSET_OBJTYPES:
+                self._add_cfgset(ctype, obj_type)
+
+    def add_path(self, config, path, changed_keys=None):
+        """Add the objects affected by a repo-relative changed path.
+
+        changed_keys, if given for a vars file, lists the top-level variables
+        that changed in it; only templates referencing them are selected.
+        """
+        parts = path.split('/', 2)
+        if len(parts) < 3:
+            return
+        maintype, dirname, relpath = parts
+        layer = _strip_layer(config, dirname)
+        fname = os.path.basename(relpath)
+        is_manifest = fname == '.smwflow.manifest.yaml'
+        is_vars = fname in ('%s.yaml' % config.system, '%s_secrets.yaml' % config.system)
+
+        if maintype == 'vars' and layer == 'vars':
+            if is_vars:
+                targets = [('hss', 'hss', None), ('imps', 'imps', None)]
+                targets.extend(self._cfgset_targets(CFGSET_TYPES, smwflow.cfgset.CFGSET_OBJTYPES))
+                self._add_vars(config, targets, changed_keys)
+        elif maintype == 'hss':
+            if layer == 'hss':
+                self._add_name('hss', relpath, is_manifest)
+            elif layer == 'vars' and is_vars:
+                self._add_vars(config, [('hss', 'hss', None)], changed_keys)
+        elif maintype == 'imps':
+            self._add_imps_path(config, layer, relpath, is_manifest,
+                                changed_keys if is_vars else False)
+
+    def _add_name(self, attr, relpath, whole):
+        names = getattr(self, attr)
+        if names is None:
+            return
+        if whole:
+            setattr(self, attr, None)
+        else:
+            names.add(relpath)
+
+    @staticmethod
+    def _cfgset_targets(ctypes, obj_types):
+        return [('imps', obj_type, ctype) for ctype in ctypes for obj_type in obj_types]
+
+    def _has_plugins(self, config, ctype):
+        """Determine if config sets of ctype load any plugins.
+
+        A plugin may provide objects of any type, rendered with the same vars
+        and possibly derived from the worksheets, so their dependencies are
+        unknown.
+        """
+        if ctype not in self.plugins:
+            self.plugins[ctype] = any(
+                fname.endswith('.py')
+                for basetype in PLUGIN_BASETYPES
+                for path in smwflow.search.gen_paths(config, 'imps', '%s_plugins' % basetype,
+                                                     ctype)
+                for fname in os.listdir(path))
+        return self.plugins[ctype]
+
+    def _dependents(self, config, target, changed_keys):
+        """Names of the templates of target using changed_keys, None if unknown."""
+        if changed_keys is None or target not in smwflow.search.TEMPLATED_OBJTYPES:
+            return None
+        maintype, obj_type, ctype = target
+        if obj_type != maintype and self._has_plugins(config, ctype):
+            return None
+        if self.deps is None:
+            self.deps = smwflow.deps.get_index(config)
+        group = smwflow.deps.group_key(*target)
+        return self.deps.templates_using(changed_keys, [group])[group]
+
+    def _add_vars(self, config, targets, changed_keys):
+        """Add the objects of targets affected by a vars file change."""
+        for target in targets:
+            maintype, obj_type, ctype = target
+            names = self._dependents(config, target, changed_keys)
+            if obj_type == maintype:
+                if names is None:
+                    setattr(self, maintype, None)
+                for name in names or []:
+                    self._add_name(maintype, name, False)
+            else:
+                if names is None:
+                    self._add_cfgset(ctype, obj_type)
+                for name in names or []:
+                    self._add_cfgset(ctype, obj_type, name)
+
+    def _add_imps_path(self, config, layer, relpath, is_manifest, changed_keys):
+        """Add the objects affected by a changed path under imps.
+
+        changed_keys is False if the path is not a vars file.
+        """
+        is_vars = changed_keys is not False
+        if layer == 'imps':
+            self._add_name('imps', relpath, is_manifest)
+            return
+        if layer == 'vars':
+            if is_vars:
+                targets = [('imps', 'imps', None)]
+                targets.extend(self._cfgset_targets(CFGSET_TYPES, smwflow.cfgset.CFGSET_OBJTYPES))
+                self._add_vars(config, targets, changed_keys)
+            return
+
+        # config set layers are <subtype>_<objtype>[_vars|_plugins]
+        ctype, _, rest = layer.partition('_')
+        if ctype not in CFGSET_TYPES:
+            return
+        if rest == 'worksheet_vars':
+            if is_vars:
+                self._add_vars(config, self._cfgset_targets([ctype], ['worksheets']), changed_keys)
+                if self._has_plugins(config, ctype):
+                    self._add_all_cfgset([ctype])
+            return
+        if rest in ['%s_plugins' % x for x in PLUGIN_BASETYPES] or \
+                (rest == 'worksheets' and self._has_plugins(config, ctype)):
+            # plugins may provide objects of any type, derived from the worksheets
+            self._add_all_cfgset([ctype])
+            return
+        for obj_type in smwflow.cfgset.CFGSET_OBJTYPES:
+            if rest == obj_type:
+                self._add_cfgset(ctype, obj_type, None if is_manifest else relpath)
+            elif rest == '%s_vars' % obj_type:
+                if is_vars:
+                    self._add_vars(config, self._cfgset_targets([ctype], [obj_type]),
+                                   changed_keys)
+            elif rest == '%s_plugins' % obj_type:
+                self._add_cfgset(ctype, obj_type)
+
+def _load_yaml_dict(data):
+    try:
+        ret = yaml.safe_load(data) if data else {}
+    except yaml.YAMLError:
+        return None
+    if ret is None:
+        return {}
+    return ret if isinstance(ret, dict) else None
+
+def get_changed_keys(config, repo_path, rev, path, tree_path=None):
+    """List the top-level variables of a vars file that changed since rev.
+
+    The new content is read from tree_path, by default the working tree of
+    repo_path.  Returns None if the change cannot be narrowed, e.g. for encrypted
+    secrets files or content that is not a yaml mapping.
+    """
+    if os.path.basename(path) != '%s.yaml' % config.system:
+        return None
+    old = _load_yaml_dict(_git(repo_path, ['show', '%s:%s' % (rev, path)]))
+    fullpath = os.path.join(tree_path or repo_path, path)
+    new_data = None
+    if os.path.exists(fullpath):
+        with open(fullpath, 'r') as rfp:
+            new_data = rfp.read()
+    new = _load_yaml_dict(new_data)
+    if old is None or new is None:
+        return None
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+def get_selection(config, since):
+    """Compute the objects affected by changes to the repos since a revision.
+
+    Args:
+      config (ArgConfig): smwflow configuration
+      since (string): git revision, or None to use the HEADs recorded at the
+                      last successful verify of config.system
+
+    Returns: Selection
+      every object is selected if a starting revision cannot be resolved
+      for a repo.
+    """
+    selection = Selection()
+    for repo in ['smwconf', 'secured']:
+        repo_path = smwflow.gitrev.get_origin(config, repo)
+        if not repo_path or not os.access(repo_path, os.R_OK):
+            continue
+        commit = smwflow.gitrev.get_commit(config, repo)
+        rev = since if since else get_last_verified(config, repo)
+        paths = get_changed_paths(repo_path, rev, commit) if rev else None
+        if paths is None:
+            print "WARNING: cannot determine changes in %s since %s, verifying everything" % \
+                  (repo_path, rev if rev else 'last verify')
+            selection.select_all()
+            return selection
+        for path in paths:
+            selection.add_path(config, path, get_changed_keys(config, repo_path, rev, path,
+                                                              getattr(config, repo)))
+    return selection
@@ -0,0 +1,198 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.deps
+
+Template dependency tracking.  Each template's referenced variables (and the
+templates it includes or imports) are extracted from its jinja2 AST and
+persisted, per system, as an index in the smwconf git directory.  Entries
+are refreshed only when their template changes.  The index answers which
+templates depend on a set of variables, both for 'smwflow deps <var>' and
+for narrowing incremental verifies to templates whose inputs changed.
+"""
+
+import os
+import codecs
+from jinja2 import Environment, TemplateSyntaxError, meta
+import smwflow.gitrev
+import smwflow.search
+import smwflow.state
+
+STATE_FILENAME = 'smwflow_deps.yaml'
+
+def group_key(maintype, objtype, subtype=None):
+    return ':'.join([maintype, objtype, subtype if subtype else ''])
+
+def template_dependencies(source):
+    """Extract the variables and included templates referenced by a template.
+
+    Returns: tuple (variables, includes)
+        sorted lists of names; variables is None if the template cannot be
+        parsed, meaning it must be assumed to depend on everything.
+    """
+    env = Environment()
+    try:
+        ast = env.parse(source)
+    except TemplateSyntaxError:
+        return None, []
+    variables = sorted(meta.find_undeclared_variables(ast))
+    includes = sorted(x for x in meta.find_referenced_templates(ast) if x)
+    return variables, includes
+
+class DepsIndex(object):
+    """Persistent index of template -> variable dependencies for one system."""
+    def __init__(self, config, system=None):
+        self.config = config
+        self.system = system if system else config.system
+        self.templates = {}
+        self.repo_path = smwflow.gitrev.get_origin(config, 'smwconf')
+
+    def load(self):
+        state = smwflow.state.load_state(self.repo_path, STATE_FILENAME)
+        self.templates = state.get(self.system, {})
+
+    def save(self):
+        # the index is rebuilt as needed, so it is not saved for users who
+        # cannot write the git directory of smwconf
+        if not smwflow.state.is_writable(self.repo_path):
+            return False
+        entry = {self.system: self.templates}
+        try:
+            return smwflow.state.update_state(self.repo_path, STATE_FILENAME,
+                                              lambda state: state.update(entry))
+        except (IOError, OSError):
+            return False
+
+    def update(self):
+        """Bring the index up to date with the templates in the repos.
+
+        Only templates whose stat signature changed are re-parsed.
+
+        Returns: int
+            number of templates (re-)parsed
+        """
+        count = 0
+        templates = {}
+        for maintype, objtype, subtype in smwflow.search.TEMPLATED_OBJTYPES:
+            group = group_key(maintype, objtype, subtype)
+            old_entries = self.templates.get(group, {})
+            entries = {}
+            # later paths take precedence, as in smwflow.search.get_objects
+            for path in smwflow.search.gen_paths(self.config, maintype, objtype, subtype,
+                                                 system=self.system):
+                rpath = os.path.realpath(path)
+                start_idx = len(rpath) + 1
+                for (dirpath, _, filenames) in os.walk(rpath):
+                    for filename in filenames:
+                        if filename == '.smwflow.manifest.yaml':
+                            continue
+                        fullpath = os.path.join(dirpath, filename)
+                        name = fullpath[start_idx:]
+                        try:
+                            stdata = os.stat(fullpath)
+                        except OSError:
+                            # broken symlink, or removed during the walk
+                            continue
+                        old = old_entries.get(name)
+                        if old and old['path'] == fullpath and \
+                                old['mtime'] == stdata.st_mtime and old['size'] == stdata.st_size:
+                            entries[name] = old
+                            continue
+                        entries[name] = self._parse(fullpath, stdata)
+                        count += 1
+            templates[group] = entries
+        self.templates = templates
+        return count
+
+    def _parse(self, fullpath, stdata):
+        try:
+            with codecs.open(fullpath, mode='r', encoding='utf-8') as rfp:
+                variables, includes = template_dependencies(rfp.read())
+        except UnicodeDecodeError:
+            variables, includes = [], []
+        return {
+            'path': fullpath,
+            'mtime': stdata.st_mtime,
+            'size': stdata.st_size,
+            'variables': variables,
+            'includes': includes,
+        }
+
+    def _variables(self, group, name, seen=None):
+        """Variables of a template including those of its included templates.
+
+        Returns None if the template (or an included one) could not be parsed.
+        """
+        if seen is None:
+            seen = set()
+        if name in seen:
+            return set()
+        seen.add(name)
+        entry = self.templates.get(group, {}).get(name)
+        if entry is None:
+            return set()
+        if entry['variables'] is None:
+            return None
+        variables = set(entry['variables'])
+        for include in entry['includes']:
+            included = self._variables(group, include, seen)
+            if included is None:
+                return None
+            variables |= included
+        return variables
+
+    def templates_using(self, variables, groups=None):
+        """Identify the templates depending on any of variables.
+
+        Args:
+          self (DepsIndex): reference to current DepsIndex instance
+          variables (iterable): names of top-level variables
+          groups (list): group keys to consider, default all
+
+        Returns: dict
+            group key -> set of template names; templates that could not be
+            parsed are always included.
+        """
+        variables = set(variables)
+        ret = {}
+        for group in groups if groups is not None else self.templates.keys():
+            names = set()
+            for name in self.templates.get(group, {}):
+                used = self._variables(group, name)
+                if used is None or used & variables:
+                    names.add(name)
+            ret[group] = names
+        return ret
+
+def get_index(config, system=None, rebuild=False):
+    """Load, refresh and (if anything changed) persist the dependency index."""
+    index = DepsIndex(config, system)
+    if not rebuild:
+        index.load()
+    if index.update() > 0:
+        index.save()
+    return index
+
+def do_deps(config):
+    index = get_index(config, rebuild=config.deps_rebuild)
+    for variable in config.deps_variables:
+        print "%s:" % variable
+        using = index.templates_using([variable])
+        for group in sorted(using):
+            for name in sorted(using[group]):
+                print "    %s %s" % (group.rstrip(':'), name)
+    return []
@@ -0,0 +1,122 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.digests
+
+The verify index: canonical semantic digests (see
+smwflow.compare.canonical_digest()) keyed by the byte digest of the content
+they were computed from, its format and its ignore_keys.  It is persisted in
+the smwconf git directory, so on later runs a semantic equality check of
+unchanged content, even if reformatted on the SMW, is a hash comparison
+instead of a parse and tree diff.
+"""
+
+import smwflow.compare
+import smwflow.gitrev
+import smwflow.plan
+import smwflow.state
+
+# renamed whenever the meaning of ignore_keys or of the digests changes, so
+# that stale entries are not used
+STATE_FILENAME = 'smwflow_digests.v2.yaml'
+
+# entries not used in a run are dropped once the index grows past this
+MAX_ENTRIES = 50000
+
+_INDEX = None
+
+class DigestIndex(object):
+    """Byte digest -> canonical digest index for one smwconf repo."""
+    def __init__(self, config):
+        self.config = config
+        self.repo_path = smwflow.gitrev.get_origin(config, 'smwconf')
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+
+    def load(self):
+        if self.repo_path:
+            self.entries = smwflow.state.load_state(self.repo_path, STATE_FILENAME)
+
+    def save(self):
+        # the index is only a cache, it is not saved for users who cannot
+        # write the git directory of smwconf
+        if not self.dirty or not self.repo_path or \
+                not smwflow.state.is_writable(self.repo_path):
+            return False
+        def merge(state):
+            state.update(self.entries)
+            if len(state) > MAX_ENTRIES:
+                kept = {x: state[x] for x in self.used if x in state}
+                state.clear()
+                state.update(kept)
+        self.dirty = False
+        try:
+            return smwflow.state.update_state(self.repo_path, STATE_FILENAME, merge)
+        except (IOError, OSError):
+            return False
+
+    def _key(self, obj, data):
+        ignore_keys = obj['ignore_keys'] if 'ignore_keys' in obj else []
+        return '%s:%s:%s' % (smwflow.compare.guess_type(self.config, obj),
+                             repr(sorted(ignore_keys)),
+                             smwflow.plan.content_digest(data))
+
+    def canonical(self, obj, data):
+        """Get the canonical digest of data as content of obj, or None if it has none."""
+        key = self._key(obj, data)
+        self.used.add(key)
+        if key not in self.entries:
+            self.entries[key] = smwflow.compare.canonical_digest(self.config, obj, data)
+            self.dirty = True
+        return self.entries[key]
+
+def get_index(config):
+    """Get the verify index of config.smwconf, loading it once per process."""
+    global _INDEX
+    if _INDEX is None or _INDEX.repo_path != smwflow.gitrev.get_origin(config, 'smwconf'):
+        save_index()
+        _INDEX = DigestIndex(config)
+        _INDEX.load()
+    return _INDEX
+
+def save_index():
+    """Persist the verify index if it was loaded and changed."""
+    if _INDEX is not None:
+        _INDEX.save()
+
+def equal(config, obj, git_data, smw_data):
+    """As smwflow.compare.equal(), deciding by canonical digest where possible."""
+    if git_data == smw_data:
+        return True
+    index = get_index(config)
+    git_digest = index.canonical(obj, git_data)
+    smw_digest = index.canonical(obj, smw_data)
+    if git_digest is None or smw_digest is None:
+        return smwflow.compare.equal(config, obj, git_data, smw_data)
+    return git_digest == smw_digest
+
+def differences(config, obj, git_data, smw_data):
+    """As smwflow.compare.basic_compare(), skipping the diff of equal content."""
+    if git_data == smw_data:
+        return []
+    index = get_index(config)
+    git_digest = index.canonical(obj, git_data)
+    smw_digest = index.canonical(obj, smw_data)
+    if git_digest is not None and git_digest == smw_digest:
+        return []
+    return smwflow.compare.basic_compare(config, obj, git_data, smw_data)
@@ -0,0 +1,244 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.gitrev
+
+Evaluate the smwconf and secured repos at an arbitrary git revision without
+checking it out.  The tree of the revision is listed with 'git ls-tree -r'
+and its blobs are read through a 'git cat-file --batch' process per repo,
+pooled for the life of the process, then laid out in a per-commit directory
+inside the repo's git directory.  config.smwconf and config.secured are pointed at those
+directories for the run, so templates, vars, manifests and plugins are all
+read as of the revision while the working trees are left alone.  The
+original repos remain available through get_origin() for git and state
+operations.
+
+Exports are keyed by commit, so they are reused by later runs and several
+revisions can be evaluated at once.  A run holds a shared lock on each export
+it uses, and exports are only pruned under an exclusive one.
+"""
+
+import os
+import errno
+import fcntl
+import atexit
+import shutil
+import threading
+import subprocess
+
+REV_REPOS = ['smwconf', 'secured']
+EXPORT_DIRNAME = 'smwflow-rev'
+
+# exports kept per repo, the least recently used are removed beyond this
+EXPORT_KEEP = 8
+
+def _git(repo_path, args):
+    command = ['git', '-C', repo_path] + args
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return stdout
+
+class CatFile(object):
+    """A long-lived 'git cat-file --batch' process for one repo."""
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(['git', '-C', repo_path, 'cat-file', '--batch'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, sha):
+        """Read an object, returning (type, content); raises KeyError if missing."""
+        with self.lock:
+            self.proc.stdin.write('%s\n' % sha)
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise KeyError('%s not found in %s' % (sha, self.repo_path))
+            _, objtype, size = header
+            content = self.proc.stdout.read(int(size))
+            self.proc.stdout.read(1)
+        return objtype, content
+
+    def close(self):
+        with self.lock:
+            if self.proc.poll() is None:
+                self.proc.stdin.close()
+                self.proc.wait()
+
+_CATFILES = {}
+_CATFILES_LOCK = threading.Lock()
+
+def get_catfile(repo_path):
+    """Get the pooled cat-file process of repo_path, starting it if needed."""
+    repo_path = os.path.realpath(repo_path)
+    with _CATFILES_LOCK:
+        catfile = _CATFILES.get(repo_path)
+        if catfile is None or catfile.proc.poll() is not None:
+            catfile = CatFile(repo_path)
+            _CATFILES[repo_path] = catfile
+    return catfile
+
+def close_catfiles():
+    with _CATFILES_LOCK:
+        for catfile in _CATFILES.values():
+            catfile.close()
+        _CATFILES.clear()
+
+atexit.register(close_catfiles)
+
+def resolve(repo_path, rev):
+    """Resolve rev to a commit id in repo_path, or None."""
+    stdout = _git(repo_path, ['rev-parse', '--verify', '--quiet', '%s^{commit}' % rev])
+    return stdout.strip() if stdout else None
+
+def list_tree(repo_path, commit):
+    """List the files of a commit.
+
+    Returns: list
+        (path, mode, blob id) tuples; submodules are not listed
+    """
+    stdout = _git(repo_path, ['ls-tree', '-r', '-z', '--full-tree', commit])
+    if stdout is None:
+        raise ValueError('cannot list %s in %s' % (commit, repo_path))
+    ret = []
+    for entry in stdout.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, objtype, sha = info.split()
+        if objtype == 'blob':
+            ret.append((path, mode, sha))
+    return ret
+
+def _export_root(repo_path):
+    git_dir = _git(repo_path, ['rev-parse', '--git-dir'])
+    if not git_dir or not git_dir.strip():
+        raise ValueError('%s is not a git repo' % repo_path)
+    return os.path.join(repo_path, git_dir.strip(), EXPORT_DIRNAME)
+
+def _write_tree(repo_path, commit, dest):
+    catfile = get_catfile(repo_path)
+    for path, mode, sha in list_tree(repo_path, commit):
+        fullpath = os.path.join(dest, path)
+        dirname = os.path.dirname(fullpath)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0755)
+        _, content = catfile.read(sha)
+        if mode == '120000':
+            os.symlink(content, fullpath)
+            continue
+        with open(fullpath, 'wb') as wfp:
+            wfp.write(content)
+        # as a checkout would; the export root itself is private
+        os.chmod(fullpath, 0755 if mode == '100755' else 0644)
+
+# lock files of the exports in use by this process, held until it exits
+_HELD_LOCKS = []
+
+def _lock_export(dest, operation):
+    lfp = open('%s.lock' % dest, 'a')
+    try:
+        fcntl.flock(lfp.fileno(), operation)
+    except IOError:
+        lfp.close()
+        return None
+    return lfp
+
+def _prune_exports(root, keep):
+    """Remove the least recently used exports beyond EXPORT_KEEP.
+
+    Exports locked by a run (see export()) are left alone.
+    """
+    exports = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if '.tmp.' in name or name.endswith('.lock') or name == keep:
+            continue
+        exports.append((os.path.getmtime(path), path))
+    for _, path in sorted(exports, reverse=True)[EXPORT_KEEP - 1:]:
+        lfp = _lock_export(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lfp is None:
+            continue
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            lfp.close()
+
+def export(repo_path, commit):
+    """Lay out the tree of commit from repo_path, reusing an earlier export.
+
+    A shared lock on the export is held for the rest of the process, so
+    that concurrent runs do not prune it while it is in use.  Returns the
+    path of the export directory.
+    """
+    root = _export_root(repo_path)
+    dest = os.path.join(root, commit)
+    try:
+        os.makedirs(root, 0700)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+    _HELD_LOCKS.append(_lock_export(dest, fcntl.LOCK_SH))
+    if os.path.isdir(dest):
+        os.utime(dest, None)
+        return dest
+    tmp = '%s.tmp.%d.%d' % (dest, os.getpid(), threading.current_thread().ident)
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp, 0700)
+    try:
+        _write_tree(repo_path, commit, tmp)
+        os.rename(tmp, dest)
+    except OSError, err:
+        # a concurrent run exported the same commit first
+        if err.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not os.path.isdir(dest):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    _prune_exports(root, commit)
+    return dest
+
+def apply_rev(config, rev):
+    """Point config.smwconf and config.secured at their trees as of rev.
+
+    The original repos and the resolved commits are recorded in
+    config.rev_origin and config.rev_commits.
+    """
+    origin = {}
+    commits = {}
+    for repo in REV_REPOS:
+        repo_path = getattr(config, repo, None)
+        if not repo_path or not os.path.isdir(repo_path):
+            continue
+        commit = resolve(repo_path, rev)
+        if commit is None:
+            raise ValueError('cannot resolve revision %s in %s' % (rev, repo_path))
+        origin[repo] = repo_path
+        commits[repo] = commit
+        setattr(config, repo, export(repo_path, commit))
+    config.rev_origin = origin
+    config.rev_commits = commits
+    return config
+
+def get_origin(config, repo):
+    """Get the git repo behind config.<repo>, which may be an export (see apply_rev())."""
+    return getattr(config, 'rev_origin', {}).get(repo, getattr(config, repo, None))
+
+def get_commit(config, repo):
+    """Get the commit config.<repo> was exported from, None for the working tree."""
+    return getattr(config, 'rev_commits', {}).get(repo)
@@ -17,11 +17,10 @@
 import os
 import subprocess
 import errno
-import codecs
-from jinja2 import Template
 import smwflow
-import smwflow.compare
+import smwflow.digests
 import smwflow.manifest
+import smwflow.render
 import smwflow.search
 import smwflow.smwfile
 import smwflow.variables
@@ -232,28 +231,17 @@ def import_data(config):
                 retcode = subprocess.call(command)
                 if retcode != 0:
                     raise OSError('Failed to copy %s to %s' % (item['smwpath'], tgt_path))
-                manifest[item['name']] = item
+                manifest[item['name']] = item.to_dict()
 
         deferred_actions.extend(manifest.save())
         deferred_actions.append("Add/Commit HSS items in %s" % repo_path)
     return deferred_actions
 
-def _git_hss_object(_, obj, hss_vars):
-    git_data = None
-    with codecs.open(obj['fullpath'], mode='r', encoding='utf-8') as rfp:
-        data = rfp.read()
-        template = Template(data)
-        git_data = template.render(hss_vars)
-    return git_data
-
 def _smw_hss_object(_, obj):
-    if not os.path.exists(obj['smwpath']):
+    if not smwflow.smwfile.STAT_CACHE.exists(obj['smwpath']):
         return None
 
-    smw_data = None
-    with codecs.open(obj['smwpath'], mode='r', encoding='utf-8') as rfp:
-        smw_data = rfp.read()
-    return smw_data
+    return smwflow.smwfile.read_smw_file(obj['smwpath'])
 
 def _valid_hss_object(_, obj, name):
     if 'smwpath' not in obj:
@@ -261,53 +249,97 @@ def _valid_hss_object(_, obj, name):
         return False
     return True
 
-def _verify_hss_object(config, obj, name, git_data, smw_data):
+def _verify_hss_object(config, obj, name, git_data, smw_data, report=True):
     if not git_data or not smw_data:
         print 'Failed to read git or smw data for hss file %s (smw: %s)' % (name, obj['smwpath'])
         return None
-    issues = smwflow.compare.basic_compare(config, obj, git_data, smw_data)
+    if not report:
+        if smwflow.digests.equal(config, obj, git_data, smw_data):
+            return []
+        return ['%s differs' % name]
+    issues = smwflow.digests.differences(config, obj, git_data, smw_data)
     return issues
 
-def verify_data(config):
-    deferred_actions = []
+def get_verify_objects(config, names=None):
+    """Discover the valid hss objects and render their git side.
 
+    If names is given, only those objects are rendered and returned.
+
+    Returns a dictionary of objects keyed by name, each carrying its rendered
+    content in 'git_data', suitable for repeated calls to verify_object().
+    """
+    ret = {}
     objs = smwflow.search.get_objects(config, 'hss', 'hss')
     hss_vars = smwflow.variables.read_vars(config, 'hss', 'vars', None, config.global_vars)
     for key in objs:
         obj = objs[key]
+        if names is not None and key not in names:
+            continue
         if not _valid_hss_object(config, obj, key):
             continue
+        obj['smwpath'] = smwflow.smwfile.smw_root_path(config, obj['smwpath'])
+        ret[key] = obj
+
+    keys = sorted(ret.keys())
+    rendered = smwflow.render.render_files([ret[x]['fullpath'] for x in keys], hss_vars,
+                                           smwflow.render.get_render_processes(config))
+    for key, git_data in zip(keys, rendered):
+        ret[key]['git_data'] = git_data
+    return ret
+
+def verify_object(config, obj, report=True):
+    """Compare a rendered hss object with its current state on the SMW.
+
+    Without report, the comparison stops at the first difference and issues
+    holds a single summary line rather than every difference.
 
-        git_data = _git_hss_object(config, obj, hss_vars)
-        smw_data = _smw_hss_object(config, obj)
+    Returns: tuple (issues, attributes_ok)
+        issues is the list of differences, or None if either side could not
+        be read; attributes_ok is False if the SMW file is missing or has the
+        wrong ownership or mode.
+    """
+    smw_data = _smw_hss_object(config, obj)
+    issues = _verify_hss_object(config, obj, obj['name'], obj['git_data'], smw_data,
+                                report)
+    attributes_ok = smwflow.smwfile.STAT_CACHE.exists(obj['smwpath']) and \
+        smwflow.smwfile.verifyattributes(config, obj)
+    return issues, attributes_ok
 
-        issues = _verify_hss_object(config, obj, key, git_data, smw_data)
-        if isinstance(issues, list) and issues:
+def verify_data(config, names=None):
+    deferred_actions = []
+
+    objs = get_verify_objects(config, names)
+    for key in objs:
+        obj = objs[key]
+        issues, attributes_ok = verify_object(config, obj)
+        if issues:
             print "DIFFERENCES FOUND IN %s" % obj['name']
             for item in issues:
                 print item
             print ""
-        if not smwflow.smwfile.verifyattributes(config, obj):
+        if not attributes_ok:
             print 'WARNING: file on smw %s has incorrect ownership or mode' % obj['smwpath']
+        if issues is None or issues or not attributes_ok:
+            deferred_actions.append("Resolve differences in HSS file %s" % obj['smwpath'])
 
     return deferred_actions
 
-def update_data(config):
+def update_data(config, plan):
+    """Add the writes and attribute changes needed by the HSS files to plan."""
     deferred_actions = []
-    objs = smwflow.search.get_objects(config, 'hss', 'hss')
-    hss_vars = smwflow.variables.read_vars(config, 'hss', 'hss', None, config.global_vars)
+    objs = get_verify_objects(config)
 
     for key in objs:
         obj = objs[key]
-        if not _valid_hss_object(config, obj, key):
+        git_data = obj['git_data']
+        if git_data is None:
+            print "Skipping HSS component %s, failed to render %s" % (obj['name'], obj['fullpath'])
+            deferred_actions.append("Resolve rendering of HSS file %s" % obj['fullpath'])
             continue
-        git_data = _git_hss_object(config, obj, hss_vars)
-        smw_data = _smw_hss_object(config, obj)
-
-        issues = _verify_hss_object(config, obj, key, git_data, smw_data)
+        issues, attributes_ok = verify_object(config, obj, report=False)
         if issues is None or issues:
-            print "Updating HSS component %s in %s" % (obj['name'], obj['smwpath'])
-            with codecs.open(obj['smwpath'], mode='w', encoding='utf-8') as wfp:
-                wfp.write(git_data)
-            smwflow.smwfile.setattributes(config, obj)
+            print "Planning update of HSS component %s in %s" % (obj['name'], obj['smwpath'])
+            plan.write(obj['smwpath'], git_data)
+        if issues is None or issues or not attributes_ok:
+            plan.attributes(obj['smwpath'], obj)
     return deferred_actions
@@ -0,0 +1,338 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.plan
+
+Two-phase update.  The plan phase compares git with the SMW and records the
+changes needed -- directories, file writes and copies with content digests,
+ownership and mode changes, and cfgset calls -- in a Plan, which can be saved
+as yaml.  The apply phase performs a Plan without consulting the templates
+again: directories first, then the file operations in parallel (operations
+on the same path stay in order), then the cfgset calls through a
+smwflow.cfgsetcli.CfgsetQueue.
+"""
+
+import os
+import hashlib
+import shutil
+import codecs
+import yaml
+from multiprocessing.pool import ThreadPool
+import smwflow.cfgsetcli
+import smwflow.smwfile
+
+PLAN_VERSION = 1
+DEFAULT_APPLY_JOBS = 8
+BULK_CHUNK = 256
+
+def content_digest(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as rfp:
+        for block in iter(lambda: rfp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_attributes(obj):
+    return {x: obj[x] for x in ('owner', 'group', 'mode') if x in obj}
+
+class Plan(object):
+    """An ordered, serializable set of changes to the SMW.
+
+    file_actions holds 'mkdir', 'write', 'copy', 'delete', 'rmdir' and
+    'attributes' actions on absolute paths; an 'attributes' action may carry
+    a list of 'paths' sharing the same ownership and mode instead of a single
+    'path'.  cfgset maps a config set name to its pending cfgset
+    calls: worksheets to submit (name -> content), whether to run 'cfgset
+    update' and 'cfgset validate', and attribute actions to perform after
+    them.  Callbacks registered with after_apply() are run by apply() but
+    are not saved.
+    """
+    def __init__(self):
+        self.file_actions = []
+        self.cfgset = {}
+        self.cfgset_order = []
+        self.callbacks = []
+
+    def mkdir(self, path, mode=0755):
+        self.file_actions.append({'action': 'mkdir', 'path': path, 'mode': mode})
+
+    def write(self, path, data):
+        self.file_actions.append({'action': 'write', 'path': path,
+                                  'digest': content_digest(data), 'content': data})
+
+    def copy(self, path, source, digest=None):
+        """Record copying source to path; digest is the sha256 of source, if known."""
+        self.file_actions.append({'action': 'copy', 'path': path, 'source': source,
+                                  'digest': digest if digest else file_digest(source)})
+
+    def delete(self, path):
+        self.file_actions.append({'action': 'delete', 'path': path})
+
+    def rmdir(self, path):
+        self.file_actions.append({'action': 'rmdir', 'path': path})
+
+    def attributes_bulk(self, paths, obj):
+        """Record the ownership and mode of obj to be applied to many paths."""
+        attrs = get_attributes(obj)
+        if attrs and paths:
+            action = {'action': 'attributes', 'paths': sorted(paths)}
+            action.update(attrs)
+            self.file_actions.append(action)
+
+    def attributes(self, path, obj):
+        """Record the ownership and mode of obj to be applied to path."""
+        attrs = get_attributes(obj)
+        if attrs:
+            action = {'action': 'attributes', 'path': path}
+            action.update(attrs)
+            self.file_actions.append(action)
+
+    def _cfgset(self, cname):
+        if cname not in self.cfgset:
+            self.cfgset[cname] = {'worksheets': {}, 'update': False, 'validate': False,
+                                  'after': []}
+            self.cfgset_order.append(cname)
+        return self.cfgset[cname]
+
+    def cfgset_worksheet(self, cname, key, data):
+        self._cfgset(cname)['worksheets'][key] = data
+        self._cfgset(cname)['update'] = True
+
+    def cfgset_update(self, cname):
+        self._cfgset(cname)['update'] = True
+
+    def cfgset_validate(self, cname):
+        self._cfgset(cname)['validate'] = True
+
+    def cfgset_attributes(self, cname, path, obj):
+        """Record attributes to be applied after the cfgset calls of cname."""
+        attrs = get_attributes(obj)
+        if attrs:
+            action = {'action': 'attributes', 'path': path}
+            action.update(attrs)
+            self._cfgset(cname)['after'].append(action)
+
+    def after_apply(self, fxn):
+        self.callbacks.append(fxn)
+
+    def is_empty(self):
+        return not self.file_actions and not self.cfgset
+
+    def describe(self):
+        for action in self.file_actions:
+            if action['action'] == 'attributes':
+                attrs = ' '.join('%s=%s' % (x, oct(action[x]) if x == 'mode' else action[x])
+                                 for x in ('owner', 'group', 'mode') if x in action)
+                for path in action.get('paths', [action.get('path')]):
+                    print "attributes %s %s" % (path, attrs)
+            elif action['action'] in ('mkdir', 'delete', 'rmdir'):
+                print "%s %s" % (action['action'], action['path'])
+            else:
+                print "%s %s sha256:%s" % (action['action'], action['path'], action['digest'])
+        for cname in self.cfgset_order:
+            pending = self.cfgset[cname]
+            for key in sorted(pending['worksheets']):
+                print "cfgset %s worksheet %s sha256:%s" % \
+                      (cname, key, content_digest(pending['worksheets'][key]))
+            if pending['update']:
+                print "cfgset update %s" % cname
+            if pending['validate']:
+                print "cfgset validate %s" % cname
+            for action in pending['after']:
+                print "attributes %s (after cfgset)" % action['path']
+        print "%d file operations, %d config sets" % (len(self.file_actions), len(self.cfgset))
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'file_actions': self.file_actions,
+            'cfgset': [dict(self.cfgset[x], name=x) for x in self.cfgset_order],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data or data.get('version') != PLAN_VERSION:
+            raise ValueError('unsupported plan version')
+        plan = cls()
+        plan.file_actions = data.get('file_actions', [])
+        for pending in data.get('cfgset', []):
+            cname = pending.pop('name')
+            plan.cfgset[cname] = pending
+            plan.cfgset_order.append(cname)
+        return plan
+
+    def save(self, path):
+        # planned writes hold rendered content, including decrypted secrets
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.fchmod(fd, 0600)
+        with os.fdopen(fd, 'w') as wfp:
+            wfp.write(yaml.safe_dump(self.to_dict(), default_flow_style=False))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as rfp:
+            return cls.from_dict(yaml.safe_load(rfp.read()))
+
+def _apply_action(config, action):
+    path = action['path']
+    if action['action'] == 'write':
+        if content_digest(action['content']) != action['digest']:
+            raise ValueError('content digest mismatch for %s' % path)
+        with codecs.open(path, mode='w', encoding='utf-8') as wfp:
+            wfp.write(action['content'])
+    elif action['action'] == 'copy':
+        if file_digest(action['source']) != action['digest']:
+            raise ValueError('%s changed since the plan was made' % action['source'])
+        shutil.copyfile(action['source'], path)
+    elif action['action'] == 'delete':
+        os.unlink(path)
+    elif action['action'] == 'attributes':
+        obj = get_attributes(action)
+        obj['name'] = path
+        obj['smwpath'] = path
+        smwflow.smwfile.setattributes(config, obj)
+
+def _apply_path(args):
+    config, actions = args
+    try:
+        for action in actions:
+            _apply_action(config, action)
+    except (IOError, OSError, ValueError, KeyError) as err:
+        return "FAILED %s: %s" % (actions[0]['path'], err)
+    finally:
+        smwflow.smwfile.STAT_CACHE.invalidate(actions[0]['path'])
+    return None
+
+def _apply_bulk(args):
+    config, action, paths = args
+    try:
+        smwflow.smwfile.setattributes_bulk(config, paths, action)
+    except (IOError, OSError, KeyError) as err:
+        return "FAILED attributes of %d paths from %s: %s" % (len(paths), paths[0], err)
+    return None
+
+def _run_jobs(fxn, jobs, processes):
+    if processes is None:
+        processes = DEFAULT_APPLY_JOBS
+    if processes > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(processes, len(jobs)))
+        try:
+            return pool.map(fxn, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [fxn(x) for x in jobs]
+
+def _apply_file_actions(config, actions, processes):
+    """Apply file actions: directories, per-path operations, bulk attributes, rmdirs."""
+    sv_umask = os.umask(0)
+    try:
+        for action in actions:
+            if action['action'] != 'mkdir':
+                continue
+            try:
+                os.mkdir(action['path'], action['mode'])
+            except OSError:
+                pass
+            smwflow.smwfile.STAT_CACHE.invalidate(action['path'])
+    finally:
+        os.umask(sv_umask)
+
+    by_path = {}
+    order = []
+    bulk_jobs = []
+    for action in actions:
+        if action['action'] in ('mkdir', 'rmdir'):
+            continue
+        if 'paths' in action:
+            paths = action['paths']
+            for idx in xrange(0, len(paths), BULK_CHUNK):
+                bulk_jobs.append((config, action, paths[idx:idx + BULK_CHUNK]))
+            continue
+        if action['path'] not in by_path:
+            by_path[action['path']] = []
+            order.append(action['path'])
+        by_path[action['path']].append(action)
+
+    results = _run_jobs(_apply_path, [(config, by_path[x]) for x in order], processes)
+    results.extend(_run_jobs(_apply_bulk, bulk_jobs, processes))
+
+    for action in actions:
+        if action['action'] != 'rmdir':
+            continue
+        try:
+            os.rmdir(action['path'])
+        except OSError as err:
+            results.append("FAILED %s: %s" % (action['path'], err))
+        smwflow.smwfile.STAT_CACHE.invalidate(action['path'])
+    return [x for x in results if x]
+
+def apply(config, plan):
+    """Perform the changes recorded in plan.
+
+    Returns: list
+        deferred actions for the operations that failed
+    """
+    errors = _apply_file_actions(config, plan.file_actions, getattr(config, 'apply_jobs', None))
+
+    queue = smwflow.cfgsetcli.CfgsetQueue(config)
+    for cname in plan.cfgset_order:
+        pending = plan.cfgset[cname]
+        for key, data in pending['worksheets'].items():
+            queue.add_worksheet(cname, key, data)
+        if pending['update']:
+            queue.update(cname)
+        if pending['validate']:
+            queue.validate(cname)
+        if pending['after']:
+            queue.after(cname, lambda actions=pending['after']:
+                        errors.extend(_apply_file_actions(config, actions, 1)))
+    retc = queue.flush()
+    queue.report()
+
+    deferred_actions = []
+    for error in errors:
+        print error
+        deferred_actions.append("Investigate update failure: %s" % error)
+    if retc != 0:
+        deferred_actions.append("Investigate failed cfgset calls")
+
+    for fxn in plan.callbacks:
+        deferred_actions.extend(fxn() or [])
+    return deferred_actions
+
+def execute(config, plan):
+    """Save, show or apply a freshly made plan as requested by config."""
+    if getattr(config, 'save_plan', None):
+        plan.save(config.save_plan)
+        print "Saved update plan to %s" % config.save_plan
+    if getattr(config, 'dry_run', False) or getattr(config, 'save_plan', None):
+        plan.describe()
+        return []
+    return apply(config, plan)
+
+def do_apply(config):
+    plan = Plan.load(config.plan_file)
+    if getattr(config, 'dry_run', False):
+        plan.describe()
+        return []
+    return apply(config, plan)
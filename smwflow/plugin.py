@@ -20,14 +20,33 @@ import copy
 import stat
 import smwflow.search
 
+# loaded plugins keyed by search paths, validated against the plugin files' stats
+_PLUGIN_CACHE = {}
+
+def clear_cache():
+    _PLUGIN_CACHE.clear()
+
+def _forget_module(module, paths):
+    """Drop a previously imported plugin module so it will be imported afresh.
+
+    Only modules loaded from one of the plugin paths are dropped, never an
+    unrelated module of the same name.
+    """
+    if module not in sys.modules:
+        return
+    fname = getattr(sys.modules[module], '__file__', None)
+    if not fname:
+        return
+    dirname = os.path.dirname(os.path.realpath(fname))
+    if dirname in [os.path.realpath(x) for x in paths]:
+        del sys.modules[module]
+
 def get_plugins(config, maintype, objtype, subtype=None, repos=('smwconf', 'secured'), system=None):
     paths = smwflow.search.gen_paths(config, maintype, "%s_plugins" % objtype, subtype, repos, system)
-    paths_rev = [x for x in paths.__reversed__()]
-    old_sys_path = copy.deepcopy(sys.path)
-    sys.path.extend(paths_rev)
 
     plugins = {}
     modules = {}
+    signature = []
     for path in paths:
         for fname in os.listdir(path):
             if not fname.endswith(".py"):
@@ -43,11 +62,25 @@ def get_plugins(config, maintype, objtype, subtype=None, repos=('smwconf', 'secu
             # to avoid loading duplicate copies (owing to the behavior of the
             # loader)
             modules[module_name] = True
-    for module in modules:
-        __module__ = __import__(module, globals(), locals(), [], -1)
-        pluginall = getattr(__module__, "__all__")
-        for plugin in pluginall:
-            plugins[plugin] = getattr(__module__, plugin)
-
-    sys.path = old_sys_path
-    return plugins
+            signature.append((fpath, stdata.st_ino, stdata.st_mtime, stdata.st_size))
+
+    key = tuple(paths)
+    signature = tuple(sorted(signature))
+    if key in _PLUGIN_CACHE and _PLUGIN_CACHE[key][0] == signature:
+        return dict(_PLUGIN_CACHE[key][1])
+
+    paths_rev = [x for x in paths.__reversed__()]
+    old_sys_path = copy.deepcopy(sys.path)
+    sys.path.extend(paths_rev)
+    try:
+        for module in modules:
+            _forget_module(module, paths)
+            __module__ = __import__(module, globals(), locals(), [], -1)
+            pluginall = getattr(__module__, "__all__")
+            for plugin in pluginall:
+                plugins[plugin] = getattr(__module__, plugin)
+    finally:
+        sys.path = old_sys_path
+
+    _PLUGIN_CACHE[key] = (signature, plugins)
+    return dict(plugins)
@@ -15,11 +15,19 @@
 # See the LICENSE file in the top-level of the smwflow source distribution.
 
 import os
+import sys
+import copy
 import subprocess
 import re
-import smwflow.hss as hss
-import smwflow.imps as imps
-import smwflow.cfgset as cfgset
+import StringIO
+import traceback
+import smwflow.smwfile
+
+# The object type modules pull in rsm, jinja2, yaml and ansible, so each mode
+# imports only what it uses, keeping status and checkout fast to start.
+
+# configuration shared with forked multi-system verify workers
+_MULTI_CONFIG = None
 
 def get_git_head_rev(path):
     command = ["git", "-C", path, "rev-parse", "HEAD"]
@@ -114,36 +122,175 @@ def do_checkout(config):
 def do_import(config):
     deferred_actions = []
     if config.import_hss:
+        import smwflow.hss as hss
         deferred_actions.extend(hss.import_data(config))
     if config.import_imps:
+        import smwflow.imps as imps
         deferred_actions.extend(imps.import_data(config))
+    if config.import_basesmw:
+        import smwflow.basesmw as basesmw
+        deferred_actions.extend(basesmw.import_data(config))
 
     return deferred_actions
 
-def do_verify(config):
+def _apply_smw_root(config):
+    if getattr(config, 'smw_root', None):
+        config.configset_path = smwflow.smwfile.smw_root_path(config, config.configset_path)
+    return config
+
+def _selected(selection, attr):
+    """Determine if any objects of a type are selected (None selects all)."""
+    if selection is None:
+        return True
+    selected = getattr(selection, attr)
+    return selected is None or len(selected) > 0
+
+def _is_clean_verify_all(config, deferred_actions):
+    return not deferred_actions and config.verify_hss and config.verify_imps \
+        and config.verify_both_cfgset
+
+def _verify_system_data(config, record=True):
+    """Verify a single system, optionally limited to changes since a revision.
+
+    A clean 'verify all' records the repo HEADs as the default starting point
+    for later 'verify --since' runs, unless record is False.
+    """
+    import smwflow.delta as delta
+    deferred_actions = []
+    selection = None
+    if getattr(config, 'verify_since', None) is not None:
+        selection = delta.get_selection(config, config.verify_since or None)
+
+    if config.verify_hss and _selected(selection, 'hss'):
+        import smwflow.hss as hss
+        deferred_actions.extend(hss.verify_data(config, selection.hss if selection else None))
+    if config.verify_imps and _selected(selection, 'imps'):
+        import smwflow.imps as imps
+        deferred_actions.extend(imps.verify_data(config, selection.imps if selection else None))
+    if (config.verify_cfgset or config.verify_both_cfgset) and _selected(selection, 'cfgset'):
+        import smwflow.cfgset as cfgset
+        deferred_actions.extend(cfgset.verify_data(config,
+                                                   selection.cfgset if selection else None))
+    if config.verify_basesmw:
+        import smwflow.basesmw as basesmw
+        deferred_actions.extend(basesmw.verify_data(config))
+    if config.verify_zypper:
+        import smwflow.zypper as zypper
+        deferred_actions.extend(zypper.verify_data(config))
+
+    if record and _is_clean_verify_all(config, deferred_actions):
+        delta.record_verified(config)
+    return deferred_actions
+
+def _system_config(config, system):
+    import smwflow.variables as variables
+    sys_config = copy.copy(config)
+    sys_config.system = system
+    sys_config.global_vars = variables.read_vars(sys_config, 'vars', 'vars')
+    return _apply_smw_root(sys_config)
+
+def _verify_one_system(system):
+    """Verify a single system in a forked worker, capturing its report.
+
+    Whether the system verified clean is returned rather than recorded, so
+    that the parent records every system without racing the other workers.
+    """
+    output = StringIO.StringIO()
+    sv_stdout = sys.stdout
+    sys.stdout = output
     deferred_actions = []
-    if config.verify_hss:
-        deferred_actions.extend(hss.verify_data(config))
-    if config.verify_imps:
-        deferred_actions.extend(imps.verify_data(config))
-    if config.verify_cfgset:
-        deferred_actions.extend(cfgset.verify_data(config))
+    error = None
+    clean = False
+    try:
+        deferred_actions = _verify_system_data(_system_config(_MULTI_CONFIG, system),
+                                               record=False)
+        clean = _is_clean_verify_all(_MULTI_CONFIG, deferred_actions)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = sv_stdout
+    return system, output.getvalue(), deferred_actions, error, clean
+
+def _precompile_templates(config, systems):
+    """Compile every template once in the parent so forked workers share them."""
+    import smwflow.render as render
+    import smwflow.search as search
+    seen = set()
+    for system in systems:
+        for maintype, objtype, subtype in search.TEMPLATED_OBJTYPES:
+            for path in search.gen_paths(config, maintype, objtype, subtype, system=system):
+                if path in seen:
+                    continue
+                seen.add(path)
+                render.precompile_tree(path)
 
+def _verify_systems(config, systems):
+    global _MULTI_CONFIG
+    import multiprocessing
+    _MULTI_CONFIG = config
+    _precompile_templates(config, systems)
+
+    jobs = config.jobs if config.jobs else multiprocessing.cpu_count()
+    jobs = min(jobs, len(systems))
+    pool = multiprocessing.Pool(processes=jobs)
+    try:
+        results = pool.map(_verify_one_system, systems)
+    finally:
+        pool.close()
+        pool.join()
+
+    import smwflow.delta as delta
+    deferred_actions = []
+    for system, output, sys_actions, error, clean in results:
+        print "==== %s ====" % system
+        sys.stdout.write(output)
+        if error:
+            print "FAILED to verify %s:" % system
+            print error
+            deferred_actions.append("Investigate verify failure on %s" % system)
+        deferred_actions.extend(sys_actions)
+        if clean:
+            sys_config = copy.copy(config)
+            sys_config.system = system
+            delta.record_verified(sys_config)
     return deferred_actions
 
+def do_verify(config):
+    systems = config.verify_systems
+    if config.verify_all_systems:
+        import smwflow.search as search
+        systems = search.get_systems(config)
+    if systems:
+        return _verify_systems(config, systems)
+    return _verify_system_data(_apply_smw_root(config))
+
 def do_update(config):
+    """Plan the requested updates, then save, show or apply the plan."""
+    import smwflow.plan as planning
     deferred_actions = []
+    plan = planning.Plan()
     if config.update_hss:
-        deferred_actions.extend(hss.update_data(config))
+        import smwflow.hss as hss
+        deferred_actions.extend(hss.update_data(config, plan))
     if config.update_imps:
-        deferred_actions.extend(imps.update_data(config))
+        import smwflow.imps as imps
+        deferred_actions.extend(imps.update_data(config, plan))
     if config.update_cfgset:
-        deferred_actions.extend(cfgset.update_data(config))
+        import smwflow.cfgset as cfgset
+        deferred_actions.extend(cfgset.update_data(config, plan))
+    if config.update_basesmw:
+        import smwflow.basesmw as basesmw
+        deferred_actions.extend(basesmw.update_data(config, plan))
+    if config.update_zypper:
+        import smwflow.zypper as zypper
+        deferred_actions.extend(zypper.update_data(config, plan))
+    deferred_actions.extend(planning.execute(config, plan))
     return deferred_actions
 
 def do_create(config):
     deferred_actions = []
     if config.create_cfgset:
+        import smwflow.cfgset as cfgset
         deferred_actions.extend(cfgset.create(config))
     return deferred_actions
 
@@ -161,4 +308,19 @@ def process(config):
         ret = do_update(config)
     elif config.mode == "create":
         ret = do_create(config)
+    elif config.mode == "watch":
+        import smwflow.watch as watch
+        ret = watch.watch(config)
+    elif config.mode == "serve":
+        import smwflow.server as server
+        ret = server.serve(config)
+    elif config.mode == "deps":
+        import smwflow.deps as deps
+        ret = deps.do_deps(config)
+    elif config.mode == "apply":
+        import smwflow.plan as planning
+        ret = planning.do_apply(config)
+    if config.mode in ('verify', 'update', 'create', 'apply'):
+        import smwflow.digests as digests
+        digests.save_index()
     return ret
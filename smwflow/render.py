@@ -0,0 +1,168 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.render
+
+Shared jinja2 template compilation and rendering for all smwflow object types.
+Compiled templates are cached by source so that unchanged templates are only
+compiled once per process (and are inherited by forked workers).
+
+Batches of templates can be rendered in a pool of worker processes with
+render_batch().  Each job names its variable scope by id; the scopes are
+handed to the workers once, when they are forked, rather than with every
+job.  render_stream() does the same for an iterable of jobs, keeping only a
+bounded window of them in flight.
+"""
+
+import os
+import codecs
+import collections
+import multiprocessing
+from jinja2 import Template, TemplateSyntaxError
+
+_TEMPLATE_CACHE = {}
+
+# variable scopes inherited by render_batch() workers
+_WORKER_SCOPES = None
+
+def clear_cache():
+    _TEMPLATE_CACHE.clear()
+
+def get_template(source):
+    """Get the compiled template for source, compiling it at most once."""
+    if source not in _TEMPLATE_CACHE:
+        _TEMPLATE_CACHE[source] = Template(source)
+    return _TEMPLATE_CACHE[source]
+
+def render(source, variables):
+    return get_template(source).render(variables)
+
+def render_file(path, variables):
+    with codecs.open(path, mode='r', encoding='utf-8') as rfp:
+        return render(rfp.read(), variables)
+
+def get_render_processes(config):
+    """Number of render worker processes requested by config (None for all cores)."""
+    return getattr(config, 'render_jobs', None)
+
+def _init_worker(scopes):
+    global _WORKER_SCOPES
+    _WORKER_SCOPES = scopes
+
+def _render_job(job):
+    source, scope_id = job
+    return render(source, _WORKER_SCOPES[scope_id])
+
+def render_batch(jobs, scopes, processes=None):
+    """Render a batch of templates, in parallel where worthwhile.
+
+    Args:
+      jobs (list): (template source, scope id) tuples
+      scopes (dict): variable dictionaries keyed by scope id
+      processes (int): number of worker processes, None for all cores
+
+    Returns: list
+      rendered strings in the same order as jobs
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # daemonic processes (e.g., multi-system verify workers) cannot fork a pool
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return [render(source, scopes[scope_id]) for source, scope_id in jobs]
+
+    pool = multiprocessing.Pool(processes, _init_worker, (scopes,))
+    try:
+        chunksize = max(1, len(jobs) // (processes * 4))
+        return pool.map(_render_job, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def render_stream(jobs, scopes, processes=None, window=None):
+    """Render an iterable of templates lazily, in parallel where worthwhile.
+
+    Args:
+      jobs (iterable): (tag, template source, scope id) tuples; the tag is
+                       not sent to the workers, only handed back
+      scopes (dict): variable dictionaries keyed by scope id
+      processes (int): number of worker processes, None for all cores
+      window (int): maximum number of jobs in flight, default 4 per process
+
+    Yields: tuple
+      (tag, rendered string) in the same order as jobs.  Jobs are only drawn
+      from the iterable as earlier results are consumed, so the templates
+      read and rendered at any one time are bounded by window.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    if processes <= 1:
+        for tag, source, scope_id in jobs:
+            yield tag, render(source, scopes[scope_id])
+        return
+
+    if window is None:
+        window = processes * 4
+    pool = multiprocessing.Pool(processes, _init_worker, (scopes,))
+    try:
+        pending = collections.deque()
+        for tag, source, scope_id in jobs:
+            pending.append((tag, pool.apply_async(_render_job, ((source, scope_id),))))
+            if len(pending) >= window:
+                tag, result = pending.popleft()
+                yield tag, result.get()
+        while pending:
+            tag, result = pending.popleft()
+            yield tag, result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+def render_files(paths, variables, processes=None):
+    """Render the template files at paths with one set of variables.
+
+    Returns the rendered strings in the same order as paths.
+    """
+    jobs = []
+    for path in paths:
+        with codecs.open(path, mode='r', encoding='utf-8') as rfp:
+            jobs.append((rfp.read(), 0))
+    return render_batch(jobs, {0: variables}, processes)
+
+def precompile_tree(path):
+    """Compile every template found under path into the template cache.
+
+    Files that are not utf-8 or not valid jinja2 templates are skipped; they
+    will be reported (if at all) when they are actually rendered.
+    """
+    count = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            if filename == '.smwflow.manifest.yaml':
+                continue
+            try:
+                with codecs.open(os.path.join(dirpath, filename), mode='r',
+                                 encoding='utf-8') as rfp:
+                    get_template(rfp.read())
+            except (IOError, UnicodeDecodeError, TemplateSyntaxError):
+                continue
+            count += 1
+    return count
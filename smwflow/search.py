@@ -18,6 +18,19 @@ import os
 import smwflow
 import smwflow.manifest
 
+# (maintype, objtype, subtype) of every object type rendered as a template
+TEMPLATED_OBJTYPES = [
+    ('hss', 'hss', None),
+    ('imps', 'imps', None),
+    ('imps', 'worksheets', 'cle'),
+    ('imps', 'worksheets', 'global'),
+    ('imps', 'config', 'cle'),
+    ('imps', 'config', 'global'),
+    ('imps', 'dist', 'cle'),
+    ('imps', 'dist', 'global'),
+    ('basesmw', 'basesmw', None),
+]
+
 def gen_paths(config, maintype, objtype, subtype=None, repos=('smwconf', 'secured'), system=None):
     """
     Generate search paths where objects of given maintype/objtype/subtype may be found.
@@ -53,6 +66,33 @@ def gen_paths(config, maintype, objtype, subtype=None, repos=('smwconf', 'secure
 
     return [x for x in paths if os.path.exists(x) and os.access(x, os.R_OK)]
 
+def get_systems(config, repos=('smwconf', 'secured')):
+    """
+    Discover the systems managed by the repos.
+
+    Every <system>.yaml in the global vars layers (vars/vars and
+    vars/<system>_vars) names a system.
+    """
+    systems = set()
+    for repo in repos:
+        rpath = getattr(config, repo, None)
+        if not rpath:
+            continue
+        vars_root = os.path.join(rpath, 'vars')
+        if not os.path.isdir(vars_root):
+            continue
+        for dirname in os.listdir(vars_root):
+            if dirname != 'vars' and not dirname.endswith('_vars'):
+                continue
+            dirpath = os.path.join(vars_root, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if not filename.endswith('.yaml') or filename.endswith('_secrets.yaml'):
+                    continue
+                systems.add(filename[:-len('.yaml')])
+    return sorted(systems)
+
 def get_objects(config, maintype, objtype, subtype=None, extra_obj_parameters=None, repos=('smwconf', 'secured'), system=None):
     """
     Get a dictionary of objects, annorated with the most relevant manifest
@@ -0,0 +1,235 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.server
+
+Optional long-running smwflow process ('smwflow serve') listening on a local
+unix socket.  It keeps the imported modules and smwflow's caches (compiled
+templates, parsed vars files, vault, plugins and worksheets) warm across
+requests, so repeated status, verify and update runs from automation skip
+interpreter startup and reloading.  Caches are validated against file stats
+as they are used, and are dropped entirely whenever a repo HEAD changes.
+
+The protocol is one JSON request line from the client ({"argv": [...],
+"cwd": "..."}) answered by a stream of JSON lines: {"output": "..."} for
+each piece of output, {"error": "..."} for each piece of error output and a
+final {"result": ...} carrying the value smwflow.process.process() returned.
+Output is captured at the file descriptor level, so that of subprocesses
+(e.g., cfgset) reaches the client too.
+"""
+
+import os
+import sys
+import json
+import codecs
+import socket
+import threading
+import traceback
+import smwflow.config
+import smwflow.gitrev
+import smwflow.process
+import smwflow.smwfile
+
+DEFAULT_SOCKET = '~/.smwflow.sock'
+
+class _SocketWriter(object):
+    """File-like object forwarding writes to the client as output (or error) messages."""
+    def __init__(self, wfp, lock, kind='output'):
+        self.wfp = wfp
+        self.lock = lock
+        self.kind = kind
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        with self.lock:
+            self.wfp.write(json.dumps({self.kind: data}) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.wfp.flush()
+
+class _FdCapture(object):
+    """Redirect a file descriptor to a _SocketWriter while active."""
+    def __init__(self, fd, writer):
+        self.fd = fd
+        self.writer = writer
+        self.saved = None
+        self.thread = None
+
+    def _relay(self, rfd):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = os.read(rfd, 65536)
+            if not data:
+                break
+            self.writer.write(decoder.decode(data))
+            self.writer.flush()
+        os.close(rfd)
+
+    def start(self):
+        rfd, wfd = os.pipe()
+        self.saved = os.dup(self.fd)
+        os.dup2(wfd, self.fd)
+        os.close(wfd)
+        self.thread = threading.Thread(target=self._relay, args=(rfd,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        os.dup2(self.saved, self.fd)
+        os.close(self.saved)
+        self.thread.join()
+
+def get_socket_path(config):
+    path = getattr(config, 'serve_socket', None) or config.server or DEFAULT_SOCKET
+    return os.path.expanduser(path)
+
+def clear_caches():
+    # imported here so that clients only forwarding a request stay light
+    import smwflow.cfgset as cfgset
+    import smwflow.plugin as plugin
+    import smwflow.render as render
+    import smwflow.smwfile as smwfile
+    import smwflow.variables as variables
+    render.clear_cache()
+    variables.clear_cache()
+    plugin.clear_cache()
+    cfgset.WORKSHEET_CACHE.clear()
+    smwfile.READ_CACHE.clear()
+
+class Server(object):
+    def __init__(self, path):
+        self.path = path
+        self.heads = None
+
+    def _check_heads(self, config):
+        heads = []
+        for repo in ['smwconf', 'secured']:
+            rpath = smwflow.gitrev.get_origin(config, repo)
+            if rpath and os.access(rpath, os.R_OK):
+                heads.append((rpath, smwflow.process.get_git_head_rev(rpath)))
+        if heads != self.heads:
+            if self.heads is not None:
+                print >>sys.stderr, "repo HEAD changed, dropping caches"
+            clear_caches()
+            self.heads = heads
+
+    def _handle(self, conn):
+        rfp = conn.makefile('r')
+        wfp = conn.makefile('w')
+        try:
+            request = json.loads(rfp.readline())
+            sv_cwd = os.getcwd()
+            os.chdir(request['cwd'])
+            lock = threading.Lock()
+            sv_stdout = sys.stdout
+            sv_stderr = sys.stderr
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sys.stdout = _SocketWriter(wfp, lock)
+            sys.stderr = _SocketWriter(wfp, lock, 'error')
+            captures = [_FdCapture(1, sys.stdout), _FdCapture(2, sys.stderr)]
+            for capture in captures:
+                capture.start()
+            result = None
+            try:
+                base_config = smwflow.config.BaseConfig()
+                config = smwflow.config.ArgConfig(base_config, request['argv'],
+                                                  forward=False).values
+                if config.mode not in smwflow.config.FORWARDED_MODES:
+                    print "mode %s cannot be run by the smwflow server" % config.mode
+                    result = 1
+                else:
+                    self._check_heads(config)
+                    smwflow.smwfile.STAT_CACHE.clear()
+                    result = smwflow.process.process(config)
+            except SystemExit as err:
+                result = err.code
+            except Exception:
+                print traceback.format_exc()
+                result = 1
+            finally:
+                for capture in captures:
+                    capture.stop()
+                sys.stdout = sv_stdout
+                sys.stderr = sv_stderr
+                os.chdir(sv_cwd)
+            wfp.write(json.dumps({'result': result}) + '\n')
+            wfp.flush()
+        finally:
+            rfp.close()
+            wfp.close()
+            conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sv_umask = os.umask(0077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(sv_umask)
+        sock.listen(5)
+        print "smwflow server listening on %s" % self.path
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self._handle(conn)
+                except (IOError, socket.error, ValueError) as err:
+                    print >>sys.stderr, "request failed: %s" % err
+        finally:
+            sock.close()
+            os.unlink(self.path)
+
+def serve(config):
+    # load the heavyweight modules once, up front
+    clear_caches()
+    server = Server(get_socket_path(config))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return []
+
+def forward(path, argv):
+    """Run argv on the smwflow server at path, relaying its output.
+
+    Returns the result of smwflow.process.process() as run by the server.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(os.path.expanduser(path))
+    rfp = sock.makefile('r')
+    wfp = sock.makefile('w')
+    try:
+        wfp.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n')
+        wfp.flush()
+        for line in rfp:
+            message = json.loads(line)
+            if 'output' in message:
+                sys.stdout.write(message['output'].encode('utf-8'))
+            elif 'error' in message:
+                sys.stderr.write(message['error'].encode('utf-8'))
+            elif 'result' in message:
+                return message['result']
+    finally:
+        rfp.close()
+        wfp.close()
+        sock.close()
+    raise IOError('smwflow server at %s closed the connection' % path)
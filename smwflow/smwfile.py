@@ -17,46 +17,231 @@
 import os
 import pwd
 import grp
+import stat
+import errno
+import codecs
+import collections
+
+def smw_root_path(config, path):
+    """Relocate an absolute SMW path under config.smw_root, if one is set.
+
+    smw_root may contain %(system)s to select a per-system snapshot or mount
+    of the SMW filesystem.
+    """
+    smw_root = getattr(config, 'smw_root', None)
+    if not smw_root or not path:
+        return path
+    smw_root = smw_root % {'system': config.system}
+    return os.path.join(smw_root, path.lstrip('/'))
+
+# uid/gid lookups, which may go to the network with nss
+_UID_CACHE = {}
+_GID_CACHE = {}
+
+def get_uid(owner):
+    if owner not in _UID_CACHE:
+        _UID_CACHE[owner] = pwd.getpwnam(owner)[2]
+    return _UID_CACHE[owner]
+
+def get_gid(group):
+    if group not in _GID_CACHE:
+        _GID_CACHE[group] = grp.getgrnam(group)[2]
+    return _GID_CACHE[group]
+
+class StatCache(object):
+    """Run-level cache of os.stat() results for SMW paths.
+
+    Missing paths are cached as None.  Entries come from the first check of
+    a path, from directory snapshots (prime()) or from fstat() of files
+    already open for reading.  smwflow invalidates a path whenever it writes,
+    copies, removes or changes the attributes of it; changes made by anyone
+    else are only seen after clear(), which watch and serve do before each
+    pass.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def stat(self, path):
+        """Get the stat result of path, or None if it does not exist."""
+        if path not in self.entries:
+            try:
+                self.entries[path] = os.stat(path)
+            except OSError, err:
+                if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                self.entries[path] = None
+        return self.entries[path]
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def prime(self, path, statobj):
+        """Record a stat result (None if missing) obtained by other means.
+
+        lstat() results of symlinks are not what stat() would return, so
+        they are not recorded.
+        """
+        if statobj is None or not stat.S_ISLNK(statobj.st_mode):
+            self.entries[path] = statobj
+
+    def invalidate(self, path):
+        self.entries.pop(path, None)
+
+    def invalidate_tree(self, root):
+        """Invalidate root and every path below it."""
+        prefix = root.rstrip('/') + '/'
+        for path in [x for x in self.entries if x == root or x.startswith(prefix)]:
+            del self.entries[path]
+
+    def clear(self):
+        self.entries.clear()
+
+STAT_CACHE = StatCache()
+
+# SMW file contents read this run, and their parsed forms
+READ_CACHE_BYTES = 64 << 20
+
+class _ReadEntry(object):
+    __slots__ = ('signature', 'text', 'parsed')
+
+    def __init__(self, signature, text):
+        self.signature = signature
+        self.text = text
+        self.parsed = {}
+
+def _signature(statobj):
+    return (statobj.st_ino, statobj.st_mtime, statobj.st_size)
+
+class ReadCache(object):
+    """Run-scoped cache of SMW file reads and of the structures parsed from them.
+
+    Entries are keyed by path and revalidated against the (inode, mtime,
+    size) of the file in STAT_CACHE on every read, so a file is read and
+    parsed at most once per run unless it changes.  The least recently used
+    entries are dropped once the cached text exceeds limit characters.
+
+    Parsed structures are kept on the entries, found again by the identity of
+    the text returned by read().  Identical short texts (e.g., u'') may be
+    one object shared by several entries, so each identity maps to every
+    path whose entry holds it.
+    """
+    def __init__(self, limit=READ_CACHE_BYTES):
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.by_id = {}
+
+    def clear(self):
+        self.entries.clear()
+        self.by_id.clear()
+        self.size = 0
+
+    def _forget(self, path, entry):
+        paths = self.by_id.get(id(entry.text), {})
+        paths.pop(path, None)
+        if not paths:
+            self.by_id.pop(id(entry.text), None)
+        self.size -= len(entry.text)
+
+    def _drop(self, path):
+        self._forget(path, self.entries.pop(path))
+
+    def read(self, path):
+        """Read path as utf-8 text; raises as codecs.open() does.
+
+        Cached text is validated against STAT_CACHE; a fresh read records
+        the fstat() of the open file there.
+        """
+        entry = self.entries.get(path)
+        if entry is not None:
+            statobj = STAT_CACHE.stat(path)
+            del self.entries[path]
+            if statobj is not None and entry.signature == _signature(statobj):
+                self.entries[path] = entry
+                return entry.text
+            self._forget(path, entry)
+
+        with codecs.open(path, mode='r', encoding='utf-8') as rfp:
+            statobj = os.fstat(rfp.fileno())
+            STAT_CACHE.prime(path, statobj)
+            text = rfp.read()
+        entry = _ReadEntry(_signature(statobj), text)
+        self.entries[path] = entry
+        self.by_id.setdefault(id(text), {})[path] = entry
+        self.size += len(text)
+        while self.size > self.limit and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
+        return text
+
+    def parse(self, text, kind, parser):
+        """Parse text with parser, reusing the result if text came from read()."""
+        entry = None
+        for candidate in self.by_id.get(id(text), {}).itervalues():
+            if candidate.text is text:
+                entry = candidate
+                break
+        if entry is None:
+            return parser(text)
+        if kind not in entry.parsed:
+            entry.parsed[kind] = parser(text)
+        return entry.parsed[kind]
+
+READ_CACHE = ReadCache()
+
+def read_smw_file(path):
+    """Read an SMW file as utf-8 text through the run-scoped READ_CACHE.
+
+    Plugins reading SMW files should use this so that every reader shares
+    one read (and parse) of each file.
+    """
+    return READ_CACHE.read(path)
+
+def parse_smw_data(text, kind, parser):
+    """Parse text with parser, at most once per run for text from read_smw_file().
+
+    The parsed structure is shared and must not be modified.
+    """
+    return READ_CACHE.parse(text, kind, parser)
 
 def setattributes(_, obj):
-    if 'smwpath' not in obj or not os.path.exists(obj['smwpath']):
+    if 'smwpath' not in obj or not STAT_CACHE.exists(obj['smwpath']):
         raise ValueError('no valid smwpath for %s' % obj['name'])
-    statobj = os.stat(obj['smwpath'])
 
-    if 'owner' in obj:
-        passwd_data = pwd.getpwnam(obj['owner'])
-        uid = passwd_data[2]
-        os.chown(obj['smwpath'], uid, statobj.st_gid)
+    try:
+        if 'owner' in obj or 'group' in obj:
+            uid = get_uid(obj['owner']) if 'owner' in obj else -1
+            gid = get_gid(obj['group']) if 'group' in obj else -1
+            os.chown(obj['smwpath'], uid, gid)
 
-    statobj = os.stat(obj['smwpath'])
-    if 'group' in obj:
-        group_data = grp.getgrnam(obj['group'])
-        gid = group_data[2]
-        os.chown(obj['smwpath'], statobj.st_uid, gid)
+        if 'mode' in obj:
+            mode = int(obj['mode'])
+            os.chmod(obj['smwpath'], mode)
+    finally:
+        STAT_CACHE.invalidate(obj['smwpath'])
 
-    if 'mode' in obj:
-        mode = int(obj['mode'])
-        os.chmod(obj['smwpath'], mode)
+def setattributes_bulk(_, paths, obj):
+    """Apply the ownership and mode of obj to many paths, resolving ids once."""
+    uid = get_uid(obj['owner']) if 'owner' in obj else -1
+    gid = get_gid(obj['group']) if 'group' in obj else -1
+    for path in paths:
+        STAT_CACHE.invalidate(path)
+        if uid != -1 or gid != -1:
+            os.chown(path, uid, gid)
+        if 'mode' in obj:
+            os.chmod(path, int(obj['mode']))
 
-def verifyattributes(_, obj):
-    if 'smwpath' not in obj or not os.path.exists(obj['smwpath']):
-        raise ValueError('no valid smwpath for %s' % obj['name'])
-    statobj = os.stat(obj['smwpath'])
-
-    if 'owner' in obj:
-        passwd_data = pwd.getpwnam(obj['owner'])
-        uid = passwd_data[2]
-        if statobj.st_uid != uid:
-            return False
-
-    if 'group' in obj:
-        group_data = grp.getgrnam(obj['group'])
-        gid = group_data[2]
-        if statobj.st_gid != gid:
-            return False
-
-    if 'mode' in obj:
-        mode = int(obj['mode'])
-        if (statobj.st_mode & 07777) != mode:
-            return False
+def attributes_match(_, obj, statobj):
+    """Compare the ownership and mode of obj with an existing stat result."""
+    if 'owner' in obj and statobj.st_uid != get_uid(obj['owner']):
+        return False
+    if 'group' in obj and statobj.st_gid != get_gid(obj['group']):
+        return False
+    if 'mode' in obj and (statobj.st_mode & 07777) != int(obj['mode']):
+        return False
     return True
+
+def verifyattributes(config, obj):
+    statobj = STAT_CACHE.stat(obj['smwpath']) if 'smwpath' in obj else None
+    if statobj is None:
+        raise ValueError('no valid smwpath for %s' % obj['name'])
+    return attributes_match(config, obj, statobj)
@@ -0,0 +1,101 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.state
+
+Persistent smwflow state (last verified revisions, template dependency
+indexes, checksum caches) kept as yaml files, or json files for names ending
+in .json, inside a repo's git directory, so that it is never committed and
+follows the repo it describes.
+"""
+
+import os
+import json
+import fcntl
+import tempfile
+import subprocess
+import yaml
+
+def get_state_path(repo_path, filename):
+    """Get the path of a state file in the git directory of repo_path, or None."""
+    command = ['git', '-C', repo_path, 'rev-parse', '--git-dir']
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    if proc.returncode != 0 or not stdout.strip():
+        return None
+    return os.path.join(repo_path, stdout.strip(), filename)
+
+def is_writable(repo_path):
+    """Determine if state files can be written in the git directory of repo_path."""
+    path = get_state_path(repo_path, '')
+    return bool(path) and os.access(path, os.W_OK)
+
+def _load(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as rfp:
+        if path.endswith('.json'):
+            return json.load(rfp) or {}
+        return yaml.safe_load(rfp.read()) or {}
+
+def _save(path, state):
+    """Replace the state file at path atomically, so readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0666 & ~umask)
+        with os.fdopen(fd, 'w') as wfp:
+            if path.endswith('.json'):
+                json.dump(state, wfp)
+            else:
+                wfp.write(yaml.safe_dump(state, default_flow_style=False))
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def load_state(repo_path, filename):
+    path = get_state_path(repo_path, filename)
+    if not path:
+        return {}
+    return _load(path)
+
+def save_state(repo_path, filename, state):
+    path = get_state_path(repo_path, filename)
+    if not path:
+        return False
+    _save(path, state)
+    return True
+
+def update_state(repo_path, filename, update):
+    """Load a state file, apply update(state) to it in place and save it.
+
+    An exclusive lock is held across the load and the save so that
+    concurrent updates of the same file are not lost.
+    """
+    path = get_state_path(repo_path, filename)
+    if not path:
+        return False
+    with open('%s.lock' % path, 'a') as lfp:
+        fcntl.flock(lfp.fileno(), fcntl.LOCK_EX)
+        state = _load(path)
+        update(state)
+        _save(path, state)
+    return True
@@ -18,32 +18,52 @@ import os
 import yaml
 import smwflow.search
 
+# parsed vars files keyed by path, validated against the file's stat signature
+_FILE_CACHE = {}
+
+def clear_cache():
+    _FILE_CACHE.clear()
+
+def _load_vars_file(config, path, encrypted):
+    """Load (and decrypt) a vars file, reusing the parsed data while unchanged."""
+    stdata = os.stat(path)
+    signature = (stdata.st_ino, stdata.st_mtime, stdata.st_size)
+    key = (path, id(config.vaultobj) if encrypted else None)
+    if key in _FILE_CACHE and _FILE_CACHE[key][0] == signature:
+        return _FILE_CACHE[key][1]
+
+    with open(path, 'r') as rfp:
+        if encrypted:
+            data = yaml.load(config.vaultobj.decrypt(rfp.read()))
+        else:
+            data = yaml.load(rfp.read())
+    _FILE_CACHE[key] = (signature, data)
+    return data
+
 def read_vars(config, maintype, objtype, subtype=None, parentvars=None, system=None):
     if not system:
         system = config.system
 
-    vars_paths = smwflow.search.gen_paths(config, maintype, objtype, subtype)
+    vars_paths = smwflow.search.gen_paths(config, maintype, objtype, subtype, system=system)
     variables = {}
     for vars_path in vars_paths:
         unencrypted_vars_path = os.path.join(vars_path, '%s.yaml' % system)
         encrypted_vars_path = os.path.join(vars_path, '%s_secrets.yaml' % system)
         if os.path.exists(unencrypted_vars_path):
-            with open(unencrypted_vars_path, 'r') as rfp:
-                data = yaml.load(rfp.read())
-                for key in data:
-                    variables[key] = data[key]
+            data = _load_vars_file(config, unencrypted_vars_path, False)
+            for key in data:
+                variables[key] = data[key]
         if os.path.exists(encrypted_vars_path) and os.access(encrypted_vars_path, os.R_OK):
             if not config.vaultobj:
                 print "WARNING: cannot read %s, no usable ansible hash" % encrypted_vars_path
                 continue
-            with open(encrypted_vars_path, 'r') as rfp:
-                try:
-                    data = yaml.load(config.vaultobj.decrypt(rfp.read()))
-                except:
-                    print "Cannot decrypt variables in %s; skipping" % encrypted_vars_path
-                    continue
-                for key in data:
-                    variables[key] = data[key]
+            try:
+                data = _load_vars_file(config, encrypted_vars_path, True)
+            except:
+                print "Cannot decrypt variables in %s; skipping" % encrypted_vars_path
+                continue
+            for key in data:
+                variables[key] = data[key]
     if parentvars:
         for key in parentvars:
             if key not in variables:
@@ -0,0 +1,386 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.watch
+
+Near-real-time drift detection.  Registers inotify watches on the directories
+holding every managed SMW path (HSS files, IMPS files and config set trees),
+keeps the rendered git side in memory and re-verifies only the objects whose
+files change.  Each re-verified object that has drifted (or has returned to
+its managed state) is reported as one JSON object per line.  A watched
+directory that is removed is reported as unwatched, and is watched and
+re-verified again once it reappears.
+"""
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import struct
+import select
+import json
+import datetime
+import smwflow.hss as hss
+import smwflow.imps as imps
+import smwflow.cfgset as cfgset
+import smwflow.digests
+import smwflow.smwfile
+import smwflow.variables
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+FILE_MODULES = {
+    'hss': hss,
+    'imps': imps,
+}
+
+class Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API."""
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+        self.wds = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        if path in self.wds:
+            return self.wds[path]
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        self.wds[path] = wd
+        return wd
+
+    def read_events(self):
+        """Read the pending events as a list of (path, mask) tuples.
+
+        The removal of a watch (IN_IGNORED) is reported with the path of the
+        watched directory.
+        """
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                if path:
+                    self.wds.pop(path, None)
+                    events.append((path, mask))
+                continue
+            if wd not in self.paths:
+                continue
+            path = self.paths[wd]
+            if name:
+                path = os.path.join(path, name)
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class DriftWatcher(object):
+    def __init__(self, config, out):
+        self.config = config
+        self.out = out
+        self.inotify = Inotify()
+        self.files = {}
+        self.cfgsets = []
+        self.drifting = set()
+        self.pending_files = set()
+        self.pending_cfgset = {}
+        # directories that must stay watched, mapped to whether their
+        # subdirectories are watched too, and those currently missing
+        self.required = {}
+        self.lost = set()
+
+    def setup(self):
+        if self.config.watch_hss:
+            for obj in hss.get_verify_objects(self.config).values():
+                self._watch_file('hss', obj)
+        if self.config.watch_imps:
+            for obj in imps.get_verify_objects(self.config).values():
+                self._watch_file('imps', obj)
+        if self.config.watch_cfgset:
+            imps_vars = smwflow.variables.read_vars(self.config, 'imps', 'vars', None,
+                                                    self.config.global_vars)
+            for ctype, cname in [('global', 'global'), ('cle', self.config.cle_configset)]:
+                configset = cfgset.ConfigSet(self.config, ctype, cname, imps_vars)
+                root = os.path.realpath(os.path.join(self.config.configset_path, cname))
+                for obj_type in cfgset.CFGSET_OBJTYPES:
+                    self._watch_tree(os.path.join(root, obj_type),
+                                     obj_type in cfgset.CFGSET_FILETREE_OBJTYPES, True)
+                self.cfgsets.append((root, configset))
+
+    def _watch_file(self, kind, obj):
+        dirname = os.path.dirname(obj['smwpath'])
+        if not os.path.isdir(dirname):
+            print 'WARNING: cannot watch %s, %s does not exist' % (obj['smwpath'], dirname)
+            return
+        self.inotify.add_watch(dirname)
+        self.required.setdefault(dirname, False)
+        self.files[obj['smwpath']] = (kind, obj)
+
+    def _watch_tree(self, path, recursive, required=False):
+        if required:
+            self.required[path] = recursive
+        if not os.path.isdir(path):
+            return
+        self.inotify.add_watch(path)
+        if not recursive:
+            return
+        for (dirpath, dirnames, _) in os.walk(path):
+            for dirname in dirnames:
+                self.inotify.add_watch(os.path.join(dirpath, dirname))
+
+    @staticmethod
+    def _nearest_dir(path):
+        while not os.path.isdir(path):
+            path = os.path.dirname(path)
+        return path
+
+    def _arm(self, path):
+        """Watch the required directory path, returning True if it exists.
+
+        Otherwise its nearest existing ancestor is watched instead, so that
+        the creation of the missing directories is noticed (see _rearm()).
+        """
+        while True:
+            try:
+                if os.path.isdir(path):
+                    self._watch_tree(path, self.required[path])
+                    self.lost.discard(path)
+                    return True
+                self.lost.add(path)
+                ancestor = self._nearest_dir(path)
+                self.inotify.add_watch(ancestor)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                # removed again while being watched
+                continue
+            if self._nearest_dir(path) == ancestor:
+                return False
+
+    def _recover(self, path):
+        """Re-verify everything under a required directory that reappeared."""
+        self._emit({'kind': 'watch', 'path': path, 'status': 'watched'})
+        for smwpath in self.files:
+            if os.path.dirname(smwpath) == path:
+                self.pending_files.add(smwpath)
+        for idx, (root, _) in enumerate(self.cfgsets):
+            if os.path.dirname(path) == root:
+                self.pending_cfgset.setdefault(idx, {})[os.path.basename(path)] = None
+
+    def _lose(self, path):
+        if self._arm(path):
+            # already recreated
+            self._recover(path)
+        else:
+            self._emit({'kind': 'watch', 'path': path, 'status': 'unwatched'})
+
+    def _rearm(self):
+        for path in sorted(self.lost):
+            if self._arm(path):
+                self._recover(path)
+
+    def _emit(self, event):
+        event['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        event['system'] = self.config.system
+        self.out.write(json.dumps(event, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def _report(self, ident, event, drift, initial):
+        if drift:
+            self.drifting.add(ident)
+            event['status'] = 'drift'
+        elif ident in self.drifting:
+            self.drifting.discard(ident)
+            event['status'] = 'clean'
+        else:
+            return
+        if drift or not initial:
+            self._emit(event)
+
+    def _verify_file(self, smwpath, initial=False):
+        kind, obj = self.files[smwpath]
+        issues, attributes_ok = FILE_MODULES[kind].verify_object(self.config, obj)
+        event = {
+            'kind': kind,
+            'name': obj['name'],
+            'smwpath': smwpath,
+            'differences': issues if issues else [],
+            'readable': issues is not None,
+            'attributes_ok': attributes_ok,
+        }
+        drift = issues is None or bool(issues) or not attributes_ok
+        self._report((kind, smwpath), event, drift, initial)
+
+    def _verify_cfgset(self, configset, touched, initial=False):
+        diffs = configset.verify(touched)
+        for obj_type in diffs:
+            if obj_type == 'differences':
+                continue
+            diff = diffs[obj_type]
+            cfgset_root = os.path.realpath(os.path.join(self.config.configset_path,
+                                                        configset.cfgset_name, obj_type))
+            keys = touched[obj_type] if touched else None
+            if keys is None:
+                keys = set(diff['keys_git_only']) | set(diff['keys_smw_only']) | \
+                       set(diff['value_diff'].keys())
+                keys |= set(x[len(cfgset_root) + 1:] for x in diff['permissions']
+                            if x.startswith(cfgset_root + '/'))
+            for key in keys:
+                smwpath = os.path.join(cfgset_root, key)
+                event = {
+                    'kind': 'cfgset',
+                    'cfgset': configset.cfgset_name,
+                    'objtype': obj_type,
+                    'name': key,
+                    'smwpath': smwpath,
+                    'differences': diff['value_diff'].get(key, []),
+                    'missing': key in diff['keys_git_only'],
+                    'unmanaged': key in diff['keys_smw_only'],
+                    'attributes_ok': smwpath not in diff['permissions'],
+                }
+                drift = bool(event['differences']) or event['missing'] or \
+                        event['unmanaged'] or not event['attributes_ok']
+                self._report((configset.cfgset_name, obj_type, key), event, drift, initial)
+
+    def initial_scan(self):
+        for smwpath in self.files:
+            self._verify_file(smwpath, initial=True)
+        for _, configset in self.cfgsets:
+            self._verify_cfgset(configset, None, initial=True)
+
+    def _queue(self, events):
+        rearm = False
+        for path, mask in events:
+            if mask & IN_IGNORED:
+                if path in self.required:
+                    self._lose(path)
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                rearm = True
+            if path in self.files:
+                self.pending_files.add(path)
+                continue
+            for idx, (root, _) in enumerate(self.cfgsets):
+                if not path.startswith(root + '/'):
+                    continue
+                obj_type, _, key = path[len(root) + 1:].partition('/')
+                if obj_type not in cfgset.CFGSET_OBJTYPES or not key:
+                    break
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and \
+                            obj_type in cfgset.CFGSET_FILETREE_OBJTYPES:
+                        self._watch_tree(path, True)
+                        self._queue_tree(idx, root, obj_type, path)
+                    break
+                self._pend_cfgset(idx, obj_type, key)
+                break
+        if rearm and self.lost:
+            self._rearm()
+
+    def _pend_cfgset(self, idx, obj_type, key):
+        pending = self.pending_cfgset.setdefault(idx, {})
+        if obj_type not in pending:
+            pending[obj_type] = set()
+        if pending[obj_type] is not None:
+            pending[obj_type].add(key)
+
+    def _queue_tree(self, idx, root, obj_type, path):
+        """Queue every file under a newly appeared directory."""
+        start_idx = len(os.path.join(root, obj_type)) + 1
+        for (dirpath, _, filenames) in os.walk(path):
+            for filename in filenames:
+                key = os.path.join(dirpath, filename)[start_idx:]
+                self._pend_cfgset(idx, obj_type, key)
+
+    def verify_pending(self):
+        pending_files = self.pending_files
+        pending_cfgset = self.pending_cfgset
+        self.pending_files = set()
+        self.pending_cfgset = {}
+        # the files changed behind smwflow's back
+        smwflow.smwfile.STAT_CACHE.clear()
+
+        for smwpath in sorted(pending_files):
+            self._verify_file(smwpath)
+        for idx in sorted(pending_cfgset):
+            _, configset = self.cfgsets[idx]
+            touched = pending_cfgset[idx]
+            for obj_type in touched:
+                configset.graph.invalidate_smw(obj_type, touched[obj_type])
+            self._verify_cfgset(configset, touched)
+        smwflow.digests.save_index()
+
+    def run(self):
+        self.initial_scan()
+        while True:
+            select.select([self.inotify.fd], [], [])
+            self._queue(self.inotify.read_events())
+            # let bursts of writes settle before re-verifying
+            while True:
+                readable, _, _ = select.select([self.inotify.fd], [], [], self.config.settle)
+                if not readable:
+                    break
+                self._queue(self.inotify.read_events())
+            self.verify_pending()
+
+def watch(config):
+    """Run the drift watcher until interrupted.
+
+    Drift events are written as JSON lines to stdout; any other output
+    produced while verifying is sent to stderr so the event stream stays
+    machine readable.
+    """
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    watcher = DriftWatcher(config, out)
+    try:
+        watcher.setup()
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.inotify.close()
+        sys.stdout = out
+    return []
@@ -0,0 +1,387 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+smwflow.zypper
+
+Verify and update the zypper repos on the SMW against the git-lfs zypper
+repo.  Each top-level directory of the zypper repo is a repo, mirrored to
+the directory of the same name under config.zypper_path.
+
+Files are compared by checksum.  Package checksums are taken from the
+repomd/primary metadata of a repo where it lists the package with the size
+found on disk, and from git-lfs pointers for files not yet fetched;
+everything else is hashed, in parallel, with a persistent cache keyed by
+device, inode, mtime and size so unchanged files are never hashed twice.
+"""
+
+import os
+import gzip
+import mmap
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import xml.etree.cElementTree as ElementTree
+import smwflow.plan
+import smwflow.smwfile
+import smwflow.state
+
+CACHE_FILENAME = 'smwflow_checksums.json'
+# checksums not used in a run are dropped once the cache grows past this
+MAX_CACHE_ENTRIES = 200000
+HASH_BLOCK = 4 << 20
+LFS_POINTER_MAX = 1024
+LFS_POINTER_HEADER = 'version https://git-lfs.github.com/spec/v1'
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+
+def sha256_file(path):
+    """Hash a file by streaming it through an mmap."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as rfp:
+        size = os.fstat(rfp.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        mapped = mmap.mmap(rfp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, size, HASH_BLOCK):
+                digest.update(buffer(mapped, offset, HASH_BLOCK))
+        finally:
+            mapped.close()
+    return digest.hexdigest()
+
+class ChecksumCache(object):
+    """sha256 checksums keyed by the stat signature of the file hashed.
+
+    The cache is kept in the git directory of the zypper repo.  Like the
+    verify index (see smwflow.digests) it is best-effort: it is not saved
+    when that directory is not writable.
+    """
+    def __init__(self, repo_path=None):
+        self.repo_path = repo_path
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        if repo_path:
+            try:
+                self.entries = smwflow.state.load_state(repo_path, CACHE_FILENAME)
+            except (IOError, OSError, ValueError):
+                self.entries = {}
+
+    @staticmethod
+    def key(statobj):
+        return '%d:%d:%r:%d' % (statobj.st_dev, statobj.st_ino, statobj.st_mtime,
+                                statobj.st_size)
+
+    def get(self, statobj):
+        key = self.key(statobj)
+        self.used.add(key)
+        return self.entries.get(key)
+
+    def set(self, statobj, checksum):
+        key = self.key(statobj)
+        self.used.add(key)
+        self.entries[key] = checksum
+        self.dirty = True
+
+    def save(self):
+        if not self.repo_path or not self.dirty or \
+                not smwflow.state.is_writable(self.repo_path):
+            return False
+        def merge(state):
+            state.update(self.entries)
+            if len(state) > MAX_CACHE_ENTRIES:
+                kept = {x: state[x] for x in self.used if x in state}
+                state.clear()
+                state.update(kept)
+        self.dirty = False
+        try:
+            return smwflow.state.update_state(self.repo_path, CACHE_FILENAME, merge)
+        except (IOError, OSError):
+            return False
+
+def get_cache(config):
+    if config.zypper and os.path.isdir(config.zypper):
+        return ChecksumCache(config.zypper)
+    return ChecksumCache()
+
+def _lfs_pointer(path, statobj):
+    """Parse a git-lfs pointer file, returning (sha256, size) or None."""
+    if statobj.st_size > LFS_POINTER_MAX:
+        return None
+    with open(path, 'rb') as rfp:
+        data = rfp.read()
+    if not data.startswith(LFS_POINTER_HEADER):
+        return None
+    fields = dict(x.split(' ', 1) for x in data.splitlines() if ' ' in x)
+    oid = fields.get('oid', '')
+    if not oid.startswith('sha256:') or 'size' not in fields:
+        return None
+    return oid[len('sha256:'):], int(fields['size'])
+
+def _read_metadata(repo_path):
+    """Read package checksums from repomd/primary metadata.
+
+    Returns: dict
+        relative package path -> (checksum type, checksum, size); empty if
+        the repo has no (readable) metadata.
+    """
+    repomd = os.path.join(repo_path, 'repodata', 'repomd.xml')
+    if not os.path.exists(repomd):
+        return {}
+    primary = None
+    try:
+        for data in ElementTree.parse(repomd).getroot().findall(REPO_NS + 'data'):
+            if data.get('type') == 'primary':
+                primary = data.find(REPO_NS + 'location').get('href')
+    except (ElementTree.ParseError, AttributeError):
+        return {}
+    if not primary:
+        return {}
+
+    primary = os.path.join(repo_path, primary)
+    if primary.endswith('.gz'):
+        opener = gzip.open
+    elif primary.endswith('.xml'):
+        opener = open
+    else:
+        # e.g., xz-compressed metadata, which python 2 cannot read
+        return {}
+
+    ret = {}
+    try:
+        with opener(primary, 'rb') as rfp:
+            for _, elem in ElementTree.iterparse(rfp):
+                if elem.tag != COMMON_NS + 'package':
+                    continue
+                checksum = elem.find(COMMON_NS + 'checksum')
+                location = elem.find(COMMON_NS + 'location')
+                size = elem.find(COMMON_NS + 'size')
+                if checksum is not None and location is not None and size is not None:
+                    ret[location.get('href')] = (checksum.get('type'), checksum.text,
+                                                 int(size.get('package')))
+                elem.clear()
+    except (IOError, ElementTree.ParseError, ValueError):
+        return {}
+    return ret
+
+def _scan_repo(repo_path):
+    """Map the relative paths of the files in a repo to their stat results.
+
+    Returns: tuple
+        the file map, the set of directories (not including symlinks to
+        directories) and the set of symlinks whose target is missing
+    """
+    files = {}
+    dirs = set()
+    broken = set()
+    start_idx = len(repo_path) + 1
+    for (dirpath, dirnames, filenames) in os.walk(repo_path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        for dirname in dirnames:
+            fullpath = os.path.join(dirpath, dirname)
+            if not os.path.islink(fullpath):
+                dirs.add(fullpath[start_idx:])
+        for filename in filenames:
+            fullpath = os.path.join(dirpath, filename)
+            try:
+                files[fullpath[start_idx:]] = os.stat(fullpath)
+            except OSError:
+                broken.add(fullpath[start_idx:])
+    return files, dirs, broken
+
+class RepoInventory(object):
+    """The files of one repo with the checksums known for them."""
+    def __init__(self, path, lfs=False):
+        self.path = path
+        self.files, self.dirs, self.broken = _scan_repo(path) if os.path.isdir(path) \
+                                             else ({}, set(), set())
+        self.checksums = dict((x, {}) for x in self.files)
+        self.sizes = dict((x, self.files[x].st_size) for x in self.files)
+        self.pointers = set()
+        metadata = _read_metadata(path)
+        for relpath, statobj in self.files.items():
+            if relpath in metadata:
+                ctype, checksum, size = metadata[relpath]
+                if size == statobj.st_size:
+                    self.checksums[relpath][ctype] = checksum
+            if lfs:
+                pointer = _lfs_pointer(os.path.join(path, relpath), statobj)
+                if pointer:
+                    self.checksums[relpath]['sha256'] = pointer[0]
+                    self.sizes[relpath] = pointer[1]
+                    self.pointers.add(relpath)
+
+def _hash_job(args):
+    path, _ = args
+    try:
+        return sha256_file(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+def ensure_sha256(inventories_relpaths, cache, processes=None):
+    """Compute the missing sha256 checksums of (inventory, relpath) pairs."""
+    jobs = []
+    targets = []
+    for inventory, relpath in inventories_relpaths:
+        if 'sha256' in inventory.checksums[relpath]:
+            continue
+        statobj = inventory.files[relpath]
+        cached = cache.get(statobj)
+        if cached:
+            inventory.checksums[relpath]['sha256'] = cached
+            continue
+        jobs.append((os.path.join(inventory.path, relpath), statobj))
+        targets.append((inventory, relpath))
+    if not jobs:
+        return
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # hashlib releases the GIL while hashing large buffers, so threads suffice
+    pool = ThreadPool(max(1, min(processes, len(jobs))))
+    try:
+        results = pool.map(_hash_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (inventory, relpath), (_, statobj), checksum in zip(targets, jobs, results):
+        if checksum:
+            inventory.checksums[relpath]['sha256'] = checksum
+            cache.set(statobj, checksum)
+
+def compare_repo(git_inv, smw_inv, cache):
+    """Compare a git repo inventory with the SMW copy.
+
+    Returns: dict
+        'missing', 'extra' and 'different' lists of relative paths.  Broken
+        symlinks on the SMW are extra, or different if git has the file.
+    """
+    git_keys = set(git_inv.files)
+    smw_keys = set(smw_inv.files) | smw_inv.broken
+    ret = {
+        'missing': sorted(git_keys - smw_keys),
+        'extra': sorted(smw_keys - git_keys),
+        'different': sorted(git_keys & smw_inv.broken),
+    }
+    common = sorted(git_keys & set(smw_inv.files))
+    need_hash = []
+    for relpath in common:
+        if git_inv.sizes[relpath] != smw_inv.sizes[relpath]:
+            continue
+        shared = set(git_inv.checksums[relpath]) & set(smw_inv.checksums[relpath])
+        if not shared:
+            need_hash.extend([(git_inv, relpath), (smw_inv, relpath)])
+    ensure_sha256(need_hash, cache)
+
+    for relpath in common:
+        if git_inv.sizes[relpath] != smw_inv.sizes[relpath]:
+            ret['different'].append(relpath)
+            continue
+        git_sums = git_inv.checksums[relpath]
+        smw_sums = smw_inv.checksums[relpath]
+        shared = sorted(set(git_sums) & set(smw_sums))
+        if not shared or any(git_sums[x] != smw_sums[x] for x in shared):
+            ret['different'].append(relpath)
+    ret['different'].sort()
+    return ret
+
+def _check_broken(repo, git_inv, deferred_actions):
+    """Report the broken symlinks in a git zypper repo, which cannot be synced."""
+    for relpath in sorted(git_inv.broken):
+        print "WARNING: zypper repo %s: broken symlink %s" % (repo, relpath)
+    if git_inv.broken:
+        deferred_actions.append("Fix broken symlinks in zypper repo %s" % repo)
+
+def get_repos(config, names=None):
+    """List the repos to process: names, or every repo in the zypper git repo."""
+    if names:
+        return list(names)
+    if not config.zypper or not os.path.isdir(config.zypper):
+        return []
+    return sorted(x for x in os.listdir(config.zypper)
+                  if not x.startswith('.') and os.path.isdir(os.path.join(config.zypper, x)))
+
+def _selected_repos(config, all_attr):
+    if getattr(config, all_attr, False):
+        return get_repos(config)
+    return get_repos(config, config.zypper_repos)
+
+def _inventories(config, repo):
+    git_inv = RepoInventory(os.path.join(config.zypper, repo), lfs=True)
+    smw_path = smwflow.smwfile.smw_root_path(config, os.path.join(config.zypper_path, repo))
+    return git_inv, RepoInventory(smw_path)
+
+def verify_data(config):
+    deferred_actions = []
+    cache = get_cache(config)
+    for repo in _selected_repos(config, 'verify_all_zypper'):
+        git_inv, smw_inv = _inventories(config, repo)
+        if not git_inv.files:
+            print "WARNING: zypper repo %s not found in %s" % (repo, config.zypper)
+            deferred_actions.append("Investigate missing zypper repo %s" % repo)
+            continue
+        _check_broken(repo, git_inv, deferred_actions)
+        diffs = compare_repo(git_inv, smw_inv, cache)
+        count = sum(len(x) for x in diffs.values())
+        print "zypper repo %s: %d files, %d missing, %d extra, %d different" % \
+              (repo, len(git_inv.files), len(diffs['missing']), len(diffs['extra']),
+               len(diffs['different']))
+        for kind in ['missing', 'extra', 'different']:
+            for relpath in diffs[kind]:
+                print "    %s %s" % (kind, relpath)
+        if count > 0:
+            deferred_actions.append("Resolve differences in zypper repo %s" % repo)
+    cache.save()
+    return deferred_actions
+
+def update_data(config, plan):
+    """Add the copies and deletes syncing the SMW zypper repos to plan."""
+    deferred_actions = []
+    cache = get_cache(config)
+    for repo in _selected_repos(config, 'update_all_zypper'):
+        git_inv, smw_inv = _inventories(config, repo)
+        if not git_inv.files:
+            print "WARNING: zypper repo %s not found in %s" % (repo, config.zypper)
+            continue
+        _check_broken(repo, git_inv, deferred_actions)
+        diffs = compare_repo(git_inv, smw_inv, cache)
+        copies = diffs['missing'] + diffs['different']
+        fetched = [x for x in copies if x not in git_inv.pointers]
+        if len(fetched) < len(copies):
+            deferred_actions.append("Run 'git lfs pull' in %s for repo %s" % (config.zypper, repo))
+        ensure_sha256([(git_inv, x) for x in fetched], cache)
+
+        if not os.path.isdir(smw_inv.path):
+            plan.mkdir(smw_inv.path)
+        for dirname in sorted(git_inv.dirs - smw_inv.dirs):
+            plan.mkdir(os.path.join(smw_inv.path, dirname))
+        for relpath in fetched:
+            if relpath in smw_inv.broken:
+                plan.delete(os.path.join(smw_inv.path, relpath))
+            plan.copy(os.path.join(smw_inv.path, relpath), os.path.join(git_inv.path, relpath),
+                      git_inv.checksums[relpath].get('sha256'))
+            plan.attributes(os.path.join(smw_inv.path, relpath), {'mode': 0644})
+        for relpath in diffs['extra']:
+            plan.delete(os.path.join(smw_inv.path, relpath))
+        # deepest directories first so they are empty when removed
+        extra_dirs = sorted(smw_inv.dirs - git_inv.dirs, reverse=True)
+        for dirname in extra_dirs:
+            plan.rmdir(os.path.join(smw_inv.path, dirname))
+        print "zypper repo %s: %d to copy, %d to delete" % \
+              (repo, len(fetched), len(diffs['extra']) + len(extra_dirs))
+    cache.save()
+    return deferred_actions
@@ -0,0 +1,170 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+Tests for smwflow.compare: ignore_keys matching, the agreement of equal()
+with basic_compare(), and the stability of canonical digests.
+
+usage: python -m unittest discover tests
+"""
+
+import unittest
+import yaml
+import smwflow.compare as compare
+
+class Config(object):
+    system = 'test'
+
+CONFIG = Config()
+
+def _baseline_diff(git_data, smw_data, typestr, keyskiplist):
+    """The ignore_keys handling of dictionaries before IgnoreSpec."""
+    ret = []
+    if type(git_data) is not type(smw_data):
+        return ['type %s' % typestr]
+    if isinstance(git_data, dict):
+        for item in set(smw_data) - set(git_data):
+            ret.append("smw %s:%s" % (typestr, item))
+        for item in set(git_data) - set(smw_data):
+            ret.append("git %s:%s" % (typestr, item))
+        for item in set(smw_data) & set(git_data):
+            if item in keyskiplist:
+                continue
+            ret.extend(_baseline_diff(git_data[item], smw_data[item],
+                                      "%s:%s" % (typestr, item), keyskiplist))
+    elif git_data != smw_data:
+        ret.append("smw %s:%s" % (typestr, smw_data))
+        ret.append("git %s:%s" % (typestr, git_data))
+    return ret
+
+# (git, smw) yaml documents of dictionaries, compared with each ignore list
+BASELINE_CASES = [
+    (u'a: 1\nb: 2\n', u'a: 1\nb: 3\n'),
+    (u'a: {b: 1, c: 2}\n', u'a: {b: 5, c: 2}\n'),
+    (u'a: {b: {c: 1}}\nc: 2\n', u'a: {b: {c: 2}}\nc: 3\n'),
+    (u'cray_net.settings.hosts.data.foo: 1\nx: 2\n',
+     u'cray_net.settings.hosts.data.foo: 3\nx: 2\n'),
+    (u'a: {x.y: 1}\n', u'a: {x.y: 2}\n'),
+    (u'a: 1\nb: 2\n', u'a: 1\n'),
+    (u'a: {b: 1}\n', u'a: {c: 1}\n'),
+]
+BASELINE_IGNORES = [
+    [],
+    ['b'],
+    ['c'],
+    ['a'],
+    ['cray_net.settings.hosts.data.foo'],
+    ['x.y', 'b'],
+]
+
+def _obj(name, ignore_keys=None):
+    obj = {'name': name}
+    if ignore_keys is not None:
+        obj['ignore_keys'] = ignore_keys
+    return obj
+
+class IgnoreSpecTest(unittest.TestCase):
+    def test_names_match_baseline(self):
+        for git_data, smw_data in BASELINE_CASES:
+            for ignore_keys in BASELINE_IGNORES:
+                obj = _obj('test.yaml', ignore_keys)
+                expected = _baseline_diff(yaml.safe_load(git_data), yaml.safe_load(smw_data),
+                                          'test.yaml', ignore_keys)
+                got = compare.basic_compare(CONFIG, obj, git_data, smw_data)
+                self.assertEqual(sorted(got), sorted(expected),
+                                 '%r %r %r' % (git_data, smw_data, ignore_keys))
+                self.assertEqual(compare.equal(CONFIG, obj, git_data, smw_data), not expected)
+
+    def test_dotted_name_is_a_key(self):
+        spec = compare.IgnoreSpec(['a.b'])
+        self.assertEqual(spec.descend(spec.roots(), 'a.b'), (True, []))
+        self.assertEqual(spec.descend(spec.roots(), 'a'), (False, []))
+
+    def test_path(self):
+        obj = _obj('test.yaml', ['path:a.*.b'])
+        git_data = u'a: {x: {b: 1, c: 1}, y: {b: 1}}\nb: 1\n'
+        self.assertEqual(compare.basic_compare(CONFIG, obj, git_data,
+                                               u'a: {x: {b: 2, c: 1}, y: {b: 3}}\nb: 1\n'), [])
+        self.assertTrue(compare.equal(CONFIG, obj, git_data,
+                                      u'a: {x: {b: 2, c: 1}, y: {b: 3}}\nb: 1\n'))
+        # only from the top of the tree
+        smw_data = u'a: {x: {b: 1, c: 1}, y: {b: 1}}\nb: 2\n'
+        self.assertNotEqual(compare.basic_compare(CONFIG, obj, git_data, smw_data), [])
+        self.assertFalse(compare.equal(CONFIG, obj, git_data, smw_data))
+        # and not beyond its end
+        smw_data = u'a: {x: {b: 1, c: 2}, y: {b: 1}}\nb: 1\n'
+        self.assertFalse(compare.equal(CONFIG, obj, git_data, smw_data))
+
+    def test_ignored_keys_must_exist(self):
+        obj = _obj('test.yaml', ['b'])
+        self.assertFalse(compare.equal(CONFIG, obj, u'a: 1\nb: 2\n', u'a: 1\n'))
+
+# (name, git, smw) covering each structured format and raw text
+AGREEMENT_CASES = [
+    ('t.yaml', u'a: 1\nb: [1, 2]\n', u'b: [2, 1]\na: 1\n'),
+    ('t.yaml', u'a: 1\nb: [1, 2]\n', u'a: 1\nb: [1, 3]\n'),
+    ('t.yaml', u'a: {b: 1}\n', u'a: [1]\n'),
+    ('t.json', u'{"a": 1, "b": {"c": 2}}', u'{"b": {"c": 2}, "a": 1}'),
+    ('t.json', u'{"a": 1, "b": {"c": 2}}', u'{"b": {"c": 3}, "a": 1}'),
+    ('t.ini', u'[s]\na = 1\nb = 2\n', u'[s]\nb = 2\na = 1\n'),
+    ('t.ini', u'[s]\na = 1\n', u'[s]\na = 2\n'),
+    ('t.txt', u'a  b\nc\n', u'a b c\n'),
+    ('t.txt', u'a b\n', u'a c\n'),
+]
+
+class EqualTest(unittest.TestCase):
+    def test_agrees_with_basic_compare(self):
+        for name, git_data, smw_data in AGREEMENT_CASES:
+            for ignore_keys in [None, ['a'], ['c'], ['path:b.c']]:
+                obj = _obj(name, ignore_keys)
+                diffs = compare.basic_compare(CONFIG, obj, git_data, smw_data)
+                self.assertEqual(compare.equal(CONFIG, obj, git_data, smw_data), not diffs,
+                                 '%s %r %r %r: %r' % (name, git_data, smw_data, ignore_keys,
+                                                      diffs))
+
+class CanonicalDigestTest(unittest.TestCase):
+    def test_stable(self):
+        obj = _obj('t.yaml')
+        digest = compare.canonical_digest(CONFIG, obj, u'a: 1\nb: [1, 2]\n')
+        self.assertEqual(digest, compare.canonical_digest(CONFIG, obj, u'a: 1\nb: [1, 2]\n'))
+        self.assertEqual(digest, compare.canonical_digest(CONFIG, obj,
+                                                          u'b:\n  - 2\n  - 1\na:   1\n'))
+        self.assertNotEqual(digest, compare.canonical_digest(CONFIG, obj, u'a: 2\nb: [1, 2]\n'))
+
+    def test_ignored_values(self):
+        obj = _obj('t.yaml', ['a'])
+        digest = compare.canonical_digest(CONFIG, obj, u'a: 1\nb: 2\n')
+        self.assertEqual(digest, compare.canonical_digest(CONFIG, obj, u'a: 5\nb: 2\n'))
+        # the ignored key still has to be there
+        self.assertNotEqual(digest, compare.canonical_digest(CONFIG, obj, u'b: 2\n'))
+
+    def test_format_matters(self):
+        self.assertNotEqual(compare.canonical_digest(CONFIG, _obj('t.yaml'), u'{"a": 1}'),
+                            compare.canonical_digest(CONFIG, _obj('t.json'), u'{"a": 1}'))
+
+    def test_agrees_with_equal(self):
+        for name, git_data, smw_data in AGREEMENT_CASES:
+            obj = _obj(name)
+            same = compare.canonical_digest(CONFIG, obj, git_data) == \
+                   compare.canonical_digest(CONFIG, obj, smw_data)
+            self.assertEqual(same, compare.equal(CONFIG, obj, git_data, smw_data),
+                             '%s %r %r' % (name, git_data, smw_data))
+
+    def test_unparsable(self):
+        self.assertEqual(compare.canonical_digest(CONFIG, _obj('t.json'), u'{'), None)
+
+if __name__ == '__main__':
+    unittest.main()
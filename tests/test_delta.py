@@ -0,0 +1,144 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+Tests for smwflow.delta: mapping changed repo paths to the objects they
+affect.
+
+usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import smwflow.delta as delta
+    import smwflow.deps as deps
+    import smwflow.cfgset as cfgset
+except ImportError:
+    # smwflow.cfgset needs rsm, which is only available on an SMW
+    delta = None
+
+class Config(object):
+    def __init__(self, smwconf):
+        self.system = 'test'
+        self.smwconf = smwconf
+        self.secured = None
+
+@unittest.skipIf(delta is None, 'smwflow.delta cannot be imported')
+class SelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.smwconf = tempfile.mkdtemp()
+        self.config = Config(self.smwconf)
+
+    def tearDown(self):
+        shutil.rmtree(self.smwconf)
+
+    def _selection(self, templates=None):
+        """A Selection whose deps index holds templates (group -> name -> variables)."""
+        selection = delta.Selection()
+        selection.deps = deps.DepsIndex(self.config)
+        for group, names in (templates or {}).items():
+            selection.deps.templates[group] = dict(
+                (name, {'variables': variables, 'includes': []})
+                for name, variables in names.items())
+        return selection
+
+    def _add_plugin(self, ctype):
+        path = os.path.join(self.smwconf, 'imps', '%s_ansible_plugins' % ctype)
+        os.makedirs(path)
+        open(os.path.join(path, 'plugin.py'), 'w').close()
+
+    def test_template(self):
+        selection = self._selection()
+        selection.add_path(self.config, 'hss/hss/xtdiscover.ini')
+        selection.add_path(self.config, 'imps/test_imps/a/b.conf')
+        selection.add_path(self.config, 'imps/cle_config/c.yaml')
+        self.assertEqual(selection.hss, set(['xtdiscover.ini']))
+        self.assertEqual(selection.imps, set(['a/b.conf']))
+        self.assertEqual(selection.cfgset, {'cle': {'config': set(['c.yaml'])}})
+
+    def test_manifest_selects_the_type(self):
+        selection = self._selection()
+        selection.add_path(self.config, 'hss/hss/.smwflow.manifest.yaml')
+        selection.add_path(self.config, 'imps/global_dist/.smwflow.manifest.yaml')
+        self.assertEqual(selection.hss, None)
+        self.assertEqual(selection.cfgset, {'global': {'dist': None}})
+
+    def test_other_systems_are_ignored(self):
+        selection = self._selection()
+        selection.add_path(self.config, 'hss/other_hss/xtdiscover.ini')
+        selection.add_path(self.config, 'vars/vars/other.yaml')
+        selection.add_path(self.config, 'README')
+        self.assertEqual(selection.hss, set())
+        self.assertEqual(selection.imps, set())
+        self.assertEqual(selection.cfgset, {})
+
+    def test_vars_narrowed_by_deps(self):
+        selection = self._selection({
+            deps.group_key('hss', 'hss'): {'a.ini': ['x'], 'b.ini': ['y']},
+            deps.group_key('imps', 'config', 'cle'): {'c.yaml': ['x', 'z']},
+        })
+        selection.add_path(self.config, 'vars/vars/test.yaml', ['x'])
+        self.assertEqual(selection.hss, set(['a.ini']))
+        self.assertEqual(selection.imps, set())
+        self.assertEqual(selection.cfgset['cle']['config'], set(['c.yaml']))
+        for obj_type in ['worksheets', 'config', 'dist']:
+            self.assertFalse(selection.cfgset['global'].get(obj_type))
+
+    def test_vars_without_keys_select_everything(self):
+        selection = self._selection()
+        selection.add_path(self.config, 'hss/test_vars/test.yaml', None)
+        self.assertEqual(selection.hss, None)
+        self.assertEqual(selection.imps, set())
+
+    def test_cfgset_vars(self):
+        selection = self._selection({
+            deps.group_key('imps', 'dist', 'cle'): {'d': ['x'], 'e': ['y']},
+        })
+        selection.add_path(self.config, 'imps/cle_dist_vars/test.yaml', ['y'])
+        self.assertEqual(selection.cfgset, {'cle': {'dist': set(['e'])}})
+
+    def test_plugins_disable_narrowing(self):
+        self._add_plugin('cle')
+        selection = self._selection({
+            deps.group_key('imps', 'config', 'cle'): {'c.yaml': ['x']},
+            deps.group_key('imps', 'config', 'global'): {'g.yaml': ['x']},
+        })
+        selection.add_path(self.config, 'imps/cle_config_vars/test.yaml', ['y'])
+        selection.add_path(self.config, 'imps/global_config_vars/test.yaml', ['x'])
+        self.assertEqual(selection.cfgset, {'cle': {'config': None},
+                                            'global': {'config': set(['g.yaml'])}})
+
+    def test_plugin_and_worksheet_changes(self):
+        self._add_plugin('cle')
+        all_types = dict((x, None) for x in cfgset.CFGSET_OBJTYPES)
+        selection = self._selection()
+        selection.add_path(self.config, 'imps/cle_worksheets/cray_net_worksheet.yaml')
+        self.assertEqual(selection.cfgset, {'cle': all_types})
+        selection = self._selection()
+        selection.add_path(self.config, 'imps/cle_files_plugins/other.py')
+        self.assertEqual(selection.cfgset, {'cle': all_types})
+        # without plugins a worksheet selects only itself
+        selection = self._selection()
+        selection.add_path(self.config, 'imps/global_worksheets/cray_net_worksheet.yaml')
+        self.assertEqual(selection.cfgset,
+                         {'global': {'worksheets': set(['cray_net_worksheet.yaml'])}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# smwflow Copyright (c) 2018, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy). All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at  IPO@lbl.gov.
+#
+# NOTICE.  This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights. As
+# such, the U.S. Government has been granted for itself and others acting on its
+# behalf a paid-up, nonexclusive, irrevocable, worldwide license in the Software
+# to reproduce, distribute copies to the public, prepare derivative works, and
+# perform publicly and display publicly, and to permit other to do so.
+#
+# See the LICENSE file in the top-level of the smwflow source distribution.
+
+"""
+Tests for smwflow.smwfile: the run-scoped read and parse caches.
+
+usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import smwflow.smwfile as smwfile
+
+class ReadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        smwfile.STAT_CACHE.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        smwfile.STAT_CACHE.clear()
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as wfp:
+            wfp.write(data)
+        smwfile.STAT_CACHE.invalidate(path)
+        return path
+
+    def _touch_later(self, path, data):
+        # make sure the stat signature changes even on coarse mtimes
+        statobj = os.stat(path)
+        self._write(os.path.basename(path), data)
+        os.utime(path, (statobj.st_atime, statobj.st_mtime + 10))
+        smwfile.STAT_CACHE.invalidate(path)
+
+    def test_read_is_cached(self):
+        path = self._write('a', 'hello')
+        cache = smwfile.ReadCache()
+        first = cache.read(path)
+        self.assertEqual(first, u'hello')
+        self.assertTrue(cache.read(path) is first)
+        self.assertEqual(cache.size, 5)
+
+    def test_changed_file_is_reread(self):
+        path = self._write('a', 'hello')
+        cache = smwfile.ReadCache()
+        cache.read(path)
+        self._touch_later(path, 'changed')
+        self.assertEqual(cache.read(path), u'changed')
+        self.assertEqual(cache.size, 7)
+
+    def test_eviction(self):
+        paths = [self._write(x, 'abcd') for x in 'abc']
+        cache = smwfile.ReadCache(limit=8)
+        for path in paths:
+            cache.read(path)
+        self.assertEqual(cache.entries.keys(), paths[1:])
+        self.assertEqual(cache.size, 8)
+
+    def test_shared_empty_texts(self):
+        # u'' is a single object, so entries of empty files share one text
+        empty = [self._write(x, '') for x in 'ab']
+        cache = smwfile.ReadCache(limit=3)
+        self.assertTrue(cache.read(empty[0]) is cache.read(empty[1]))
+        cache.read(self._write('c', 'abcd'))
+        self.assertEqual(cache.entries.keys(), [os.path.join(self.tmpdir, 'c')])
+        self.assertEqual(cache.size, 4)
+
+    def test_shared_empty_texts_changed(self):
+        empty = [self._write(x, '') for x in 'ab']
+        cache = smwfile.ReadCache()
+        for path in empty:
+            cache.read(path)
+        for path in empty:
+            self._touch_later(path, 'x')
+        self.assertEqual([cache.read(x) for x in empty], [u'x', u'x'])
+        self.assertEqual(cache.size, 2)
+
+    def test_parse_is_shared(self):
+        path = self._write('a', 'hello')
+        cache = smwfile.ReadCache()
+        calls = []
+        def parser(text):
+            calls.append(text)
+            return [text]
+        text = cache.read(path)
+        first = cache.parse(text, 'kind', parser)
+        self.assertTrue(cache.parse(cache.read(path), 'kind', parser) is first)
+        self.assertEqual(len(calls), 1)
+        # text not read through the cache is parsed every time
+        cache.parse(u'other', 'kind', parser)
+        cache.parse(u'other', 'kind', parser)
+        self.assertEqual(len(calls), 3)
+
+    def test_parse_after_eviction(self):
+        path = self._write('a', 'abcd')
+        cache = smwfile.ReadCache(limit=4)
+        text = cache.read(path)
+        cache.read(self._write('b', 'efgh'))
+        self.assertEqual(cache.parse(text, 'kind', lambda x: [x]), [u'abcd'])
+
+if __name__ == '__main__':
+    unittest.main()